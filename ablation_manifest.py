@@ -0,0 +1,147 @@
+"""One manifest for all nested ablations of a dataset, and the provider lists rendered from it.
+
+Ablations are nested: the images of a class in ablation 20 are the first images of that class in ablation 80, and so
+on. So instead of a train and val list per ablation and provider, create_ablations.py writes a single
+
+    data/{dataset}/ablations/{dataset}_manifest.csv
+
+with one [file, class_id, split, ablation] row per image of the largest ablation: class_id indexes the classes of
+data/{dataset}/classes.txt, split is train or val, and ablation is the smallest ablation the image belongs to. An
+image is in ablation a when its ablation is <= a. Rows are grouped by class in classes.txt order and keep the order
+of {dataset}_train.csv within a class, so every list rendered from the manifest has the same rows in the same order
+as the per-ablation files it replaces.
+
+Uploaders read their rows straight from the manifest (ablation_rows). The files for services that import a list
+through their console (Vertex AI, Hugging Face, Azure ML) are rendered on demand:
+
+    python ablation_manifest.py render <dataset> [ablation ...]
+
+writes {dataset}_{split}_{view}_{ablation}.csv/.jsonl for the given ablations (default all) like before.
+"""
+
+import csv
+import io
+import math
+import os
+import sys
+from json.encoder import encode_basestring
+
+VIEWS = ["plain", "vertex", "hg", "nyckel", "azure", "aws"]
+
+
+def manifest_file(dataset):
+    return f"data/{dataset}/ablations/{dataset}_manifest.csv"
+
+
+def read_classes(dataset):
+    with open(f"data/{dataset}/classes.txt") as f:
+        return f.read().split(",")
+
+
+def write_manifest(dataset, classes, ablations, by_class):
+    """Splits the first ablations[0] images of every class into 80% train and 20% val and records the smallest
+    ablation of each image: a train image at position i of its class is in every ablation a with i < int(0.8 * a),
+    a val image at position j in every ablation a with j < ceil(0.2 * a) and in ablations[0]."""
+    smallest_first = sorted(ablations)
+    split = int(ablations[0] * 0.8)
+    if not os.path.exists(os.path.dirname(manifest_file(dataset))):
+        os.makedirs(os.path.dirname(manifest_file(dataset)))
+    with open(f"{manifest_file(dataset)}.tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "class_id", "split", "ablation"])
+        for class_id, cls in enumerate(classes):
+            images = by_class.get(cls, [])[: ablations[0]]
+            for i, file_name in enumerate(images[:split]):
+                level = next(a for a in smallest_first if i < int(a * 0.8))
+                writer.writerow([file_name, class_id, "train", level])
+            for j, file_name in enumerate(images[split:]):
+                level = next(a for a in smallest_first if j < math.ceil(a * 0.2) or a == ablations[0])
+                writer.writerow([file_name, class_id, "val", level])
+    os.replace(f"{manifest_file(dataset)}.tmp", manifest_file(dataset))
+
+
+def read_manifest(dataset):
+    """[(file, class, split, ablation)] in manifest order."""
+    classes = read_classes(dataset)
+    with open(manifest_file(dataset), newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [(file_name, classes[int(class_id)], split, int(level)) for file_name, class_id, split, level in reader]
+
+
+def manifest_ablations(manifest):
+    """The ablation sizes of a manifest, largest first."""
+    return sorted({row[3] for row in manifest}, reverse=True)
+
+
+def ablation_rows(dataset, ablation, split, manifest=None):
+    """[(file, class)] of one split ("train" or "val") of an ablation."""
+    manifest = read_manifest(dataset) if manifest is None else manifest
+    ablation = int(ablation)
+    return [
+        (file_name, cls) for file_name, cls, row_split, level in manifest if row_split == split and level <= ablation
+    ]
+
+
+def csv_text(rows):
+    buffer = io.StringIO()
+    a = csv.writer(buffer, delimiter=",")
+    a.writerows(rows)
+    return buffer.getvalue()
+
+
+def azure_jsonl_text(rows):
+    """[(image_url, label)] as Azure ML's {"image_url": ..., "label": ...} lines, byte for byte what jsonlines writes,
+    with the strings escaped by json's C encoder instead of one JSONEncoder call per row."""
+    return "".join(
+        f'{{"image_url": {encode_basestring(url)}, "label": {encode_basestring(label)}}}\n' for url, label in rows
+    )
+
+
+def render_view(train, val, split, view, google_bucket_name, azure_training_uploads, azure_val_uploads):
+    """(file name suffix, text) of one provider list, e.g. ("train_vertex", ...), from an ablation's train and val
+    rows. nyckel only has a train list, which holds the train and val images."""
+    rows = train if split == "train" else val
+    if view == "plain":
+        return split, csv_text(rows)
+    if view == "vertex":
+        folder = "training_uploads" if split == "train" else "val_uploads"
+        return f"{split}_vertex", csv_text(
+            (f"{google_bucket_name}/{folder}/{file_name}", cls) for file_name, cls in rows
+        )
+    if view == "hg":
+        return f"{split}_hg", csv_text([("file", "label")] + rows)
+    if view == "nyckel":
+        return "train_nyckel", csv_text(train + val)
+    if view == "azure":
+        prefix = azure_training_uploads if split == "train" else azure_val_uploads
+        return f"{split}_azure", azure_jsonl_text((prefix + file_name, cls) for file_name, cls in rows)
+    if view == "aws":
+        return f"{split}_aws", csv_text(rows)
+    raise ValueError(f"Unknown view {view}, expected one of {VIEWS}")
+
+
+def render_files(dataset, ablations=None, views=VIEWS, uris=None):
+    """Writes the provider lists of the given ablations (default all) into data/{dataset}/ablations/."""
+    if uris is None:
+        from create_ablations import get_bucket_uris
+
+        uris = get_bucket_uris(dataset)
+    manifest = read_manifest(dataset)
+    ablations = manifest_ablations(manifest) if not ablations else [int(ablation) for ablation in ablations]
+    for ablation in ablations:
+        train = ablation_rows(dataset, ablation, "train", manifest)
+        val = ablation_rows(dataset, ablation, "val", manifest)
+        for view in views:
+            for split in ["train"] if view == "nyckel" else ["train", "val"]:
+                name, text = render_view(train, val, split, view, *uris)
+                extension = "jsonl" if view == "azure" else "csv"
+                path = f"data/{dataset}/ablations/{dataset}_{name}_{ablation}.{extension}"
+                with open(path, "w", encoding="utf-8" if view == "azure" else None) as f:
+                    f.write(text)
+                print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "render":
+        render_files(sys.argv[2], sys.argv[3:])
@@ -1,24 +1,40 @@
 import io
 import boto3
-import csv
 import sys
 import os
 import logging
 import time
-import pandas as pd
 from PIL import Image
-from joblib import Parallel, delayed
-from tqdm import tqdm
 
 
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+
+from ablation_manifest import ablation_rows, read_manifest
+from image_store import md5_lookup
+from load_generator import run_open_loop
+from retry import parse_retry_after
+from runner import read_test_rows, run_invoke, run_parallel
+from s3_upload import bulk_upload
+from throughput_sweep import run_sweep
+from service_adapter import ServiceAdapter, ServiceError
 
 logger = logging.getLogger(__name__)
+# No response from the endpoint, retried like a 503: EndpointConnectionError and ConnectTimeoutError are botocore
+# ConnectionErrors, ReadTimeoutError and ConnectionClosedError are HTTPClientErrors
+TRANSPORT_ERRORS = (BotocoreConnectionError, HTTPClientError)
+
+# Rekognition reports throttling as a 400 with one of these codes
+THROTTLING_ERROR_CODES = {"ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException"}
+S3_MAX_POOL_CONNECTIONS = 64
 
 
 def create_client(type):
     AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
     AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+    # Set AWS_ENDPOINT_URL to run against mock_server.py or another local stand-in
+    AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
 
     if type == "rekognition":
         print("creating rekognition client")
@@ -27,6 +43,9 @@ def create_client(type):
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
             region_name="us-west-2",
+            endpoint_url=AWS_ENDPOINT_URL,
+            # Retries are done (and counted) by runner.py, not silently inside botocore
+            config=Config(retries={"total_max_attempts": 1}),
         )
     elif type == "s3":
         print("creating s3 client")
@@ -35,37 +54,88 @@ def create_client(type):
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
             region_name="us-west-2",
+            endpoint_url=AWS_ENDPOINT_URL,
+            # Enough connections for every worker of s3_upload.bulk_upload
+            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
         )
 
 
 def create_bucket(bucket_name):
-    s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+    try:
+        s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+    except ClientError as err:
+        # Re-running an upload only sends what is missing from the bucket
+        if err.response.get("Error", {}).get("Code") != "BucketAlreadyOwnedByYou":
+            raise
 
 
-def upload_folder(dataset, ablation, bucket_name, s3):
+def upload_folder(dataset, ablation, bucket_name, s3, workers=16):
+    """Uploads the train/val images of an ablation (or the test images for ablation "test") that are not already in
+    the bucket, `workers` at a time."""
+    files = []
     if ablation != "test":
-        with open(f"data/{dataset}/ablations/{dataset}_train_aws_{ablation}.csv") as csvfile:
-            reader = csv.reader(csvfile)
-            # get the class labels from classes.txt
+        samples = read_manifest(dataset)
+        for split in ["train", "val"]:
+            for filename, label in ablation_rows(dataset, ablation, split, samples):
+                files.append((f"data/{dataset}/train/{label}/{filename}", f"{split}/{label}/{filename}"))
+    else:
+        bucket_name = f"argot-{bucket_name}"
+        for filename, label in read_test_rows(f"data/{dataset}/{dataset}_test_aws.csv"):
+            files.append((f"data/{dataset}/test/{label}/{filename}", f"test/{label}/{filename}"))
+    manifest = f"data/{dataset}/s3_manifests/{bucket_name}.csv"
+    bulk_upload(s3, bucket_name, files, manifest, workers, md5_of=md5_lookup(dataset))
 
-            for row in reader:
-                s3.upload_file(f"data/{dataset}/train/{row[1]}/{row[0]}", bucket_name, f"train/{row[1]}/{row[0]}")
 
-        with open(f"data/{dataset}/ablations/{dataset}_val_aws_{ablation}.csv") as csvfile:
-            reader = csv.reader(csvfile)
-            # get the class labels from classes.txt
+JPEG_MAGIC = b"\xff\xd8\xff"
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
 
-            for row in reader:
-                s3.upload_file(f"data/{dataset}/train/{row[1]}/{row[0]}", bucket_name, f"val/{row[1]}/{row[0]}")
-    else:
-        with open(f"data/{dataset}/{dataset}_test_aws.csv") as csvfile:
-            reader = csv.reader(csvfile)
-            # get the class labels from classes.txt
 
-            for row in reader:
-                s3.upload_file(
-                    f"data/{dataset}/test/{row[1]}/{row[0]}", f"argot-{bucket_name}", f"test/{row[1]}/{row[0]}"
-                )
+def detect_image_type(image_bytes):
+    if image_bytes[:3] == JPEG_MAGIC:
+        return "image/jpeg"
+    if image_bytes[:8] == PNG_MAGIC:
+        return "image/png"
+    return None
+
+
+def load_image_bytes(photo, decode=False):
+    """Returns the bytes to send for a local image. By default the file is sent as-is, with the format checked from
+    its magic bytes. decode=True keeps the old path that opens the image with PIL and re-encodes it, which costs a
+    full decode/encode per request and can change the bytes that are sent."""
+    if not decode:
+        with open(photo, "rb") as f:
+            image_bytes = f.read()
+        if detect_image_type(image_bytes) is None:
+            logger.error("Invalid image type for %s", photo)
+            raise ValueError(f"Invalid file format. Supply a jpeg or png format file: {photo}")
+        return image_bytes
+
+    image = Image.open(photo)
+    image_type = Image.MIME[image.format]
+
+    if (image_type == "image/jpeg" or image_type == "image/png") is False:
+        logger.error("Invalid image type for %s", photo)
+        raise ValueError(f"Invalid file format. Supply a jpeg or png format file: {photo}")
+
+    # get images bytes for call to detect_anomalies
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format=image.format)
+    return image_bytes.getvalue()
+
+
+def compare_payload_paths(dataset, n_images=100):
+    """Reports the client CPU time per image spent preparing the payload with and without the PIL decode/re-encode."""
+    rows = read_test_rows(f"data/{dataset}/{dataset}_test_aws.csv", limit=n_images)
+    cpu_times = {}
+    for decode in [True, False]:
+        start = time.thread_time()
+        for filename, label in rows:
+            load_image_bytes(f"data/{dataset}/test/{label}/{filename}", decode=decode)
+        cpu_times[decode] = (time.thread_time() - start) / len(rows)
+    print(f"CPU time per image with PIL re-encode: {1000 * cpu_times[True]:.2f} ms")
+    print(f"CPU time per image sending file bytes: {1000 * cpu_times[False]:.2f} ms")
+    print(f"Saved per image: {1000 * (cpu_times[True] - cpu_times[False]):.2f} ms")
+    return cpu_times
 
 
 def analyze_local_image(rek_client, model, photo, min_confidence):
@@ -80,24 +150,14 @@ def analyze_local_image(rek_client, model, photo, min_confidence):
 
     try:
         logger.info("Analyzing local file: %s", photo)
-        image = Image.open(photo)
-        image_type = Image.MIME[image.format]
-
-        if (image_type == "image/jpeg" or image_type == "image/png") is False:
-            logger.error("Invalid image type for %s", photo)
-            raise ValueError(f"Invalid file format. Supply a jpeg or png format file: {photo}")
-
-        # get images bytes for call to detect_anomalies
-        image_bytes = io.BytesIO()
-        image.save(image_bytes, format=image.format)
-        image_bytes = image_bytes.getvalue()
-        start = time.time()
+        image_bytes = load_image_bytes(photo)
+        start = time.perf_counter_ns()
 
         response = rek_client.detect_custom_labels(
             Image={"Bytes": image_bytes}, MinConfidence=min_confidence, ProjectVersionArn=model
         )
-        end = time.time()
-        latency = end - start
+        end = time.perf_counter_ns()
+        latency = (end - start) / 1e9
 
         return response["CustomLabels"], latency
 
@@ -109,98 +169,81 @@ def analyze_local_image(rek_client, model, photo, min_confidence):
         raise
 
 
+class RekognitionAdapter(ServiceAdapter):
+    name = "aws"
+    test_suffix = "aws"
+
+    def __init__(self, dataset, model, min_confidence=1, decode=False):
+        super().__init__(dataset)
+        self.model = model
+        self.min_confidence = min_confidence
+        self.decode = decode
+        self.rek_client = create_client("rekognition")
+
+    def prepare(self, filename, label):
+        if self.decode:
+            return load_image_bytes(self.image_path(filename, label), decode=True)
+        image_bytes = self.image_bytes(filename, label)
+        if detect_image_type(image_bytes) is None:
+            raise ValueError(f"Invalid file format. Supply a jpeg or png format file: {filename}")
+        # botocore only accepts bytes, not a memoryview into the packed store
+        return bytes(image_bytes)
+
+    def send(self, payload):
+        try:
+            return self.rek_client.detect_custom_labels(
+                Image={"Bytes": payload}, MinConfidence=self.min_confidence, ProjectVersionArn=self.model
+            )
+        except ClientError as client_err:
+            logger.error(format(client_err))
+            metadata = client_err.response["ResponseMetadata"]
+            status_code = metadata.get("HTTPStatusCode")
+            if client_err.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                status_code = 429
+            retry_after = parse_retry_after(metadata.get("HTTPHeaders", {}).get("retry-after"))
+            raise ServiceError(str(client_err), status_code, retry_after)
+        except TRANSPORT_ERRORS as err:
+            raise ServiceError(f"Connection failed: {err}") from err
+
+    def parse(self, response):
+        custom_labels = response["CustomLabels"]
+        if len(custom_labels) == 0:
+            return "none", 0.0
+        return custom_labels[0]["Name"], custom_labels[0]["Confidence"]
+
+
 def invoke(dataset, ablationSize, model):
-    results = [[], [], [], [], []]
-    if not os.path.exists(f"data/{dataset}/results"):
-        os.makedirs(f"data/{dataset}/results")
-    if os.path.exists(f"data/{dataset}/results/{dataset}-aws-results-{str(ablationSize)}.csv"):
-        df = pd.read_csv(f"data/{dataset}/results/{dataset}-aws-results-{str(ablationSize)}.csv", header=None)
-        results[0] = df[0].tolist()
-        results[1] = df[1].tolist()
-        results[2] = df[2].tolist()
-        results[3] = df[3].tolist()
-        results[4] = df[4].tolist()
-
-    rek_client = create_client("rekognition")
-
-    with open(f"data/{dataset}/{dataset}_test_aws.csv") as csvfile:
-        reader = csv.reader(csvfile)
-        # get the class labels from classes.txt
-
-        for row in reader:
-            filename = row[0].split("/")[-1]
-            print(filename)
-            if filename in results[0]:
-                print("already done")
-                continue
-            else:
-                custom_labels, latency = analyze_local_image(
-                    rek_client, model, f"data/{dataset}/test/{row[1]}/{filename}", 1
-                )
-                print(custom_labels)
-
-                if len(custom_labels) == 0:
-                    results[0].append(filename)
-                    results[1].append(row[1])
-                    results[2].append("none")
-                    results[3].append(0.0)
-                    results[4].append(latency)
-                else:
-                    results[0].append(filename)
-                    results[1].append(row[1])
-                    results[2].append(custom_labels[0]["Name"])
-                    results[3].append(custom_labels[0]["Confidence"])
-                    results[4].append(latency)
-                df = pd.DataFrame(results)
-                df = df.transpose()
-                df.to_csv(
-                    f"data/{dataset}/results/{dataset}-aws-results-{str(ablationSize)}.csv", index=False, header=False
-                )
+    run_invoke(RekognitionAdapter(dataset, model), ablationSize)
 
 
 def parallel_invoke(dataset, ablationSize, model):
-    
-
-    rek_client = create_client("rekognition")
-
-    filenames = []
-    labels = []
-    with open(f"data/{dataset}/{dataset}_test_aws.csv") as csvfile:
-        reader = csv.reader(csvfile)
-        # get the class labels from classes.txt
-        count = 0
-        for row in reader:
-            filenames.append(row[0].split("/")[-1])
-            labels.append(row[1])
-            count += 1
-            if count == 1000:
-                break
-
-
-    def _parallel_invoke(filename: str, label: str):
-
-        custom_labels, latency = analyze_local_image(
-                    rek_client, model, f"data/{dataset}/test/{label}/{filename}", 1
-                )
-
-    start = time.time()
-    Parallel(n_jobs=10, prefer="threads")(
-        delayed(_parallel_invoke)(filename, label)
-        for filename, label in tqdm(zip(filenames, labels), total=len(labels))
-    )
-    end = time.time()
-    print(f"Time to 1000 invokes {dataset}-{ablationSize}: {end - start}")
+    run_parallel(RekognitionAdapter(dataset, model), ablationSize)
+
+
+def async_invoke(dataset, ablationSize, model, concurrency=10):
+    run_invoke(RekognitionAdapter(dataset, model), ablationSize, concurrency)
+
+
+def load_test(dataset, ablationSize, model, rps, duration=60, warmup=10):
+    run_open_loop(RekognitionAdapter(dataset, model), ablationSize, rps, duration, warmup)
+
+
+def sweep(dataset, ablationSize, model, max_concurrency=64, n_requests=1000):
+    run_sweep(RekognitionAdapter(dataset, model), ablationSize, max_concurrency, n_requests)
+
 
 if __name__ == "__main__":
     if sys.argv[1] == "upload":
         dataset = sys.argv[2]
         ablation = sys.argv[3]
 
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+
         bucket_name = f"{dataset}-{ablation}"
         s3 = create_client("s3")
         create_bucket(bucket_name)
 
-        upload_folder(dataset, ablation, bucket_name, s3)
+        upload_folder(dataset, ablation, bucket_name, s3, workers)
         print(f"s3://{bucket_name}/train/")
         print(f"s3://{bucket_name}/val/")
         print(f"s3://{bucket_name}/")
@@ -214,3 +257,28 @@ if __name__ == "__main__":
         ablation = sys.argv[3]
         model = sys.argv[4]
         parallel_invoke(dataset, ablation, model)
+    elif sys.argv[1] == "async":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        model = sys.argv[4]
+        concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 10
+        async_invoke(dataset, ablation, model, concurrency)
+    elif sys.argv[1] == "load":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        model = sys.argv[4]
+        rps = float(sys.argv[5])
+        duration = float(sys.argv[6]) if len(sys.argv) > 6 else 60
+        warmup = float(sys.argv[7]) if len(sys.argv) > 7 else 10
+        load_test(dataset, ablation, model, rps, duration, warmup)
+    elif sys.argv[1] == "sweep":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        model = sys.argv[4]
+        max_concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 64
+        n_requests = int(sys.argv[6]) if len(sys.argv) > 6 else 1000
+        sweep(dataset, ablation, model, max_concurrency, n_requests)
+    elif sys.argv[1] == "payload-cpu":
+        dataset = sys.argv[2]
+        n_images = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        compare_payload_paths(dataset, n_images)
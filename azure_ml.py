@@ -3,10 +3,18 @@ from azure.ai.ml import MLClient
 from azure.ai.ml.constants import AssetTypes
 
 from azure.ai.ml.entities import Data
+import base64
 import json
 import os
 import sys
 
+from http_session import HttpSession
+from load_generator import run_open_loop
+from retry import parse_retry_after
+from runner import run_invoke, run_parallel
+from throughput_sweep import run_sweep
+from service_adapter import ServiceAdapter, ServiceError
+
 
 def get_mlclient(subscription_id, resource_group, workspace_name):
     credential = DefaultAzureCredential()
@@ -52,8 +60,65 @@ def upload(dataset, resource_group, workspace_name, subscription_id):
         print(uri_folder_data_asset.path)
 
 
-def invoke():
-    url = "https://xrays-20.westus.inference.ml.azure.com/score"
+class AzureAdapter(ServiceAdapter):
+    name = "azure"
+    test_suffix = "azure"
+
+    def __init__(self, dataset, scoring_uri, pool_size=10):
+        super().__init__(dataset)
+        self.url = scoring_uri
+        api_key = os.getenv("AZURE_ML_API_KEY")
+        self.headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        self.session = HttpSession(pool_size)
+
+    def connection_reused(self):
+        return self.session.connection_reused()
+
+    def first_byte_ns(self):
+        return self.session.first_byte_ns()
+
+    def prepare(self, filename, label):
+        encoded_content = base64.b64encode(super().prepare(filename, label)).decode("utf-8")
+        return json.dumps({"input_data": {"columns": ["image"], "index": [0], "data": [encoded_content]}})
+
+    def send(self, payload):
+        try:
+            response = self.session.post(self.url, headers=self.headers, data=payload)
+        except self.session.transport_errors as err:
+            raise ServiceError(f"Connection failed: {err}") from err
+        if response.status_code != 200:
+            raise ServiceError(
+                f"{response.text=} {response.status_code=}",
+                response.status_code,
+                parse_retry_after(response.headers.get("Retry-After")),
+            )
+        return response.json()
+
+    def parse(self, response):
+        # AutoML image classification endpoints return the probability of every label, highest is the prediction
+        probs = response[0]["probs"]
+        best = max(range(len(probs)), key=lambda i: probs[i])
+        return response[0]["labels"][best], probs[best]
+
+
+def invoke(dataset, ablationSize, scoring_uri):
+    run_invoke(AzureAdapter(dataset, scoring_uri, pool_size=1), ablationSize)
+
+
+def parallel_invoke(dataset, ablationSize, scoring_uri):
+    run_parallel(AzureAdapter(dataset, scoring_uri, pool_size=10), ablationSize)
+
+
+def async_invoke(dataset, ablationSize, scoring_uri, concurrency=10):
+    run_invoke(AzureAdapter(dataset, scoring_uri, pool_size=concurrency), ablationSize, concurrency)
+
+
+def load_test(dataset, ablationSize, scoring_uri, rps, duration=60, warmup=10):
+    run_open_loop(AzureAdapter(dataset, scoring_uri, pool_size=64), ablationSize, rps, duration, warmup)
+
+
+def sweep(dataset, ablationSize, scoring_uri, max_concurrency=64, n_requests=1000):
+    run_sweep(AzureAdapter(dataset, scoring_uri, pool_size=max_concurrency), ablationSize, max_concurrency, n_requests)
 
 
 if __name__ == "__main__":
@@ -63,3 +128,34 @@ if __name__ == "__main__":
         workspace_name = sys.argv[4]
         subscription_id = sys.argv[5]
         upload(dataset, resource_group, workspace_name, subscription_id)
+    elif sys.argv[1] == "invoke":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        scoring_uri = sys.argv[4]
+        invoke(dataset, ablation, scoring_uri)
+    elif sys.argv[1] == "parallel":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        scoring_uri = sys.argv[4]
+        parallel_invoke(dataset, ablation, scoring_uri)
+    elif sys.argv[1] == "async":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        scoring_uri = sys.argv[4]
+        concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 10
+        async_invoke(dataset, ablation, scoring_uri, concurrency)
+    elif sys.argv[1] == "load":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        scoring_uri = sys.argv[4]
+        rps = float(sys.argv[5])
+        duration = float(sys.argv[6]) if len(sys.argv) > 6 else 60
+        warmup = float(sys.argv[7]) if len(sys.argv) > 7 else 10
+        load_test(dataset, ablation, scoring_uri, rps, duration, warmup)
+    elif sys.argv[1] == "sweep":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        scoring_uri = sys.argv[4]
+        max_concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 64
+        n_requests = int(sys.argv[6]) if len(sys.argv) > 6 else 1000
+        sweep(dataset, ablation, scoring_uri, max_concurrency, n_requests)
@@ -0,0 +1,131 @@
+"""Bootstrap confidence intervals for accuracy and latency.
+
+All resamples of a cell are drawn at once, and none of them needs a Python loop or a sort per resample:
+
+- accuracy: resampling n predictions with replacement and counting the correct ones is exactly a Binomial(n,
+  accuracy) draw, so B resamples are one vector of binomials (for all cells at once).
+- latency quantiles: a resample is F^-1(U_1..U_n) for the empirical CDF F and uniform U_i, so its k-th smallest value
+  is x_(ceil(n * U_(k))) with U_(k) ~ Beta(k, n + 1 - k). B resampled quantiles are B beta draws and one gather from
+  the sorted latencies.
+- mean latency: B resamples are a (B, n) index matrix, processed `chunk_size` resamples at a time to bound memory
+  and optionally spread over `n_jobs` processes.
+
+Cells are the (dataset, service, ablation) groups loaded by get_results.py. Quantiles use the order statistic
+x_(ceil(q * n)), NumPy's "inverted_cdf" method.
+
+    python bootstrap.py [n_resamples]
+
+prints the table of CIs for every cell.
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+
+def _mean_chunk(latencies, n_resamples, seed):
+    rng = np.random.default_rng(seed)
+    return latencies[rng.integers(0, len(latencies), size=(n_resamples, len(latencies)))].mean(axis=1)
+
+
+def bootstrap_mean(latencies, n_resamples=2000, chunk_size=None, n_jobs=1, seed=0):
+    """Means of n_resamples resamples. chunk_size defaults to as many resamples as fit in ~16M index entries."""
+    latencies = np.asarray(latencies, dtype=float)
+    if chunk_size is None:
+        chunk_size = max(1, min(n_resamples, 2**24 // max(1, len(latencies))))
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_jobs == 1:
+        chunks = [_mean_chunk(latencies, size, s) for size, s in zip(sizes, seeds)]
+    else:
+        chunks = Parallel(n_jobs=n_jobs)(delayed(_mean_chunk)(latencies, size, s) for size, s in zip(sizes, seeds))
+    return np.concatenate(chunks)
+
+
+def bootstrap_quantiles(latencies, quantiles, n_resamples=2000, seed=0):
+    """(n_resamples, len(quantiles)) resampled quantiles, drawn through the beta distribution of uniform order
+    statistics instead of materializing the resamples."""
+    rng = np.random.default_rng(seed)
+    ordered = np.sort(np.asarray(latencies, dtype=float))
+    n = len(ordered)
+    ranks = np.clip(np.ceil(np.asarray(quantiles) * n).astype(int), 1, n)
+    u = rng.beta(ranks, n + 1 - ranks, size=(n_resamples, len(ranks)))
+    return ordered[np.clip(np.ceil(u * n).astype(int) - 1, 0, n - 1)]
+
+
+def bootstrap_latency(latencies, n_resamples=2000, quantiles=(0.5, 0.99), n_jobs=1, seed=0):
+    """(n_resamples, 1 + len(quantiles)) array with the mean and the quantiles of every resample."""
+    means = bootstrap_mean(latencies, n_resamples, n_jobs=n_jobs, seed=seed)
+    return np.column_stack([means, bootstrap_quantiles(latencies, quantiles, n_resamples, seed)])
+
+
+def interval(resamples, confidence=0.95, axis=0):
+    """Percentile interval (low, high) of bootstrap resamples."""
+    alpha = (1 - confidence) / 2
+    return np.quantile(resamples, [alpha, 1 - alpha], axis=axis)
+
+
+def bootstrap_cells(
+    keys, groups, correct, latencies, n_resamples=2000, confidence=0.95, quantiles=(0.5, 0.99), n_jobs=1, seed=0
+):
+    """One row per cell with point estimates and bootstrap CIs of accuracy, mean latency and latency quantiles. Takes
+    the arrays returned by get_results.load_indexed_results."""
+    rng = np.random.default_rng(seed)
+    counts = np.bincount(groups, minlength=len(keys))
+    n_correct = np.bincount(groups, weights=correct, minlength=len(keys))
+
+    # Accuracy for every cell in one draw: (n_resamples, n_cells)
+    accuracy_resamples = rng.binomial(counts, n_correct / np.maximum(counts, 1), size=(n_resamples, len(keys)))
+    accuracy_low, accuracy_high = interval(accuracy_resamples / np.maximum(counts, 1), confidence)
+
+    # Latency resamples per cell; rows of a cell are contiguous once sorted by group
+    order = np.argsort(groups, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    names = ["mean"] + [f"p{100 * q:g}" for q in quantiles]
+    rows = []
+    for cell, (dataset, service, ablation) in enumerate(keys):
+        cell_latencies = latencies[order[bounds[cell] : bounds[cell + 1]]]
+        row = {
+            "dataset": dataset,
+            "service": service,
+            "ablation": ablation,
+            "n": counts[cell],
+            "accuracy": n_correct[cell] / counts[cell] if counts[cell] else np.nan,
+            "accuracy_low": accuracy_low[cell],
+            "accuracy_high": accuracy_high[cell],
+        }
+        if counts[cell]:
+            point = [cell_latencies.mean(), *np.quantile(cell_latencies, quantiles, method="inverted_cdf")]
+            resamples = bootstrap_latency(cell_latencies, n_resamples, quantiles, n_jobs=n_jobs, seed=seed + cell)
+            low, high = interval(resamples, confidence)
+            for name, value, lo, hi in zip(names, point, low, high):
+                row.update({f"latency_{name}": value, f"latency_{name}_low": lo, f"latency_{name}_high": hi})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def bootstrap_combined_accuracy(n_correct, counts, n_resamples=10000, confidence=0.95, seed=0):
+    """CI of the accuracy averaged over datasets, resampling the predictions of every dataset independently.
+    n_correct and counts are (..., n_datasets) arrays, NaN/0 where a dataset has no results; returns (mean, low, high)
+    with the leading shape."""
+    rng = np.random.default_rng(seed)
+    counts = np.asarray(counts, dtype=int)
+    present = counts > 0
+    p = np.where(present, np.nan_to_num(n_correct) / np.maximum(counts, 1), 0)
+    resamples = rng.binomial(counts, p, size=(n_resamples, *counts.shape)) / np.maximum(counts, 1)
+    n_present = present.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(present, resamples, 0).sum(axis=-1) / n_present
+        point = np.where(present, p, 0).sum(axis=-1) / n_present
+    low, high = interval(means, confidence)
+    return point, low, high
+
+
+if __name__ == "__main__":
+    from get_results import get_results
+
+    n_resamples = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    table = bootstrap_cells(*get_results(), n_resamples=n_resamples, quantiles=(0.5, 0.9, 0.99))
+    print(table.to_string(index=False))
@@ -2,25 +2,27 @@ import json
 import csv
 import os
 import random
-import shutil
 import sys
-import jsonlines
 
+from ablation_manifest import ablation_rows, read_manifest, write_manifest
+from image_store import image_source
+from materialize import materialize_all
 
-def get_ablations(dataset):
+
+def get_ablations(dataset, class_counts=None):
+    """The ablation sizes below the image count of the smallest class. class_counts ({class: number of images}) saves
+    listing every class folder when the counts are already known."""
     ablations = [1280, 320, 80, 20, 5]
 
-    train_folders = os.listdir(f"data/{dataset}/train")
-    if ".DS_Store" in train_folders:
-        train_folders.remove(".DS_Store")
-    print(f"Number of classes in {dataset}: {len(train_folders)}")
+    if class_counts is None:
+        train_folders = os.listdir(f"data/{dataset}/train")
+        if ".DS_Store" in train_folders:
+            train_folders.remove(".DS_Store")
+        class_counts = {class_: len(os.listdir(f"data/{dataset}/train/{class_}")) for class_ in train_folders}
+    print(f"Number of classes in {dataset}: {len(class_counts)}")
     # find the number of images in each class and print the class with the fewest images
-    min_images = 100000
-    for class_ in train_folders:
-        images = os.listdir(f"data/{dataset}/train/{class_}")
-        if len(images) < min_images:
-            min_images = len(images)
-            min_class = class_
+    min_class = min(class_counts, key=class_counts.get)
+    min_images = class_counts[min_class]
     print(f"Class with the fewest images: {min_class} with {min_images} images")
     # find the number and index in ABLATIONS that is the next lowest number from min_images
     for i, ablation in enumerate(ablations):
@@ -69,202 +71,43 @@ def get_bucket_uris(dataset):
     return google_bucket_name, azure_training_uploads, azure_val_uploads
 
 
-def create_ablation_files(dataset, classes, ablations, google_bucket_name, azure_training_uploads, azure_val_uploads):
-    class_list = [[], []]
-    train_list = [[], []]
-    val_list = [[], []]
-    for cls in classes:
-        ablation_count = 0
-        class_list = [[], []]
-        vertex_train_list = [[], []]
-        vertex_val_list = [[], []]
-        azure_train_list = []
-        azure_val_list = []
-        hg_train_list = [["file"], ["label"]]
-        hg_val_list = [["file"], ["label"]]
-        nyckel_train_list = [[], []]
-        aws_train_list = [[], []]
-        aws_val_list = [[], []]
-        with open(f"data/{dataset}/{dataset}_train.csv") as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row[1] == cls and ablation_count < ablations[0]:
-                    class_list[0].append(row[0])
-                    class_list[1].append(cls)
-                    ablation_count += 1
-        train_list[0].extend(class_list[0][: int(ablations[0] * 0.8)])
-        train_list[1].extend(class_list[1][: int(ablations[0] * 0.8)])
-        for file_name, file_class in zip(train_list[0], train_list[1]):
-            vertex_train_list[0].append(f"{google_bucket_name}/training_uploads/{file_name}")
-            vertex_train_list[1].append(file_class)
-        hg_train_list[0].extend(train_list[0])
-        hg_train_list[1].extend(train_list[1])
-        # concatenate the validation list and the training list into nyckel_train_list
-        nyckel_train_list[0].extend(train_list[0])
-        nyckel_train_list[1].extend(train_list[1])
-        for file_name, file_class in zip(train_list[0], train_list[1]):
-            azure_train_list.append({"image_url": azure_training_uploads + file_name, "label": file_class})
-        aws_train_list[0].extend(train_list[0])
-        aws_train_list[1].extend(train_list[1])
-
-        val_list[0].extend(class_list[0][int(ablations[0] * 0.8) :])
-        val_list[1].extend(class_list[1][int(ablations[0] * 0.8) :])
-        for file_name, file_class in zip(val_list[0], val_list[1]):
-            vertex_val_list[0].append(f"{google_bucket_name}/val_uploads/{file_name}")
-            vertex_val_list[1].append(file_class)
-        hg_val_list[0].extend(val_list[0])
-        hg_val_list[1].extend(val_list[1])
-        nyckel_train_list[0].extend(val_list[0])
-        nyckel_train_list[1].extend(val_list[1])
-        for file_name, file_class in zip(val_list[0], val_list[1]):
-            azure_val_list.append({"image_url": azure_val_uploads + file_name, "label": file_class})
-
-        aws_val_list[0].extend(val_list[0])
-        aws_val_list[1].extend(val_list[1])
-
-    if not os.path.exists(f"data/{dataset}/ablations"):
-        os.makedirs(f"data/{dataset}/ablations")
-
-    with open(f"data/{dataset}/ablations/{dataset}_train_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*train_list))
-    with open(f"data/{dataset}/ablations/{dataset}_train_vertex_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*vertex_train_list))
-    with open(f"data/{dataset}/ablations/{dataset}_train_hg_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*hg_train_list))
-    with open(f"data/{dataset}/ablations/{dataset}_train_nyckel_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*nyckel_train_list))
-    with jsonlines.open(f"data/{dataset}/ablations/{dataset}_train_azure_{ablations[0]}.jsonl", "w") as writer:
-        writer.write_all(azure_train_list)
-    with open(f"data/{dataset}/ablations/{dataset}_train_aws_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*aws_train_list))
-    with open(f"data/{dataset}/ablations/{dataset}_val_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*val_list))
-    with open(f"data/{dataset}/ablations/{dataset}_val_vertex_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*vertex_val_list))
-    with open(f"data/{dataset}/ablations/{dataset}_val_hg_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*hg_val_list))
-    with jsonlines.open(f"data/{dataset}/ablations/{dataset}_val_azure_{ablations[0]}.jsonl", "w") as writer:
-        writer.write_all(azure_val_list)
-    with open(f"data/{dataset}/ablations/{dataset}_val_aws_{ablations[0]}.csv", "w") as f:
-        a = csv.writer(f, delimiter=",")
-        a.writerows(zip(*aws_val_list))
-
-    # copy all the files listed in the training list to a new hg_training folder
-    # create hg_training folder if it doesn't exist
-    if not os.path.exists(f"data/{dataset}/training_uploads"):
-        os.makedirs(f"data/{dataset}/training_uploads")
-
-    for file_name, file_class in zip(train_list[0], train_list[1]):
-        shutil.copyfile(
-            f"data/{dataset}/train/{file_class}/{file_name}", f"data/{dataset}/training_uploads/{file_name}"
-        )
-    if not os.path.exists(f"data/{dataset}/val_uploads"):
-        os.makedirs(f"data/{dataset}/val_uploads")
-    for file_name, file_class in zip(val_list[0], val_list[1]):
-        shutil.copyfile(f"data/{dataset}/train/{file_class}/{file_name}", f"data/{dataset}/val_uploads/{file_name}")
-
-    for ablation in ablations[1:]:
-        temp_train_list = [[], []]
-        vertex_list = [[], []]
-        hg_train_list = [["file"], ["label"]]
-        nyckel_train_list = [[], []]
-        azure_train_list = []
-        aws_train_list = [[], []]
-
-        for cls in classes:
-            ablation_count = 0
-            for file_name, file_class in zip(train_list[0], train_list[1]):
-                if file_class == cls and ablation_count < int(ablation * 0.8):
-                    temp_train_list[0].append(file_name)
-                    temp_train_list[1].append(cls)
-                    ablation_count += 1
-        train_list = temp_train_list
-        for file_name, file_class in zip(train_list[0], train_list[1]):
-            vertex_list[0].append(f"{google_bucket_name}/training_uploads/{file_name}")
-            vertex_list[1].append(file_class)
-        hg_train_list[0].extend(train_list[0])
-        hg_train_list[1].extend(train_list[1])
-        nyckel_train_list[0].extend(train_list[0])
-        nyckel_train_list[1].extend(train_list[1])
-        for file_name, file_class in zip(train_list[0], train_list[1]):
-            azure_train_list.append({"image_url": azure_training_uploads + file_name, "label": file_class})
-
-        aws_train_list[0].extend(train_list[0])
-        aws_train_list[1].extend(train_list[1])
-
-        with open(f"data/{dataset}/ablations/{dataset}_train_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*train_list))
-        with open(f"data/{dataset}/ablations/{dataset}_train_vertex_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*vertex_list))
-        with open(f"data/{dataset}/ablations/{dataset}_train_hg_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*hg_train_list))
-        with jsonlines.open(f"data/{dataset}/ablations/{dataset}_train_azure_{ablation}.jsonl", "w") as writer:
-            writer.write_all(azure_train_list)
-        with open(f"data/{dataset}/ablations/{dataset}_train_aws_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*aws_train_list))
-
-        temp_val_list = [[], []]
-        vertex_list = [[], []]
-        hg_val_list = [["file"], ["label"]]
-        azure_val_list = []
-        aws_val_list = [[], []]
-        for cls in classes:
-            ablation_count = 0
-            for file_name, file_class in zip(val_list[0], val_list[1]):
-                if file_class == cls and ablation_count < ablation * 0.2:
-                    temp_val_list[0].append(file_name)
-                    temp_val_list[1].append(cls)
-                    ablation_count += 1
-        val_list = temp_val_list
-        for file_name, file_class in zip(val_list[0], val_list[1]):
-            vertex_list[0].append(f"{google_bucket_name}/val_uploads/{file_name}")
-            vertex_list[1].append(file_class)
-        hg_val_list[0].extend(val_list[0])
-        hg_val_list[1].extend(val_list[1])
-        nyckel_train_list[0].extend(val_list[0])
-        nyckel_train_list[1].extend(val_list[1])
-        for file_name, file_class in zip(val_list[0], val_list[1]):
-            azure_val_list.append({"image_url": azure_val_uploads + file_name, "label": file_class})
-
-        aws_val_list[0].extend(val_list[0])
-        aws_val_list[1].extend(val_list[1])
-
-        with open(f"data/{dataset}/ablations/{dataset}_val_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*val_list))
-        with open(f"data/{dataset}/ablations/{dataset}_val_vertex_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*vertex_list))
-        with open(f"data/{dataset}/ablations/{dataset}_val_hg_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*hg_val_list))
-        with open(f"data/{dataset}/ablations/{dataset}_train_nyckel_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*nyckel_train_list))
-        with jsonlines.open(f"data/{dataset}/ablations/{dataset}_val_azure_{ablation}.jsonl", "w") as writer:
-            writer.write_all(azure_val_list)
-        with open(f"data/{dataset}/ablations/{dataset}_val_aws_{ablation}.csv", "w") as f:
-            a = csv.writer(f, delimiter=",")
-            a.writerows(zip(*aws_val_list))
+def read_training_list(dataset):
+    """{class: [file, ...]} in {dataset}_train.csv order, from a single pass over the file."""
+    by_class = {}
+    with open(f"data/{dataset}/{dataset}_train.csv") as csvfile:
+        for row in csv.reader(csvfile):
+            by_class.setdefault(row[1], []).append(row[0])
+    return by_class
+
+
+def create_ablation_files(dataset, classes, ablations, by_class=None):
+    """Writes the manifest of every ablation (ablation_manifest.py). The first ablations[0] images of each class (in
+    {dataset}_train.csv order) are split once into 80% train and 20% val; a smaller ablation takes the first
+    int(0.8 * ablation) train and ceil(0.2 * ablation) val images of every class, so ablations are nested and one
+    manifest row per image of the largest ablation describes all of them."""
+    if by_class is None:
+        by_class = read_training_list(dataset)
+    write_manifest(dataset, classes, ablations, by_class)
+
+    # link all the files of the largest ablation into the upload folders, from the image store if it was built
+    manifest = read_manifest(dataset)
+    pairs = [
+        (image_source(dataset, "train", cls, file_name), f"data/{dataset}/training_uploads/{file_name}")
+        for file_name, cls in ablation_rows(dataset, ablations[0], "train", manifest)
+    ]
+    pairs += [
+        (image_source(dataset, "train", cls, file_name), f"data/{dataset}/val_uploads/{file_name}")
+        for file_name, cls in ablation_rows(dataset, ablations[0], "val", manifest)
+    ]
+    materialize_all(pairs)
 
 
 def create_ablations_main(dataset: str):
-    ablations = get_ablations(dataset)
     classes = create_main_training_list(dataset)
-    google_bucket_name, azure_training_uploads, azure_val_uploads = get_bucket_uris(dataset)
-    create_ablation_files(dataset, classes, ablations, google_bucket_name, azure_training_uploads, azure_val_uploads)
+    # The training list has every image of every class, so the class sizes come from it instead of another listdir
+    by_class = read_training_list(dataset)
+    ablations = get_ablations(dataset, {cls: len(by_class.get(cls, [])) for cls in classes})
+    create_ablation_files(dataset, classes, ablations, by_class)
     return ablations
 
 
@@ -1,31 +1,20 @@
-import csv
-import os
-import shutil
 import sys
 
+from ablation_manifest import ablation_rows, read_manifest
 from create_ablations import get_ablations
+from image_store import image_source
+from materialize import materialize_all
 
 
 def create_folders(dataset, ablations):
+    pairs = []
+    manifest = read_manifest(dataset)
     for ablation in ablations:
-        if not os.path.exists(f"data/{dataset}/train_uploads_{ablation}"):
-            os.makedirs(f"data/{dataset}/train_uploads_{ablation}")
-        with open(f"data/{dataset}/ablations/{dataset}_train_hg_{ablation}.csv") as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row[1] != "label":
-                    shutil.copyfile(
-                        f"data/{dataset}/train/{row[1]}/{row[0]}", f"data/{dataset}/train_uploads_{ablation}/{row[0]}"
-                    )
-        if not os.path.exists(f"data/{dataset}/val_uploads_{ablation}"):
-            os.makedirs(f"data/{dataset}/val_uploads_{ablation}")
-        with open(f"data/{dataset}/ablations/{dataset}_val_hg_{ablation}.csv") as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row[1] != "label":
-                    shutil.copyfile(
-                        f"data/{dataset}/train/{row[1]}/{row[0]}", f"data/{dataset}/val_uploads_{ablation}/{row[0]}"
-                    )
+        for split, folder in [("train", "train_uploads"), ("val", "val_uploads")]:
+            for filename, label in ablation_rows(dataset, ablation, split, manifest):
+                source = image_source(dataset, "train", label, filename)
+                pairs.append((source, f"data/{dataset}/{folder}_{ablation}/{filename}"))
+    materialize_all(pairs)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 import csv
 import os
-import shutil
 import sys
 
 from create_ablations import get_bucket_uris
+from image_store import image_source
+from materialize import materialize_all
 
 testing_list = []
 
@@ -20,10 +21,12 @@ def create_test_list(dataset, google_bucket_name, azure_test_uploads):
             test_list[0].append(file)
             test_list[1].append(cls)
 
-    if not os.path.exists(f"data/{dataset}/test_uploads"):
-        os.makedirs(f"data/{dataset}/test_uploads")
-    for file_name, file_class in zip(test_list[0], test_list[1]):
-        shutil.copyfile(f"data/{dataset}/test/{file_class}/{file_name}", f"data/{dataset}/test_uploads/{file_name}")
+    materialize_all(
+        [
+            (image_source(dataset, "test", file_class, file_name), f"data/{dataset}/test_uploads/{file_name}")
+            for file_name, file_class in zip(test_list[0], test_list[1])
+        ]
+    )
 
     vertex_list = [[], []]
     for file_name, file_class in zip(test_list[0], test_list[1]):
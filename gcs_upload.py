@@ -0,0 +1,87 @@
+"""Bulk upload of local files to a Google Cloud Storage bucket.
+
+The objects under each destination prefix are listed once, up front, into a {name: (size, md5)} map. A file is only
+uploaded if its object is missing or differs: the size is compared first and the MD5 (which GCS stores base64
+encoded) only computed when the sizes match. Uploads and hashing run on a bounded thread pool sharing one client, and
+no request is spent on get_bucket or per-object existence checks.
+
+Works with any object that has the google.cloud.storage.Client methods list_blobs and bucket, so it can be run
+against a fake client or a local emulator (STORAGE_EMULATOR_HOST).
+"""
+
+import base64
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+def local_md5(path, chunk_size=1 << 20):
+    """Base64 encoded MD5 of a file, the format of Blob.md5_hash."""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode("utf-8")
+
+
+def list_existing(storage_client, bucket_name, prefixes):
+    """{blob_name: (size, md5_hash)} of every object under the given prefixes, one listing per prefix."""
+    existing = {}
+    for prefix in prefixes:
+        for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+            existing[blob.name] = (blob.size, blob.md5_hash)
+    return existing
+
+
+def folder_files(local_dir, prefix):
+    """[(local_path, blob_name)] for every file in local_dir, uploaded as {prefix}/{file}."""
+    return [(f"{local_dir}/{file}", f"{prefix}/{file}") for file in sorted(os.listdir(local_dir))]
+
+
+def is_uploaded(path, blob_name, existing, md5_of=None):
+    if blob_name not in existing:
+        return False
+    size, md5_hash = existing[blob_name]
+    # Composite objects have no MD5; upload those again rather than trust the size alone
+    if size != os.path.getsize(path) or md5_hash is None:
+        return False
+    known = md5_of(path) if md5_of is not None else None
+    if known is not None:
+        return md5_hash == base64.b64encode(bytes.fromhex(known)).decode("utf-8")
+    return md5_hash == local_md5(path)
+
+
+def bulk_upload(storage_client, bucket_name, files, workers=8, md5_of=None):
+    """Uploads [(local_path, blob_name)] that are missing or changed in the bucket, `workers` at a time. md5_of
+    optionally maps a local path to its known MD5 hex digest (image_store.md5_lookup), saving the read to hash it.
+    Returns (uploaded, skipped, bytes_uploaded, seconds)."""
+    prefixes = sorted({blob_name.rsplit("/", 1)[0] + "/" if "/" in blob_name else "" for _, blob_name in files})
+    existing = list_existing(storage_client, bucket_name, prefixes)
+    # bucket() builds the reference locally, unlike get_bucket which fetches the bucket's metadata
+    bucket = storage_client.bucket(bucket_name)
+    progress = tqdm(total=len(files))
+
+    def _upload(path, blob_name):
+        if is_uploaded(path, blob_name, existing, md5_of):
+            progress.update(1)
+            return None
+        bucket.blob(blob_name).upload_from_filename(path)
+        progress.update(1)
+        return os.path.getsize(path)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(lambda file: _upload(*file), files))
+    duration = time.perf_counter() - start
+    progress.close()
+
+    uploaded = sum(1 for size in sizes if size is not None)
+    total_bytes = sum(size for size in sizes if size is not None)
+    print(
+        f"Uploaded {uploaded} files ({total_bytes / 1e6:.1f} MB) to gs://{bucket_name} in {duration:.1f}s, "
+        f"{total_bytes / 1e6 / max(duration, 1e-9):.2f} MB/s, {len(files) - uploaded} already up to date"
+    )
+    return uploaded, len(files) - uploaded, total_bytes, duration
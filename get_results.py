@@ -3,7 +3,11 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
-from scipy.stats import sem
+import pandas as pd
+
+from bootstrap import bootstrap_combined_accuracy
+from latency_sketch import SUMMARY_QUANTILES, LatencySketch, box_stats, load_sketches
+from results_store import STORE_ROOT, import_if_stale, load_results, parse_results_filename
 
 DATASETS = ["beans", "cars", "food", "intel", "pets", "clothing", "xrays"]
 SERVICES = ["nyckel", "huggingface", "aws", "vertex"]
@@ -55,86 +59,112 @@ colors = list(color_by_service.values())
 services = list(color_by_service.keys())
 
 
+LABEL_BY_SERVICE = {"nyckel": "Nyckel", "huggingface": "Huggingface", "aws": "AWS", "vertex": "Vertex"}
+# Results files are named after the adapter, which is shorter than the service name for Hugging Face
+FILE_NAME_BY_SERVICE = {"huggingface": "hg"}
+
+
+def index_results(datasets=DATASETS, data_dir="data"):
+    """Maps (dataset, service, ablation) to its results file with a single listdir per dataset. File names are matched
+    exactly, so ablation 20 never picks up a -320 file."""
+    service_by_file_name = {FILE_NAME_BY_SERVICE.get(service, service): service for service in SERVICES}
+    index = {}
+    for dataset in datasets:
+        results_dir = f"{data_dir}/{dataset}/results"
+        if not os.path.isdir(results_dir):
+            continue
+        for file in os.listdir(results_dir):
+            key = parse_results_filename(file)
+            if key is None or key[0] != dataset or key[1] not in service_by_file_name:
+                continue
+            index[(dataset, service_by_file_name[key[1]], key[2])] = f"{results_dir}/{file}"
+    return index
+
+
+def load_indexed_results(index, root=STORE_ROOT):
+    """Reads the indexed results from the Parquet store (results_store.py) in one scan, importing the results files
+    whose partition is missing or older than the file first. Returns the index keys and, per successful request, the
+    position of its key (group), whether the prediction was correct and the latency in seconds, as flat NumPy
+    arrays."""
+    keys = sorted(index)
+    if not keys:
+        return keys, np.zeros(0, dtype=int), np.zeros(0, dtype=bool), np.zeros(0)
+    for key in keys:
+        import_if_stale(index[key], root)
+    file_keys = [(dataset, FILE_NAME_BY_SERVICE.get(service, service), ablation) for dataset, service, ablation in keys]
+    frame = load_results(
+        root,
+        datasets={key[0] for key in file_keys},
+        services={key[1] for key in file_keys},
+        ablations={key[2] for key in file_keys},
+        columns=["dataset", "service", "ablation", "truth", "prediction", "latency_ns", "status"],
+    ).to_pandas()
+    # The filters above also match partitions of combinations that are not in the index
+    group_by_key = pd.Series(range(len(keys)), index=pd.MultiIndex.from_tuples(file_keys))
+    groups = group_by_key.reindex(pd.MultiIndex.from_frame(frame[["dataset", "service", "ablation"]])).to_numpy()
+    keep = ~np.isnan(groups) & (frame["status"] == "ok").to_numpy()
+    frame = frame[keep]
+    correct = (frame["truth"] == frame["prediction"]).to_numpy()
+    return keys, groups[keep].astype(int), correct, frame["latency_ns"].to_numpy(dtype=float) / 1e9
+
+
+def group_metrics(keys, groups, correct, latencies):
+    """Per key: number of rows, accuracy and mean latency, each computed for all groups at once."""
+    counts = np.bincount(groups, minlength=len(keys))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        accuracy = np.bincount(groups, weights=correct, minlength=len(keys)) / counts
+        latency = np.bincount(groups, weights=latencies, minlength=len(keys)) / counts
+    return counts, accuracy, latency
+
+
+_results = None
+
+
+def get_results():
+    """The results of every dataset, loaded on first use and shared by all the reports below."""
+    global _results
+    if _results is None:
+        _results = load_indexed_results(index_results())
+    return _results
+
+
 def get_accuracies():
-    accuracies = []
-    for dataset in DATASETS:
-        if os.path.exists(f"data/{dataset}/results"):
-            for file in os.listdir(f"data/{dataset}/results"):
-                if file != ".DS_Store":
-                    with open(f"data/{dataset}/results/{file}") as csvfile:
-                        accuracy = 0
-                        total = 0
-                        reader = csv.reader(csvfile)
-                        for row in reader:
-                            if str(row[1]) == str(row[2]):
-                                accuracy += 1
-                            total += 1
-                        accuracies.append(accuracy / total)
-                        print(f"Accuracy for {file}: {accuracy/total}")
+    keys, groups, correct, latencies = get_results()
+    _, accuracy, _ = group_metrics(keys, groups, correct, latencies)
+    for (dataset, service, ablation), value in zip(keys, accuracy):
+        print(f"Accuracy for {dataset} {service} {ablation}: {value}")
+    return accuracy
 
 
 def get_combined_accuracies():
-    combined_accuracies = np.zeros((len(SERVICES), len(ABLATIONS)))
-    combined_errors = np.zeros((len(SERVICES), len(ABLATIONS)))
+    keys, groups, correct, latencies = get_results()
+    counts = np.bincount(groups, minlength=len(keys))
+    n_correct = np.bincount(groups, weights=correct, minlength=len(keys))
 
-    for service_count, service in enumerate(SERVICES):
-        for ablation_count, ablation in enumerate(ABLATIONS):
-            ablation_means = np.zeros(len(DATASETS))
-            for dataset_count, dataset in enumerate(DATASETS):
-                if os.path.exists(f"data/{dataset}/results"):
-                    for file in os.listdir(f"data/{dataset}/results"):
-                        if file != ".DS_Store":
-                            if service in file and str(ablation) in file:
-                                with open(f"data/{dataset}/results/{file}") as csvfile:
-                                    accuracy = 0
-                                    total = 0
-                                    reader = csv.reader(csvfile)
-                                    for row in reader:
-                                        if str(row[1]) == str(row[2]):
-                                            accuracy += 1
-                                        total += 1
-                                if total != 0:
-                                    print(f"Accuracy for {file}: {accuracy/total}")
-                                    ablation_means[dataset_count] = accuracy / total
-            # print(ablation_means)
-            ablation_means[ablation_means == 0] = np.nan
-            # print(ablation_means)
-            # print(np.nanmean(ablation_means))
-            combined_accuracies[service_count, ablation_count] = np.nanmean(ablation_means)
-            combined_errors[service_count, ablation_count] = sem(ablation_means, nan_policy="omit")
+    # service x ablation x dataset, 0 where there is no results file
+    counts_by_dataset = np.zeros((len(SERVICES), len(ABLATIONS), len(DATASETS)), dtype=int)
+    correct_by_dataset = np.zeros(counts_by_dataset.shape)
+    for (dataset, service, ablation), count, n in zip(keys, counts, n_correct):
+        if ablation in ABLATIONS:
+            cell = SERVICES.index(service), ABLATIONS.index(ablation), DATASETS.index(dataset)
+            counts_by_dataset[cell] = count
+            correct_by_dataset[cell] = n
+    # Mean accuracy over datasets with a 95% bootstrap interval that resamples the individual predictions
+    combined_accuracies, low, high = bootstrap_combined_accuracy(correct_by_dataset, counts_by_dataset)
+    combined_errors = np.stack([combined_accuracies - low, high - combined_accuracies], axis=1)
 
     _, ax = plt.subplots()
     ax.set_xscale("log")
-    ax.errorbar(
-        ABLATIONS,
-        combined_accuracies[0],
-        yerr=combined_errors[0],
-        fmt="o",
-        label="Vertex",
-        linestyle="dotted",
-        capsize=6,
-    )
-    ax.errorbar(
-        ABLATIONS, combined_accuracies[1], yerr=combined_errors[1], fmt="o", label="AWS", linestyle="dotted", capsize=6
-    )
-    ax.errorbar(
-        ABLATIONS,
-        combined_accuracies[2],
-        yerr=combined_errors[2],
-        fmt="o",
-        label="Huggingface",
-        linestyle="dotted",
-        capsize=6,
-    )
-    ax.errorbar(
-        ABLATIONS,
-        combined_accuracies[3],
-        yerr=combined_errors[3],
-        fmt="o",
-        label="Nyckel",
-        linestyle="dotted",
-        capsize=6,
-    )
+    for service_count, service in enumerate(SERVICES):
+        ax.errorbar(
+            ABLATIONS,
+            combined_accuracies[service_count],
+            yerr=combined_errors[service_count],
+            fmt="o",
+            label=LABEL_BY_SERVICE[service],
+            linestyle="dotted",
+            capsize=6,
+        )
 
     # Show the legend
     ax.legend()
@@ -144,54 +174,46 @@ def get_combined_accuracies():
 
 
 def get_latencies():
-    for latency_count, service in enumerate(SERVICES):
-        latencies = []
-        for dataset in DATASETS:
-            if os.path.exists(f"data/{dataset}/results"):
-                for file in os.listdir(f"data/{dataset}/results"):
-                    if service == "huggingface":
-                        service = "hg"
-                    if service in file:
-                        with open(f"data/{dataset}/results/{file}") as csvfile:
-                            reader = csv.reader(csvfile)
-                            latencies = []
-
-                            for row in reader:
-                                if service in ["aws", "vertex"]:
-                                    latencies.append(float(row[4]))
-                                else:
-                                    latencies.append(float(row[4][-8:-1]))
-                        print(f"Latency for {file}: {sum(latencies)/len(latencies)}")
+    keys, groups, correct, latencies = get_results()
+    _, _, latency = group_metrics(keys, groups, correct, latencies)
+    for (dataset, service, ablation), value in zip(keys, latency):
+        print(f"Latency for {dataset} {service} {ablation}: {value}")
+    return latency
+
+
+def get_latency_sketches():
+    """One merged LatencySketch per service. Uses the sketches stored by the runners and only falls back to the raw
+    latencies for results that have none (or an outdated one)."""
+    keys, groups, correct, latencies = get_results()
+    counts = np.bincount(groups, minlength=len(keys))
+    stored = load_sketches()
+    sketches = {service: LatencySketch() for service in SERVICES}
+    for group, (dataset, service, ablation) in enumerate(keys):
+        sketch = stored.get((dataset, FILE_NAME_BY_SERVICE.get(service, service), ablation))
+        if sketch is None or sketch.count != counts[group]:
+            sketch = LatencySketch()
+            sketch.add_many(latencies[groups == group])
+        sketches[service].merge(sketch)
+    return sketches
 
 
 def get_combined_latencies():
-    all_latencies = [[], [], [], []]
-    for latency_count, service in enumerate(SERVICES):
-        latencies = []
-        for dataset in DATASETS:
-            if os.path.exists(f"data/{dataset}/results"):
-                for file in os.listdir(f"data/{dataset}/results"):
-                    if service == "huggingface":
-                        service = "hg"
-                    if service in file:
-                        with open(f"data/{dataset}/results/{file}") as csvfile:
-                            reader = csv.reader(csvfile)
-                            for row in reader:
-                                if service in ["aws", "vertex"]:
-                                    latencies.append(float(row[4]))
-                                else:
-                                    latencies.append(float(row[4][-8:-1]))
-        print(f"Latency for {service}: {sum(latencies)/len(latencies)}")
-        all_latencies[latency_count].extend(latencies)
+    sketches = get_latency_sketches()
+    for service, sketch in sketches.items():
+        if sketch.count:
+            quantiles = ", ".join(
+                f"p{100 * q:g} {value}" for q, value in zip(SUMMARY_QUANTILES, sketch.quantiles(SUMMARY_QUANTILES))
+            )
+            print(f"Latency for {service}: mean {sketch.mean()}, {quantiles}")
     # create boxplots for each without outliers
     _, (ax1, ax2) = plt.subplots(1, 2)
-    bplot = ax1.boxplot(all_latencies, showfliers=False, patch_artist=True)
-    ax1.set_xticklabels(SERVICES)
+    boxes = [box_stats(sketch, service) for service, sketch in sketches.items() if sketch.count]
+    bplot = ax1.bxp(boxes, showfliers=False, patch_artist=True)
     ax1.set_title("Latency per invoke")
     ax1.set_ylabel("Time (s)")
     ax1.set_xlabel("Dataset")
-    for patch, color in zip(bplot["boxes"], colors):
-        patch.set_facecolor(color)
+    for patch, box in zip(bplot["boxes"], boxes):
+        patch.set_facecolor(color_by_service[box["label"]])
     for median in bplot["medians"]:
         median.set_color("black")
 
@@ -0,0 +1,108 @@
+"""Shared HTTP sessions for the services that are called over plain HTTP (Nyckel, Hugging Face, Azure ML).
+
+A single session per adapter keeps connections alive between requests, so only the first request on each
+connection pays for the TCP and TLS handshake. The connection pool is sized to the number of requests in flight.
+Each request also records whether it went out on a reused connection, so handshakes can be told apart from service
+latency in the results.
+
+Requests are made in streaming mode so the arrival of the response headers can be timestamped
+(time.perf_counter_ns) before the body is read; runner.py records it as the request's first-byte time.
+
+HTTP/2 is optional: HttpSession(http2=True), or USE_HTTP2=1 in the environment, uses httpx instead of requests
+(pip install "httpx[http2]"). Connection reuse is not tracked for HTTP/2, where all requests share one connection.
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Failures without an HTTP response (connection refused or reset, timeout). The adapters report them as a ServiceError
+# without a status code, which retry.py retries like a 503.
+TRANSPORT_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+_last_request = threading.local()
+
+
+class _ReuseTrackingMixin:
+    def _make_request(self, conn, *args, **kwargs):
+        # New connections are only connected inside _make_request, so an open socket here means keep-alive reuse
+        _last_request.reused = getattr(conn, "sock", None) is not None
+        return super()._make_request(conn, *args, **kwargs)
+
+
+class _ReuseTrackingHTTPConnectionPool(_ReuseTrackingMixin, HTTPConnectionPool):
+    pass
+
+
+class _ReuseTrackingHTTPSConnectionPool(_ReuseTrackingMixin, HTTPSConnectionPool):
+    pass
+
+
+class _ReuseTrackingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _ReuseTrackingHTTPConnectionPool,
+            "https": _ReuseTrackingHTTPSConnectionPool,
+        }
+
+
+class HttpSession:
+    def __init__(self, pool_size=10, http2=None):
+        if http2 is None:
+            http2 = os.getenv("USE_HTTP2") == "1"
+        self.http2 = http2
+        if http2:
+            import httpx
+
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            self._client = httpx.Client(http2=True, limits=limits, timeout=None)
+            self.transport_errors = TRANSPORT_ERRORS + (httpx.TransportError,)
+        else:
+            self.transport_errors = TRANSPORT_ERRORS
+            self._client = requests.Session()
+            adapter = _ReuseTrackingAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+
+    def post(self, url, headers=None, data=None, files=None, json=None):
+        return self._request("POST", url, headers=headers, data=data, files=files, json=json)
+
+    def get(self, url, headers=None):
+        return self._request("GET", url, headers=headers)
+
+    def _request(self, method, url, headers=None, data=None, files=None, json=None):
+        _last_request.reused = None
+        _last_request.first_byte_ns = None
+        if self.http2:
+            # httpx takes raw bodies as content= and form fields as data=, and would iterate a memoryview
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            if isinstance(data, (bytes, bytearray, str)):
+                request = self._client.build_request(method, url, headers=headers, content=data, files=files, json=json)
+            else:
+                request = self._client.build_request(method, url, headers=headers, data=data, files=files, json=json)
+            response = self._client.send(request, stream=True)
+            _last_request.first_byte_ns = time.perf_counter_ns()
+            response.read()
+            return response
+        response = self._client.request(method, url, headers=headers, data=data, files=files, json=json, stream=True)
+        _last_request.first_byte_ns = time.perf_counter_ns()
+        # Reading the body also hands the connection back to the pool
+        response.content
+        return response
+
+    def connection_reused(self):
+        """Whether the last request made on the calling thread reused a kept-alive connection (None if unknown)."""
+        return getattr(_last_request, "reused", None)
+
+    def first_byte_ns(self):
+        """perf_counter_ns when the response headers of the last request on the calling thread arrived."""
+        return getattr(_last_request, "first_byte_ns", None)
+
+    def close(self):
+        self._client.close()
@@ -0,0 +1,171 @@
+"""Content-addressed image store shared by every split, dataset and upload folder.
+
+Every image of data/{dataset}/{train,test}/{label}/ is stored once under the SHA-256 of its bytes,
+
+    data/image_store/{sha256[:2]}/{sha256}
+
+and data/{dataset}/image_index.csv maps [split, label, filename] to [sha256, md5, size, mtime_ns]. The first image
+with some bytes becomes their object as a hardlink, so the store is the only real copy and costs no extra disk
+space; every other image with the same bytes (the same photo in two classes or splits, or in two datasets) is
+replaced by a hardlink to that object. Images keep their permissions, but they share an inode with their object,
+so an image should be replaced (written to a new file and renamed over) rather than edited in place. Only when the
+store is on another filesystem than the dataset are objects copied and images left as they are.
+
+The upload folders built by create_folders.py, create_ablations.py and create_tests.py are then views onto the store
+(image_source), and the GCS and S3 uploaders take the MD5 from the index (md5_lookup) instead of reading the file
+again to decide whether an object is already in the bucket.
+
+    python image_store.py build <dataset>
+
+hashes new or modified images only (unchanged size and mtime reuse the index) on a thread pool.
+"""
+
+import csv
+import hashlib
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from materialize import materialize
+
+STORE_ROOT = "data/image_store"
+SPLITS = ["train", "test"]
+
+
+def object_path(digest, root=STORE_ROOT):
+    return f"{root}/{digest[:2]}/{digest}"
+
+
+def index_file(dataset):
+    return f"data/{dataset}/image_index.csv"
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """(sha256, md5) hex digests of a file, computed in one read."""
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def read_index(dataset):
+    """{(split, label, filename): (sha256, md5, size, mtime_ns)}, empty if the store was never built."""
+    index = {}
+    if os.path.exists(index_file(dataset)):
+        with open(index_file(dataset), newline="") as f:
+            for split, label, filename, sha256, md5, size, mtime_ns in csv.reader(f):
+                index[(split, label, filename)] = (sha256, md5, int(size), int(mtime_ns))
+    return index
+
+
+def build_store(dataset, splits=SPLITS, workers=16, root=STORE_ROOT):
+    """Adds every image of the dataset's splits to the store and rewrites the dataset's index."""
+    previous = read_index(dataset)
+    images = []
+    for split in splits:
+        for label in sorted(os.listdir(f"data/{dataset}/{split}")):
+            if os.path.isdir(f"data/{dataset}/{split}/{label}"):
+                images += [(split, label, file) for file in sorted(os.listdir(f"data/{dataset}/{split}/{label}"))]
+
+    # Objects are shared between datasets, so two threads may race to add the same bytes; one lock per digest
+    locks = {}
+    locks_lock = threading.Lock()
+    stats = {"hashed": 0, "added": 0, "linked": 0}
+    unsupported = set()
+
+    def _add(key):
+        path = f"data/{dataset}/{key[0]}/{key[1]}/{key[2]}"
+        stat = os.stat(path)
+        entry = previous.get(key)
+        if (
+            entry is not None
+            and entry[2:] == (stat.st_size, stat.st_mtime_ns)
+            and os.path.exists(object_path(entry[0], root))
+        ):
+            sha256, md5 = entry[:2]
+        else:
+            sha256, md5 = hash_file(path)
+            with locks_lock:
+                stats["hashed"] += 1
+        with locks_lock:
+            lock = locks.setdefault(sha256, threading.Lock())
+        with lock:
+            target = object_path(sha256, root)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                materialize(path, target, modes=["hardlink", "copy"], unsupported=unsupported)
+                stats["added"] += 1
+            elif "hardlink" not in unsupported:
+                try:
+                    if materialize(target, path, modes=["hardlink"], unsupported=unsupported) is not None:
+                        stats["linked"] += 1
+                except OSError:
+                    # The store is on another filesystem, so this image keeps its own copy
+                    pass
+        # A relinked image takes the size and mtime of its object
+        stat = os.stat(path)
+        return sha256, md5, stat.st_size, stat.st_mtime_ns
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(_add, images))
+
+    with open(f"{index_file(dataset)}.tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        for key, entry in zip(images, entries):
+            writer.writerow([*key, *entry])
+    os.replace(f"{index_file(dataset)}.tmp", index_file(dataset))
+    print(
+        f"{len(images)} images of {dataset} in the store ({len(set(entry[0] for entry in entries))} unique): "
+        f"{stats['hashed']} hashed, {stats['added']} added, {stats['linked']} relinked to an existing object"
+    )
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _get_index(dataset):
+    with _indexes_lock:
+        if dataset not in _indexes:
+            _indexes[dataset] = read_index(dataset)
+        return _indexes[dataset]
+
+
+def image_source(dataset, split, label, filename, root=STORE_ROOT):
+    """Where to link an image from: its store object if the dataset has been added to the store, the file in
+    data/{dataset}/{split}/{label}/ otherwise."""
+    entry = _get_index(dataset).get((split, label, filename))
+    if entry is not None:
+        return object_path(entry[0], root)
+    return f"data/{dataset}/{split}/{label}/{filename}"
+
+
+def md5_lookup(dataset, root=STORE_ROOT):
+    """A function from a local path to its MD5 hex digest from the index, or None if the file is not known to be
+    unchanged. Paths are matched by name under data/{dataset}/{split}/{label}/ and, for files in the upload folders,
+    by inode, which they share with their object when they were hardlinked or symlinked from the store."""
+    by_path = {}
+    by_inode = {}
+    for (split, label, filename), (sha256, md5, size, mtime_ns) in read_index(dataset).items():
+        by_path[f"data/{dataset}/{split}/{label}/{filename}"] = (md5, size, mtime_ns)
+        if os.path.exists(object_path(sha256, root)):
+            stat = os.stat(object_path(sha256, root))
+            by_inode[(stat.st_dev, stat.st_ino)] = (md5, stat.st_size, stat.st_mtime_ns)
+
+    def _lookup(path):
+        stat = os.stat(path)
+        entry = by_path.get(path) or by_inode.get((stat.st_dev, stat.st_ino))
+        if entry is None or entry[1:] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return entry[0]
+
+    return _lookup
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "build":
+        build_store(sys.argv[2])
@@ -0,0 +1,189 @@
+"""Mergeable streaming latency sketches.
+
+A LatencySketch counts latencies in logarithmic buckets (the DDSketch layout): bucket i holds values in
+(gamma^(i-1), gamma^i] with gamma = (1 + a) / (1 - a), so every quantile it returns is within a relative error `a`
+(1% by default) of the exact one, tails included. Memory depends only on the range of latencies, about a thousand
+buckets from a microsecond to an hour, not on the number of samples. Two sketches with the same accuracy merge by
+adding bucket counts, so runs from different datasets, ablations or worker processes can be combined afterwards.
+
+runner.py updates a sketch live during every accuracy and parallel run and stores it next to the results as
+data/{dataset}/sketches/{dataset}-{service}-{kind}-{ablation}.json, with kind "results" or "parallel".
+
+    python latency_sketch.py summary [kind]
+
+prints p50/p90/p99/p99.9 per service, merged over all datasets and ablations.
+"""
+
+import glob
+import json
+import math
+import os
+import re
+import sys
+
+import numpy as np
+
+SUMMARY_QUANTILES = [0.5, 0.9, 0.99, 0.999]
+SKETCH_FILE = re.compile(r"^(?P<dataset>[^-]+)-(?P<service>.+)-(?P<kind>results|parallel)-(?P<ablation>\d+)\.json$")
+
+
+class LatencySketch:
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index):
+        # Midpoint (in relative terms) of bucket index, within relative_accuracy of anything in the bucket
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def add(self, value):
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        positive = values[values > 0]
+        indexes, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(int), return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "bins": {str(index): count for index, count in self.bins.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.bins = {int(index): count for index, count in data["bins"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+    def save(self, path):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def box_stats(sketch, label, scale=1.0):
+    """Box for matplotlib's Axes.bxp: quartiles from the sketch, whiskers at 1.5 IQR clipped to the observed range
+    like Axes.boxplot's defaults."""
+    q1, med, q3 = sketch.quantiles([0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    return {
+        "label": label,
+        "whislo": scale * max(sketch.min, q1 - 1.5 * iqr),
+        "q1": scale * q1,
+        "med": scale * med,
+        "q3": scale * q3,
+        "whishi": scale * min(sketch.max, q3 + 1.5 * iqr),
+        "fliers": [],
+    }
+
+
+def sketch_file(dataset, service, ablationSize, kind="results"):
+    return f"data/{dataset}/sketches/{dataset}-{service}-{kind}-{str(ablationSize)}.json"
+
+
+def load_sketches(kind="results", data_dir="data"):
+    """{(dataset, service, ablation): sketch} for every stored sketch of the given kind."""
+    sketches = {}
+    for path in glob.glob(f"{data_dir}/*/sketches/*.json"):
+        match = SKETCH_FILE.match(os.path.basename(path))
+        if match is not None and match["kind"] == kind:
+            sketches[(match["dataset"], match["service"], int(match["ablation"]))] = LatencySketch.load(path)
+    return sketches
+
+
+def merge_by_service(sketches):
+    merged = {}
+    for (_, service, _), sketch in sketches.items():
+        if service not in merged:
+            merged[service] = LatencySketch(sketch.relative_accuracy)
+        merged[service].merge(sketch)
+    return merged
+
+
+def summary(kind="results"):
+    for service, sketch in sorted(merge_by_service(load_sketches(kind)).items()):
+        quantiles = ", ".join(
+            f"p{100 * q:g} {value:.3f}s" for q, value in zip(SUMMARY_QUANTILES, sketch.quantiles(SUMMARY_QUANTILES))
+        )
+        print(f"{service}: {sketch.count} requests, mean {sketch.mean():.3f}s, {quantiles}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "summary":
+        summary(sys.argv[2] if len(sys.argv) > 2 else "results")
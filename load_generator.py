@@ -0,0 +1,125 @@
+"""Open-loop load generator. Unlike parallel_invoke, which keeps a fixed number of requests in flight and so sends
+less when the service slows down, requests here are sent on a fixed schedule (constant or Poisson arrivals at a
+target rate) no matter how long earlier requests take.
+
+Every request records when it was supposed to be sent, when it was actually sent and when the response came back.
+Latency is reported both as service time (sent -> completed) and corrected for coordinated omission
+(intended -> completed), which includes the time a request spent waiting because the client or service was behind.
+"""
+
+import asyncio
+import csv
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from runner import read_test_rows
+from service_adapter import error_status
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def arrival_offsets(rps, duration, arrival="poisson", seed=0):
+    """Send times in seconds from the start of the run for a `duration` second run at `rps` requests per second."""
+    rng = random.Random(seed)
+    offsets = []
+    t = 0.0
+    while True:
+        if arrival == "poisson":
+            t += rng.expovariate(rps)
+        elif arrival == "constant":
+            t += 1 / rps
+        else:
+            raise ValueError(f"Unknown arrival process {arrival}, use poisson or constant")
+        if t >= duration:
+            return offsets
+        offsets.append(t)
+
+
+def _send(adapter, payload, intended):
+    """(intended, sent, completed, status) of one request. A failure is recorded as an error completion instead of
+    stopping the schedule, with service_adapter.error_status as its status."""
+    sent = time.perf_counter()
+    try:
+        adapter.send(payload)
+        status = "ok"
+    except Exception as err:
+        status = error_status(err)
+    return intended, sent, time.perf_counter(), status
+
+
+async def _run_open_loop(adapter, payloads, offsets, max_in_flight):
+    loop = asyncio.get_running_loop()
+    tasks = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        start = time.perf_counter()
+        for i, offset in enumerate(offsets):
+            intended = start + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            payload = payloads[i % len(payloads)]
+            tasks.append(loop.run_in_executor(executor, _send, adapter, payload, intended))
+        samples = await asyncio.gather(*tasks)
+    return [
+        (intended - start, sent - start, completed - start, status) for intended, sent, completed, status in samples
+    ]
+
+
+def summarize(samples, warmup, duration):
+    measured = [sample for sample in samples if sample[0] >= warmup]
+    ok = [sample for sample in measured if sample[3] == "ok"]
+    summary = {
+        "requests": len(measured),
+        "errors": len(measured) - len(ok),
+        "offered_rps": len(measured) / duration,
+        "achieved_rps": len(ok) / duration,
+    }
+    if ok:
+        intended, sent, completed = (np.array(column, dtype=float) for column in list(zip(*ok))[:3])
+        service_latency = completed - sent
+        corrected_latency = completed - intended
+        for p in PERCENTILES:
+            summary[f"service_p{p}"] = np.percentile(service_latency, p)
+            summary[f"corrected_p{p}"] = np.percentile(corrected_latency, p)
+        summary["max_send_lag"] = np.max(sent - intended)
+    return summary
+
+
+def run_open_loop(
+    adapter,
+    ablationSize,
+    rps,
+    duration=60,
+    warmup=10,
+    arrival="poisson",
+    max_in_flight=256,
+    n_payloads=100,
+    seed=0,
+):
+    """Sends requests to the adapter's endpoint at `rps` for `warmup` + `duration` seconds. Requests sent during the
+    warmup are recorded but left out of the summary."""
+    rows = read_test_rows(adapter.test_file(), limit=n_payloads)
+    # Payloads are prepared up front so that reading and encoding images does not delay the send schedule
+    payloads = [adapter.prepare(filename, label) for filename, label in rows]
+    offsets = arrival_offsets(float(rps), warmup + duration, arrival, seed)
+    print(f"Sending {len(offsets)} requests at {rps} rps ({arrival}) for {warmup}s warmup + {duration}s")
+
+    samples = asyncio.run(_run_open_loop(adapter, payloads, offsets, int(max_in_flight)))
+
+    if not os.path.exists(f"data/{adapter.dataset}/load"):
+        os.makedirs(f"data/{adapter.dataset}/load")
+    load_file = f"data/{adapter.dataset}/load/{adapter.dataset}-{adapter.run_name()}-load-{ablationSize}-{rps}rps.csv"
+    with open(load_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["intended_s", "sent_s", "completed_s", "status", "warmup"])
+        for intended, sent, completed, status in samples:
+            writer.writerow([intended, sent, completed, status, intended < warmup])
+
+    summary = summarize(samples, warmup, duration)
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+    return summary
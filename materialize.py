@@ -0,0 +1,98 @@
+"""Puts images into the upload folders (training_uploads, val_uploads, test_uploads, *_uploads_{ablation}) without
+copying their bytes where the filesystem allows it.
+
+Every file is linked to its source in data/{dataset}/train or test with the first mode that works:
+
+- reflink: a copy-on-write clone (FICLONE on Linux: btrfs, XFS, ...), an independent file that shares the blocks
+- hardlink: another name for the same inode
+- symlink: a relative symbolic link to the source
+- copy: a plain copy, always works
+
+A mode that fails once (e.g. reflink on ext4, hardlink across devices) is not tried again for the rest of the batch.
+Set MATERIALIZE_MODES (e.g. "copy" or "hardlink,copy") to restrict the modes. Files are materialized on a thread
+pool, and a destination that already is the source (same inode) is left alone, so re-running a build is cheap.
+"""
+
+import errno
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MODES = ["reflink", "hardlink", "symlink", "copy"]
+# ioctl request number of FICLONE, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "reflink is only implemented for Linux")
+    import fcntl
+
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dst)
+            raise
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.relpath(src, os.path.dirname(dst) or "."), dst)
+
+
+_LINKERS = {"reflink": _reflink, "hardlink": os.link, "symlink": _symlink, "copy": shutil.copyfile}
+
+
+def modes_from_env():
+    modes = os.getenv("MATERIALIZE_MODES")
+    return [mode.strip() for mode in modes.split(",")] if modes else MODES
+
+
+def materialize(src, dst, modes=MODES, unsupported=None):
+    """Makes dst a reflink/hardlink/symlink/copy of src, in that order of preference. Returns the mode used, or None
+    if dst already was src. Modes that fail are added to `unsupported` and skipped from then on."""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return None
+    unsupported = set() if unsupported is None else unsupported
+    # Link under a temporary name and rename over dst, so an existing dst is replaced in one step
+    tmp = f"{dst}.{threading.get_ident()}.tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    for mode in modes:
+        if mode in unsupported and mode != "copy":
+            continue
+        try:
+            _LINKERS[mode](src, tmp)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            if mode == "copy":
+                raise
+            unsupported.add(mode)
+            continue
+        os.replace(tmp, dst)
+        return mode
+    raise OSError(f"None of the modes {modes} could materialize {src}")
+
+
+def materialize_all(pairs, workers=16, modes=None):
+    """Materializes every (src, dst) on a thread pool, creating the destination folders. Returns {mode: count}."""
+    modes = modes_from_env() if modes is None else modes
+    # Upload folders are flat, so images with the same name in two classes share a destination; like the sequential
+    # copies this replaces, the last one wins
+    pairs = list({dst: (src, dst) for src, dst in pairs}.values())
+    for folder in {os.path.dirname(dst) for _, dst in pairs}:
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+    unsupported = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        used = list(executor.map(lambda pair: materialize(*pair, modes, unsupported), pairs))
+    counts = {}
+    for mode in used:
+        counts[mode or "unchanged"] = counts.get(mode or "unchanged", 0) + 1
+    if counts:
+        print("Materialized " + ", ".join(f"{count} {mode}" for mode, count in counts.items()))
+    return counts
@@ -0,0 +1,229 @@
+"""Local stand-in for the inference APIs of every service, so the harness can be run, benchmarked and regression-tested
+without credentials or a deployed model.
+
+One server answers in the request/response shapes the adapters expect:
+
+    Nyckel        POST /connect/token, POST /v1/functions/{id}/invoke (plus the label/sample calls used by upload)
+    Hugging Face  POST to any other path with the raw image as body
+    Vertex AI     POST /v1/projects/{project}/locations/{location}/endpoints/{endpoint}:predict (REST transport)
+    Rekognition   POST / with X-Amz-Target: RekognitionService.DetectCustomLabels (JSON 1.1 protocol)
+    Azure ML      POST /score
+
+Point the harness at it with NYCKEL_BASE_URL, VERTEX_API_ENDPOINT and AWS_ENDPOINT_URL set to http://localhost:{port},
+and pass http://localhost:{port}/score or http://localhost:{port}/hf as the Azure scoring uri or Hugging Face endpoint.
+
+Every request goes through the same simulated service: a cold-start delay for the first request after `cold_after`
+idle seconds, a token bucket of `rate_limit` requests per second (429 with Retry-After once it is empty), a fraction
+`error_rate` of 503s and a response time drawn from `latency` ("constant", "uniform", "exponential" or "lognormal"
+around `latency_ms`).
+"""
+
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import fire
+
+LATENCY_DISTRIBUTIONS = ["constant", "uniform", "exponential", "lognormal"]
+
+
+class MockService:
+    def __init__(
+        self,
+        labels=("mock",),
+        latency="constant",
+        latency_ms=50.0,
+        latency_sigma=0.5,
+        rate_limit=None,
+        burst=None,
+        error_rate=0.0,
+        cold_start_ms=0.0,
+        cold_after=300.0,
+        seed=None,
+    ):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {latency}, use one of {LATENCY_DISTRIBUTIONS}")
+        self.labels = list(labels)
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else rate_limit
+        self.error_rate = error_rate
+        self.cold_start_ms = cold_start_ms
+        self.cold_after = cold_after
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._last_request = None
+
+    def _take_token(self, now):
+        """Refills the bucket and takes one token. Returns 0 if the request may go through, otherwise the number of
+        seconds until the next token is available."""
+        if self.rate_limit is None:
+            return 0
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate_limit)
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate_limit
+
+    def _sample_latency(self):
+        mean = self.latency_ms / 1000
+        if self.latency == "constant":
+            return mean
+        if self.latency == "uniform":
+            return self._rng.uniform(0, 2 * mean)
+        if self.latency == "exponential":
+            return self._rng.expovariate(1 / mean) if mean > 0 else 0
+        # lognormal with latency_ms as the median
+        return self._rng.lognormvariate(math.log(mean), self.latency_sigma) if mean > 0 else 0
+
+    def admit(self):
+        """Decides how one request is served: returns (status, delay_seconds, retry_after)."""
+        with self._lock:
+            now = time.monotonic()
+            self.requests += 1
+            wait = self._take_token(now)
+            if wait:
+                self.throttled += 1
+                return 429, 0, max(1, math.ceil(wait))
+            delay = self._sample_latency()
+            if self.cold_start_ms and (self._last_request is None or now - self._last_request > self.cold_after):
+                delay += self.cold_start_ms / 1000
+            self._last_request = now
+            if self._rng.random() < self.error_rate:
+                self.errors += 1
+                return 503, delay, None
+            return 200, delay, None
+
+    def predict(self):
+        """Top-1 label and confidence, plus the full (labels, probabilities) ranking for APIs that return all
+        classes."""
+        with self._lock:
+            weights = [self._rng.random() for _ in self.labels]
+        total = sum(weights)
+        probs = [w / total for w in weights]
+        ranking = sorted(zip(self.labels, probs), key=lambda item: -item[1])
+        return ranking
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive, like the real services
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; with Nagle on, the body waits ~40ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None, content_type="application/json"):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if re.match(r"^/v1/functions/[^/]+/labels", path):
+            return self._send_json(200, [{"id": label, "name": label} for label in self.service.labels])
+        self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        body = self._read_body()
+        path = urlparse(self.path).path
+        target = self.headers.get("X-Amz-Target")
+        amz = target is not None
+        content_type = "application/x-amz-json-1.1" if amz else "application/json"
+
+        # Nyckel management calls are not part of the simulated inference service
+        if path == "/connect/token":
+            return self._send_json(200, {"access_token": "mock-token", "token_type": "Bearer", "expires_in": 3600})
+        if re.match(r"^/v1/functions(/[^/]+/(labels|samples).*)?$", path):
+            return self._send_json(200, {"id": "mock"})
+
+        status, delay, retry_after = self.service.admit()
+        if status == 429:
+            error = (
+                {"__type": "ThrottlingException", "message": "Rate exceeded"} if amz else {"error": "Too many requests"}
+            )
+            return self._send_json(429, error, {"Retry-After": retry_after}, content_type)
+        time.sleep(delay)
+        if status != 200:
+            error = (
+                {"__type": "InternalServerError", "message": "Injected error"} if amz else {"error": "Injected error"}
+            )
+            return self._send_json(status, error, content_type=content_type)
+
+        ranking = self.service.predict()
+        label, confidence = ranking[0]
+        if amz:
+            if target != "RekognitionService.DetectCustomLabels":
+                return self._send_json(400, {"__type": "UnknownOperationException"}, content_type=content_type)
+            return self._send_json(
+                200, {"CustomLabels": [{"Name": label, "Confidence": confidence * 100}]}, content_type=content_type
+            )
+        if path.endswith(":predict"):
+            predictions = []
+            for _ in json.loads(body)["instances"]:
+                instance_ranking = self.service.predict()
+                predictions.append(
+                    {
+                        "ids": [str(self.service.labels.index(name)) for name, _ in instance_ranking],
+                        "displayNames": [name for name, _ in instance_ranking],
+                        "confidences": [prob for _, prob in instance_ranking],
+                    }
+                )
+            return self._send_json(200, {"predictions": predictions, "deployedModelId": "mock"})
+        if re.match(r"^/v1/functions/[^/]+/invoke", path):
+            return self._send_json(200, {"labelName": label, "labelId": label, "confidence": confidence})
+        if path == "/score":
+            return self._send_json(
+                200, [{"probs": [prob for _, prob in ranking], "labels": [name for name, _ in ranking]}]
+            )
+        return self._send_json(200, [{"label": name, "score": prob} for name, prob in ranking])
+
+
+def make_server(port=8080, host="127.0.0.1", **service_options):
+    """Returns a ThreadingHTTPServer for a new MockService. Call serve_forever() on it, on a thread for tests."""
+    handler = type("Handler", (MockHandler,), {"service": MockService(**service_options)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(port=8080, host="127.0.0.1", dataset=None, **service_options):
+    """Runs the mock server until interrupted. With --dataset the predicted labels are the dataset's classes."""
+    if dataset is not None:
+        with open(f"data/{dataset}/classes.txt") as f:
+            service_options["labels"] = f.read().split(",")
+    server = make_server(port, host, **service_options)
+    print(f"Mock inference server on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    service = server.RequestHandlerClass.service
+    print(f"{service.requests} requests, {service.throttled} throttled, {service.errors} injected errors")
+
+
+if __name__ == "__main__":
+    fire.Fire(serve)
@@ -1,32 +1,43 @@
-import csv
 import os
 import sys
-import pandas as pd
-import requests
 from tqdm import tqdm
 from joblib import Parallel, delayed
-import threading
 import time
 
+from ablation_manifest import ablation_rows, read_classes, read_manifest
+from http_session import HttpSession
+from load_generator import run_open_loop
+from packed_store import open_packed
+from retry import parse_retry_after
+from runner import run_invoke, run_parallel
+from throughput_sweep import run_sweep
+from service_adapter import ServiceAdapter, ServiceError
+
+# Set NYCKEL_BASE_URL to run against mock_server.py
+BASE_URL = os.getenv("NYCKEL_BASE_URL", "https://www.nyckel.com")
+
+# Shared by the management calls and the 10 upload threads below
+session = HttpSession(pool_size=10)
+
 
 def get_token():
 
     client_id = os.getenv("NYCKEL_CLIENT_ID")
     client_secret = os.getenv("NYCKEL_CLIENT_SECRET")
 
-    token_url = "https://www.nyckel.com/connect/token"
+    token_url = f"{BASE_URL}/connect/token"
     data = {"client_id": client_id, "client_secret": client_secret, "grant_type": "client_credentials"}
 
-    result = requests.post(token_url, data=data)
+    result = session.post(token_url, data=data)
     return result.json()["access_token"]
 
 
 def create_function(access_token, function_name):
 
-    url = "https://www.nyckel.com/v1/functions"
+    url = f"{BASE_URL}/v1/functions"
     headers = {"Authorization": f"Bearer {access_token}"}
 
-    result = requests.post(
+    result = session.post(
         url, headers=headers, json={"name": function_name, "input": "Image", "output": "Classification"}
     )
 
@@ -35,42 +46,44 @@ def create_function(access_token, function_name):
 
 def create_label(access_token, classes, function_id):
 
-    url = f"https://www.nyckel.com/v1/functions/{function_id}/labels"
+    url = f"{BASE_URL}/v1/functions/{function_id}/labels"
     headers = {"Authorization": f"Bearer {access_token}"}
 
     print("Posting labels ...")
     for cls in tqdm(classes):
-        response = requests.post(url, headers=headers, json={"name": cls})
+        response = session.post(url, headers=headers, json={"name": cls})
         if not response.status_code == 200:
             raise RuntimeError(f"Invalid response {response.text=} {response.status_code=}")
-    url = f"https://www.nyckel.com/v1/functions/{function_id}/labels/?batchSize=200"
-    response = requests.get(url, headers=headers)
+    url = f"{BASE_URL}/v1/functions/{function_id}/labels/?batchSize=200"
+    response = session.get(url, headers=headers)
     print(f"Created {len(response.json())} labels for function: {function_id}")
 
 
 def upload(access_token, function_id, ablationSize, dataset):
-    url = f"https://www.nyckel.com/v1/functions/{function_id}/samples"
+    url = f"{BASE_URL}/v1/functions/{function_id}/samples"
     headers = {"Authorization": f"Bearer {access_token}"}
 
-    def _post_annotated_image(filename: str, label: str):
-        with open(f"data/{dataset}/train/{label}/{filename}", "rb") as f:
-            response = requests.post(url, headers=headers, files={"data": f}, data={"annotation.labelName": label})
-            if not response.status_code == 200:
-                print(f"Invalid response {response.text=} {response.status_code=} {filename=} {label=}")
+    train_store = open_packed(dataset, "train")
 
-    training_file = f"data/{dataset}/ablations/{dataset}_train_nyckel_{ablationSize}.csv"
+    def _post_annotated_image(filename: str, label: str):
+        if train_store is not None and (label, filename) in train_store:
+            image = train_store.get(filename, label)
+        else:
+            with open(f"data/{dataset}/train/{label}/{filename}", "rb") as f:
+                image = f.read()
+        response = session.post(url, headers=headers, files={"data": image}, data={"annotation.labelName": label})
+        if not response.status_code == 200:
+            print(f"Invalid response {response.text=} {response.status_code=} {filename=} {label=}")
 
-    with open(f"data/{dataset}/classes.txt") as f:
-        classes = f.read().split(",")
+    classes = read_classes(dataset)
     create_label(access_token, classes, function_id)
 
-    filenames = []
-    labels = []
-    with open(training_file) as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            filenames.append(row[0])
-            labels.append(row[1])
+    # nyckel takes the train and val images of the ablation in one upload
+    manifest = read_manifest(dataset)
+    rows = ablation_rows(dataset, ablationSize, "train", manifest)
+    rows += ablation_rows(dataset, ablationSize, "val", manifest)
+    filenames = [filename for filename, _ in rows]
+    labels = [label for _, label in rows]
 
     print("Posting samples ...")
     Parallel(n_jobs=10, prefer="threads")(
@@ -78,112 +91,73 @@ def upload(access_token, function_id, ablationSize, dataset):
         for filename, label in tqdm(zip(filenames, labels), total=len(labels))
     )
 
-    url = f"https://www.nyckel.com/v1/functions/{function_id}/invoke"
+    url = f"{BASE_URL}/v1/functions/{function_id}/invoke"
 
     status_code = 0
     with open(f"data/{dataset}/test/NORMAL/IM-0001-0001.jpeg", "rb") as f:
-        start = time.time()
+        start = time.perf_counter_ns()
         while status_code != 200:
-            result = requests.post(url, headers=headers, files={"data": f})
+            result = session.post(url, headers=headers, files={"data": f})
             print(result.json())
             status_code = result.status_code
-    end = time.time()
-    print(f"Latency: {end - start}")
+    end = time.perf_counter_ns()
+    print(f"Latency: {(end - start) / 1e9}")
 
 
-def invoke(access_token, function_id, ablationSize, dataset):
-    url = f"https://www.nyckel.com/v1/functions/{function_id}/invoke"
+class NyckelAdapter(ServiceAdapter):
+    name = "nyckel"
+    test_suffix = "nyckel"
 
-    headers = {"Authorization": f"Bearer {access_token}"}
+    def __init__(self, dataset, access_token, function_id, pool_size=10):
+        super().__init__(dataset)
+        self.url = f"{BASE_URL}/v1/functions/{function_id}/invoke"
+        self.headers = {"Authorization": f"Bearer {access_token}"}
+        self.session = HttpSession(pool_size)
 
-    results = [[], [], [], [], []]
-    if not os.path.exists(f"data/{dataset}/results"):
-        os.makedirs(f"data/{dataset}/results")
-    if os.path.exists(f"data/{dataset}/results/{dataset}-nyckel-results-{str(ablationSize)}.csv"):
-        df = pd.read_csv(f"data/{dataset}/results/{dataset}-nyckel-results-{str(ablationSize)}.csv", header=None)
-        results[0] = df[0].tolist()
-        results[1] = df[1].tolist()
-        results[2] = df[2].tolist()
-        results[3] = df[3].tolist()
-        results[4] = df[4].tolist()
-
-    accurate = 0
-    total = 0
-    with open(f"data/{dataset}/{dataset}_test_nyckel.csv") as csvfile:
-        reader = csv.reader(csvfile)
-        # get the class labels from classes.txt
-
-        for row in reader:
-            print(row[0])
-            if row[0] in results[0]:
-                print("already done")
-                continue
-            else:
-                with open(f"data/{dataset}/test/{row[1]}/{row[0]}", "rb") as f:
-                    # measure the latency for this request
-                    result = requests.post(url, headers=headers, files={"data": f})
-                    print(result.json())
-                    results[0].append(row[0])
-                    results[1].append(row[1])
-                    results[2].append(result.json()["labelName"])
-                    results[3].append(result.json()["confidence"])
-                    results[4].append(result.elapsed)
-                    # check whether the result.labelName is pneumonia
-                    if result.json()["labelName"] == row[1]:
-                        accurate += 1
-                        print("accurate")
-                    else:
-                        print("inaccurate")
-                    total += 1
-
-                df = pd.DataFrame(results)
-                df = df.transpose()
-                df.to_csv(
-                    f"data/{dataset}/results/{dataset}-nyckel-results-{str(ablationSize)}.csv",
-                    index=False,
-                    header=False,
-                )
-                print(f"Accuracy: {accurate/total}")
-                print(f"Accurate: {accurate}")
-                print(f"Total: {total}")
+    def connection_reused(self):
+        return self.session.connection_reused()
+
+    def first_byte_ns(self):
+        return self.session.first_byte_ns()
+
+    def send(self, payload):
+        try:
+            response = self.session.post(self.url, headers=self.headers, files={"data": payload})
+        except self.session.transport_errors as err:
+            raise ServiceError(f"Connection failed: {err}") from err
+        if not response.status_code == 200:
+            raise ServiceError(
+                f"{response.text=} {response.status_code=}",
+                response.status_code,
+                parse_retry_after(response.headers.get("Retry-After")),
+            )
+        return response.json()
+
+    def parse(self, response):
+        return response["labelName"], response["confidence"]
+
+
+def invoke(access_token, function_id, ablationSize, dataset):
+    run_invoke(NyckelAdapter(dataset, access_token, function_id, pool_size=1), ablationSize)
 
 
 def parallel_invoke(access_token, function_id, ablationSize, dataset):
+    run_parallel(NyckelAdapter(dataset, access_token, function_id, pool_size=10), ablationSize)
 
-    url = f"https://www.nyckel.com/v1/functions/{function_id}/invoke"
 
-    headers = {"Authorization": f"Bearer {access_token}"}
+def async_invoke(access_token, function_id, ablationSize, dataset, concurrency=10):
+    run_invoke(NyckelAdapter(dataset, access_token, function_id, pool_size=concurrency), ablationSize, concurrency)
 
-    filenames = []
-    labels = []
-    with open(f"data/{dataset}/{dataset}_test_nyckel.csv") as csvfile:
-        reader = csv.reader(csvfile)
-        # get the class labels from classes.txt
-        count = 0
-        for row in reader:
-            filenames.append(row[0])
-            labels.append(row[1])
-            count += 1
-            if count == 1000:
-                break
-
-    def _parallel_invoke(filename: str, label: str):
-
-        with open(f"data/{dataset}/test/{label}/{filename}", "rb") as f:
-            response = requests.post(url, headers=headers, files={"data": f})
-            if not response.status_code == 200:
-                print(f"Invalid response {response.text=} {response.status_code=} {filename=} {label=}")
-
-    start = time.time()
-    Parallel(n_jobs=10, prefer="threads")(
-        delayed(_parallel_invoke)(filename, label)
-        for filename, label in tqdm(zip(filenames, labels), total=len(labels))
-    )
-    end = time.time()
-    print(f"Time to 1000 invokes {dataset}-{ablationSize}: {end - start}")
 
+def load_test(access_token, function_id, ablationSize, dataset, rps, duration=60, warmup=10):
+    adapter = NyckelAdapter(dataset, access_token, function_id, pool_size=64)
+    run_open_loop(adapter, ablationSize, rps, duration, warmup)
 
 
+def sweep(access_token, function_id, ablationSize, dataset, max_concurrency=64, n_requests=1000):
+    adapter = NyckelAdapter(dataset, access_token, function_id, pool_size=max_concurrency)
+    run_sweep(adapter, ablationSize, max_concurrency, n_requests)
+
 
 if __name__ == "__main__":
     access_token = get_token()
@@ -205,4 +179,24 @@ if __name__ == "__main__":
         function_id = sys.argv[3]
         ablationSize = sys.argv[4]
         parallel_invoke(access_token, function_id, ablationSize, dataset)
-    
+    elif sys.argv[1] == "async":
+        dataset = sys.argv[2]
+        function_id = sys.argv[3]
+        ablationSize = sys.argv[4]
+        concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 10
+        async_invoke(access_token, function_id, ablationSize, dataset, concurrency)
+    elif sys.argv[1] == "load":
+        dataset = sys.argv[2]
+        function_id = sys.argv[3]
+        ablationSize = sys.argv[4]
+        rps = float(sys.argv[5])
+        duration = float(sys.argv[6]) if len(sys.argv) > 6 else 60
+        warmup = float(sys.argv[7]) if len(sys.argv) > 7 else 10
+        load_test(access_token, function_id, ablationSize, dataset, rps, duration, warmup)
+    elif sys.argv[1] == "sweep":
+        dataset = sys.argv[2]
+        function_id = sys.argv[3]
+        ablationSize = sys.argv[4]
+        max_concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else 64
+        n_requests = int(sys.argv[6]) if len(sys.argv) > 6 else 1000
+        sweep(access_token, function_id, ablationSize, dataset, max_concurrency, n_requests)
@@ -0,0 +1,101 @@
+"""Packed image store: every image of a split in one contiguous blob, read through mmap.
+
+    python packed_store.py pack <dataset> [split ...]
+
+writes data/{dataset}/packed/{split}.bin with the images of data/{dataset}/{split}/{label}/{filename} back to back,
+and data/{dataset}/packed/{split}.index.csv with one [label, filename, offset, length] row per image (splits default
+to test and train).
+
+ServiceAdapter.image_bytes looks images up here first. A payload is then a memoryview slice of the mapped blob: no
+open() per image inside the request loop, no copy, and the bytes come straight from the page cache. Images that are
+not in the index (e.g. added after packing) are read from their file as before.
+"""
+
+import csv
+import mmap
+import os
+import shutil
+import sys
+import threading
+
+
+def packed_paths(dataset, split):
+    return f"data/{dataset}/packed/{split}.bin", f"data/{dataset}/packed/{split}.index.csv"
+
+
+def pack_split(dataset, split="test"):
+    blob_path, index_path = packed_paths(dataset, split)
+    if not os.path.exists(os.path.dirname(blob_path)):
+        os.makedirs(os.path.dirname(blob_path))
+
+    offset = 0
+    n_images = 0
+    with open(f"{blob_path}.tmp", "wb") as blob, open(f"{index_path}.tmp", "w", newline="") as index:
+        writer = csv.writer(index)
+        for label in sorted(os.listdir(f"data/{dataset}/{split}")):
+            if not os.path.isdir(f"data/{dataset}/{split}/{label}"):
+                continue
+            for filename in sorted(os.listdir(f"data/{dataset}/{split}/{label}")):
+                with open(f"data/{dataset}/{split}/{label}/{filename}", "rb") as f:
+                    length = os.fstat(f.fileno()).st_size
+                    shutil.copyfileobj(f, blob)
+                writer.writerow([label, filename, offset, length])
+                offset += length
+                n_images += 1
+    # Readers only ever see a complete blob and index
+    os.replace(f"{blob_path}.tmp", blob_path)
+    os.replace(f"{index_path}.tmp", index_path)
+    print(f"Packed {n_images} {split} images of {dataset} into {blob_path} ({offset / 1e6:.1f} MB)")
+
+
+class PackedStore:
+    def __init__(self, dataset, split="test"):
+        blob_path, index_path = packed_paths(dataset, split)
+        self.index = {}
+        with open(index_path, newline="") as f:
+            for label, filename, offset, length in csv.reader(f):
+                self.index[(label, filename)] = (int(offset), int(length))
+        self._file = open(blob_path, "rb")
+        # mmap refuses empty files
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.index else None
+        if self._mmap is not None and hasattr(self._mmap, "madvise"):
+            # Requests pick images in test-list order, not blob order; ask for read-ahead of the whole split
+            self._mmap.madvise(mmap.MADV_WILLNEED)
+        self._view = memoryview(self._mmap) if self._mmap is not None else None
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, filename, label):
+        offset, length = self.index[(label, filename)]
+        return self._view[offset : offset + length]
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._mmap.close()
+        self._file.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_packed(dataset, split="test"):
+    """The PackedStore of a split, opened once per process, or None if the split was never packed."""
+    with _stores_lock:
+        if (dataset, split) not in _stores:
+            blob_path, index_path = packed_paths(dataset, split)
+            exists = os.path.exists(blob_path) and os.path.exists(index_path)
+            _stores[(dataset, split)] = PackedStore(dataset, split) if exists else None
+        return _stores[(dataset, split)]
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "pack":
+        dataset = sys.argv[2]
+        for split in sys.argv[3:] or ["test", "train"]:
+            pack_split(dataset, split)
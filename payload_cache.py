@@ -0,0 +1,179 @@
+"""Provider-ready payloads: test images resized, recompressed and stripped of metadata once, then reused.
+
+A PayloadTransform (max dimension, JPEG quality, EXIF strip) turns an image into a JPEG no larger than max_dimension
+on its long side. Results are cached by the SHA-256 of the source bytes plus the transform parameters,
+
+    data/payload_cache/{transform.key()}/{sha256[:2]}/{sha256}.jpg
+
+so the five ablation runs of a dataset, every service, and identical images in other splits or datasets all share one
+payload. data/{dataset}/payloads/{split}-{transform.key()}.csv maps [label, filename] to [sha256, source_bytes,
+payload_bytes], which lets the runners fetch a payload without hashing the source again.
+
+    python payload_cache.py build <dataset> <max_dimension> [quality] [split]
+
+transforms a split ahead of a run on a process pool (images already in the cache are skipped). Runners use
+transformed payloads when PAYLOAD_MAX_DIMENSION and/or PAYLOAD_QUALITY are set in the environment; anything missing
+from the cache is transformed on first use.
+"""
+
+import csv
+import hashlib
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+from tqdm import tqdm
+
+CACHE_ROOT = "data/payload_cache"
+
+
+class PayloadTransform:
+    def __init__(self, max_dimension=None, quality=85, strip_exif=True):
+        self.max_dimension = int(max_dimension) if max_dimension else None
+        self.quality = int(quality)
+        self.strip_exif = strip_exif
+
+    def key(self):
+        """Directory name for the cache of this transform; every parameter that changes the output is in it."""
+        size = f"max{self.max_dimension}" if self.max_dimension else "full"
+        return f"{size}-q{self.quality}-{'noexif' if self.strip_exif else 'exif'}"
+
+    def apply(self, image_bytes):
+        """The transformed image as JPEG bytes."""
+        image = Image.open(io.BytesIO(image_bytes))
+        exif = image.info.get("exif")
+        if self.strip_exif:
+            # The orientation tag goes away with the rest of the EXIF block, so bake it into the pixels first
+            image = ImageOps.exif_transpose(image)
+        if self.max_dimension and max(image.size) > self.max_dimension:
+            image.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        options = {} if self.strip_exif or exif is None else {"exif": exif}
+        image.save(output, format="JPEG", quality=self.quality, optimize=True, **options)
+        return output.getvalue()
+
+
+def transform_from_env():
+    """The PayloadTransform asked for with PAYLOAD_MAX_DIMENSION / PAYLOAD_QUALITY, None to send the original bytes."""
+    max_dimension = os.getenv("PAYLOAD_MAX_DIMENSION")
+    quality = os.getenv("PAYLOAD_QUALITY")
+    if not max_dimension and not quality:
+        return None
+    return PayloadTransform(max_dimension, quality or 85)
+
+
+def cache_path(transform, digest, root=CACHE_ROOT):
+    return f"{root}/{transform.key()}/{digest[:2]}/{digest}.jpg"
+
+
+def index_path(dataset, split, transform):
+    return f"data/{dataset}/payloads/{split}-{transform.key()}.csv"
+
+
+def cached_payload(image_bytes, transform, root=CACHE_ROOT):
+    """(sha256 of the source, payload bytes), transforming and storing the payload only if it is not cached yet."""
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    path = cache_path(transform, digest, root)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return digest, f.read()
+    payload = transform.apply(image_bytes)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Concurrent builders may produce the same payload; whichever rename lands last wins with identical bytes
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return digest, payload
+
+
+def _build_one(path, transform, root):
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    digest, payload = cached_payload(image_bytes, transform, root)
+    return digest, len(image_bytes), len(payload)
+
+
+def build_payloads(dataset, transform, split="test", workers=None, root=CACHE_ROOT):
+    """Transforms every image of data/{dataset}/{split} on a process pool and writes the split's payload index."""
+    images = []
+    for label in sorted(os.listdir(f"data/{dataset}/{split}")):
+        if os.path.isdir(f"data/{dataset}/{split}/{label}"):
+            images += [(label, filename) for filename in sorted(os.listdir(f"data/{dataset}/{split}/{label}"))]
+    paths = [f"data/{dataset}/{split}/{label}/{filename}" for label, filename in images]
+
+    workers = workers or os.cpu_count()
+    chunksize = max(1, len(paths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            tqdm(
+                executor.map(_build_one, paths, [transform] * len(paths), [root] * len(paths), chunksize=chunksize),
+                total=len(paths),
+            )
+        )
+
+    path = index_path(dataset, split, transform)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(f"{path}.tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        for (label, filename), (digest, source_bytes, payload_bytes) in zip(images, results):
+            writer.writerow([label, filename, digest, source_bytes, payload_bytes])
+    os.replace(f"{path}.tmp", path)
+
+    source_total = sum(result[1] for result in results)
+    payload_total = sum(result[2] for result in results)
+    if source_total:
+        print(
+            f"{len(results)} {split} payloads of {dataset} with {transform.key()}: "
+            f"{source_total / 1e6:.1f} MB -> {payload_total / 1e6:.1f} MB ({payload_total / source_total:.0%})"
+        )
+
+
+class PayloadCache:
+    """Transformed payloads of one split, looked up through the split's index when it was built ahead of time."""
+
+    def __init__(self, dataset, transform, split="test", root=CACHE_ROOT):
+        self.transform = transform
+        self.root = root
+        self.index = {}
+        path = index_path(dataset, split, transform)
+        if os.path.exists(path):
+            with open(path, newline="") as f:
+                for label, filename, digest, _, _ in csv.reader(f):
+                    self.index[(label, filename)] = digest
+
+    def get(self, filename, label, read_source):
+        """The payload of an image. read_source() returns the original bytes; it is only called on a cache miss."""
+        digest = self.index.get((label, filename))
+        if digest is not None and os.path.exists(cache_path(self.transform, digest, self.root)):
+            with open(cache_path(self.transform, digest, self.root), "rb") as f:
+                return f.read()
+        digest, payload = cached_payload(read_source(), self.transform, self.root)
+        self.index[(label, filename)] = digest
+        return payload
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_payloads(dataset, transform, split="test"):
+    """The PayloadCache of a split and transform, opened once per process."""
+    with _caches_lock:
+        if (dataset, split, transform.key()) not in _caches:
+            _caches[(dataset, split, transform.key())] = PayloadCache(dataset, transform, split)
+        return _caches[(dataset, split, transform.key())]
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "build":
+        dataset = sys.argv[2]
+        transform = PayloadTransform(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else 85)
+        build_payloads(dataset, transform, sys.argv[5] if len(sys.argv) > 5 else "test")
@@ -1,23 +1,169 @@
 import os
 import shutil
 import sys
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from mat4py import loadmat
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def archive_members(path):
+    """Yields (name, file object) for every regular file of a .zip or tar archive, in archive order, reading the
+    archive once from start to end (tar archives in stream mode, so compressed tarballs are never seeked)."""
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as f:
+                        yield info.filename, f
+    else:
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+
+
+def ingest_archive(training_set, path, place):
+    """Writes the images of an archive straight to data/{training_set}/{split}/{class}/{filename}, without extracting
+    the archive first. place(name, f) returns (split, class, filename) for a member to keep, None to skip it; it may
+    read metadata members from f. Returns {split: number of images written}."""
+    counts = {}
+    created = set()
+    for name, f in archive_members(path):
+        destination = place(name, f)
+        if destination is None:
+            continue
+        split, class_, filename = destination
+        class_, filename = str(class_), os.path.basename(filename)
+        if class_ in ("", ".", "..") or "/" in class_ or filename in ("", ".", ".."):
+            raise ValueError(f"Unsafe destination {destination} for {name} in {path}")
+        folder = f"data/{training_set}/{split}/{class_}"
+        if folder not in created:
+            os.makedirs(folder, exist_ok=True)
+            created.add(folder)
+        with open(f"{folder}/{filename}.tmp", "wb") as target:
+            shutil.copyfileobj(f, target, 1 << 20)
+        os.replace(f"{folder}/{filename}.tmp", f"{folder}/{filename}")
+        counts[split] = counts.get(split, 0) + 1
+    print(f"{path}: " + ", ".join(f"{count} {split}" for split, count in sorted(counts.items())))
+    return counts
+
+
+def ingest_archives(training_set, jobs, workers=4):
+    """Runs ingest_archive for every (path, place) in parallel, one thread per archive."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(ingest_archive, training_set, path, place) for path, place in jobs]
+        return [future.result() for future in futures]
+
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _read_lines(f):
+    """The non-empty lines of a small text member, e.g. a split list."""
+    return [line.strip() for line in f.read().decode("utf-8").splitlines() if line.strip()]
+
+
+def _class_folder_place(split):
+    """Places .../{class}/{image} members under split, for archives whose split is the archive itself."""
+
+    def place(name, f):
+        parts = name.split("/")
+        return (split, parts[-2], parts[-1]) if len(parts) >= 2 and _is_image(name) else None
+
+    return place
+
+
+def read_pets_splits(path="data/pets/annotations.tar.gz"):
+    """{image: split} from annotations/trainval.txt and annotations/test.txt, read out of the annotations tarball."""
+    splits = {}
+    for name, f in archive_members(path):
+        list_file = name.split("/")[-1]
+        if list_file in ("trainval.txt", "test.txt"):
+            split = "train" if list_file == "trainval.txt" else "test"
+            for line in _read_lines(f):
+                splits[line.split(" ")[0]] = split
+    return splits
+
+
+def _food_place():
+    """(place, finish) for food-101.tar.gz, whose split lists (meta/train.txt, meta/test.txt) are in the same tarball
+    as the images. Images that come before both lists have been read are written to train, the larger split, and
+    finish() moves the test ones with a rename once the whole archive has been read."""
+    splits = {}
+    lists_read = set()
+    provisional = []
+
+    def place(name, f):
+        parts = name.split("/")
+        if len(parts) >= 2 and parts[-2] == "meta" and parts[-1] in ("train.txt", "test.txt"):
+            split = parts[-1][: -len(".txt")]
+            for line in _read_lines(f):
+                splits[line] = split
+            lists_read.add(split)
+            return None
+        if len(parts) < 3 or parts[-3] != "images" or not _is_image(name):
+            return None
+        key = f"{parts[-2]}/{os.path.splitext(parts[-1])[0]}"
+        if len(lists_read) < 2:
+            provisional.append((key, parts[-2], parts[-1]))
+            return "train", parts[-2], parts[-1]
+        return (splits[key], parts[-2], parts[-1]) if key in splits else None
+
+    def finish():
+        for key, class_, filename in provisional:
+            if splits.get(key) == "train":
+                continue
+            if splits.get(key) == "test":
+                os.makedirs(f"data/food/test/{class_}", exist_ok=True)
+                os.replace(f"data/food/train/{class_}/{filename}", f"data/food/test/{class_}/{filename}")
+            else:
+                os.remove(f"data/food/train/{class_}/{filename}")
+
+    return place, finish
 
-def extract_dataset(training_set):
+
+def ingest_dataset(training_set, workers=4):
+    """Streams the downloaded archives of beans, cars, pets or food into data/{training_set}/train/{class} and
+    data/{training_set}/test/{class}, using the split each dataset ships with."""
     if training_set == "beans":
-        for dataset in ["train", "test", "validation"]:
-            shutil.unpack_archive(f"data/{training_set}/{dataset}.zip", f"data/{training_set}")
+        # beans comes as train, validation and test zips of {split}/{class}/{image}; validation is used for training
+        jobs = [
+            (f"data/beans/{archive}.zip", _class_folder_place("test" if archive == "test" else "train"))
+            for archive in ["train", "test", "validation"]
+        ]
+        ingest_archives(training_set, jobs, workers)
     elif training_set == "cars":
-        shutil.unpack_archive(f"data/{training_set}/car_ims.tgz", f"data/{training_set}/")
         mat_to_csv(training_set)
+        df = pd.read_csv("data/cars/cars_annos.csv")
+        destinations = {
+            path: ("test" if test else "train", class_)
+            for path, class_, test in zip(df["relative_im_path"], df["class"], df["test"])
+        }
+
+        def place(name, f):
+            return (*destinations[name], name) if name in destinations else None
+
+        ingest_archives(training_set, [("data/cars/car_ims.tgz", place)], workers)
     elif training_set == "pets":
-        for dataset in ["images", "annotations"]:
-            shutil.unpack_archive(f"data/{training_set}/{dataset}.tar.gz", f"data/{training_set}")
+        splits = read_pets_splits()
+
+        def place(name, f):
+            image = os.path.splitext(name.split("/")[-1])[0]
+            if image not in splits or not _is_image(name):
+                return None
+            return splits[image], "_".join(image.split("_")[:-1]), name
+
+        ingest_archives(training_set, [("data/pets/images.tar.gz", place)], workers)
     elif training_set == "food":
-        shutil.unpack_archive(f"data/{training_set}/food-101.tar.gz", f"data/{training_set}/")
+        place, finish = _food_place()
+        ingest_archives(training_set, [("data/food/food-101.tar.gz", place)], workers)
+        finish()
 
 
 def mat_to_csv(training_set):
@@ -28,15 +174,6 @@ def mat_to_csv(training_set):
 
 
 def move_validation_to_train(training_set):
-    if training_set == "beans" and os.path.exists(f"data/{training_set}/validation/"):
-        classes = ["healthy", "angular_leaf_spot", "bean_rust"]
-        for class_ in classes:
-            for file in os.listdir(f"data/{training_set}/validation/{class_}"):
-                shutil.move(
-                    f"data/{training_set}/validation/{class_}/{file}", f"data/{training_set}/train/{class_}/{file}"
-                )
-            os.rmdir(f"data/{training_set}/validation/{class_}")
-        os.rmdir(f"data/{training_set}/validation/")
     if training_set == "xrays" and os.path.exists(f"data/{training_set}/chest_xray/val"):
         classes = ["NORMAL", "PNEUMONIA"]
         for class_ in classes:
@@ -50,83 +187,13 @@ def move_validation_to_train(training_set):
 
 
 def create_train_and_test_dirs(training_set):
-    if training_set in ["cars", "food", "pets", "intel", "xrays"]:
+    if training_set in ["intel", "xrays"]:
         if not os.path.exists(f"data/{training_set}/train"):
             os.makedirs(f"data/{training_set}/train")
         if not os.path.exists(f"data/{training_set}/test"):
             os.makedirs(f"data/{training_set}/test")
 
 
-def create_class_dirs(training_set):
-    if training_set == "cars":
-        classes = pd.read_csv("data/cars/cars_annos.csv")["class"].unique()
-        for class_ in classes:
-            if not os.path.exists(f"data/cars/train/{class_}"):
-                os.makedirs(f"data/cars/train/{class_}")
-            if not os.path.exists(f"data/cars/test/{class_}"):
-                os.makedirs(f"data/cars/test/{class_}")
-    elif training_set == "food":
-        # read classes.txt
-        classes = []
-        with open("data/food/food-101/meta/classes.txt", "r") as f:
-            for line in f:
-                classes.append(line.strip())
-        for class_ in classes:
-            if not os.path.exists(f"data/food/train/{class_}"):
-                os.makedirs(f"data/food/train/{class_}")
-            if not os.path.exists(f"data/food/test/{class_}"):
-                os.makedirs(f"data/food/test/{class_}")
-    elif training_set == "pets":
-        classes = []
-        with open("data/pets/annotations/trainval.txt", "r") as f:
-            for line in f:
-                image = line.strip().split(" ")[0]
-                class_ = "_".join(image.split("_")[:-1])
-                classes.append(class_)
-        for class_ in classes:
-            if not os.path.exists(f"data/pets/train/{class_}"):
-                os.makedirs(f"data/pets/train/{class_}")
-            if not os.path.exists(f"data/pets/test/{class_}"):
-                os.makedirs(f"data/pets/test/{class_}")
-
-
-def move_images_to_class_dirs(training_set):
-    if training_set == "cars":
-        df = pd.read_csv("data/cars/cars_annos.csv")
-        for index, row in df.iterrows():
-            if row["test"]:
-                shutil.move(
-                    f'data/cars/{row["relative_im_path"]}',
-                    f'data/cars/test/{row["class"]}/{row["relative_im_path"].split("/")[-1]}',
-                )
-            else:
-                shutil.move(
-                    f'data/cars/{row["relative_im_path"]}',
-                    f'data/cars/train/{row["class"]}/{row["relative_im_path"].split("/")[-1]}',
-                )
-    elif training_set == "food":
-        with open("data/food/food-101/meta/train.txt", "r") as f:
-            for line in f:
-                line = line.strip()
-                shutil.move(f"data/food/food-101/images/{line}.jpg", f"data/food/train/{line}.jpg")
-        with open("data/food/food-101/meta/test.txt", "r") as f:
-            for line in f:
-                line = line.strip()
-                shutil.move(f"data/food/food-101/images/{line}.jpg", f"data/food/test/{line}.jpg")
-    elif training_set == "pets":
-        with open("data/pets/annotations/trainval.txt", "r") as f:
-            for line in f:
-                image = line.strip().split(" ")[0]
-                class_ = "_".join(image.split("_")[:-1])
-
-                shutil.move(f"data/pets/images/{image}.jpg", f"data/pets/train/{class_}/{image}.jpg")
-        with open("data/pets/annotations/test.txt", "r") as f:
-            for line in f:
-                image = line.strip().split(" ")[0]
-                class_ = "_".join(image.split("_")[:-1])
-                shutil.move(f"data/pets/images/{image}.jpg", f"data/pets/test/{class_}/{image}.jpg")
-
-
 def move_classes_folders_and_images_to_test_and_train(training_set):
     if training_set == "intel":
         classes = os.listdir("data/intel/seg_train/seg_train")
@@ -161,15 +228,14 @@ def move_classes_folders_and_images_to_test_and_train(training_set):
 
 
 def preprocessing_main(training_set):
-    extract_dataset(training_set)
-    mat_to_csv(training_set)
+    # beans, cars, pets and food are downloaded as archives; intel and xrays come extracted from Kaggle
+    ingest_dataset(training_set)
     move_validation_to_train(training_set)
     create_train_and_test_dirs(training_set)
-    create_class_dirs(training_set)
-    move_images_to_class_dirs(training_set)
     move_classes_folders_and_images_to_test_and_train(training_set)
 
 
 if __name__ == "__main__":
-    training_set = sys.argv[1]
-    preprocessing_main(training_set)
+    # Several datasets are preprocessed in parallel, e.g. python preprocessing.py beans cars pets food
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(preprocessing_main, sys.argv[1:]))
@@ -9,6 +9,8 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 
+from latency_sketch import box_stats, load_sketches, merge_by_service
+
 CB91_Blue = "#2CBDFE"
 CB91_Green = "#47DBCD"
 CB91_Pink = "#F3A0F2"
@@ -479,6 +481,21 @@ def render_latency_and_throughput():
     fig.savefig("result_plots/throughput_latency.svg")
 
 def render_latency(plot):
+    # Prefer the latency sketches stored by the runners (see latency_sketch.py), merged over all datasets and
+    # ablations. Without any, fall back to the hand-maintained latency.csv.
+    sketches = merge_by_service(load_sketches())
+    if sketches:
+        boxes = []
+        service_colors = []
+        for service, sketch in sketches.items():
+            service = "huggingface" if service == "hg" else service
+            if service not in pretty_name_by_service:
+                continue
+            boxes.append(box_stats(sketch, pretty_name_by_service[service], scale=1000))
+            service_colors.append(color_by_service[service])
+        _plot_latency_boxes(plot, boxes, service_colors)
+        return
+
     with open ("latency.csv") as f:
         lines = f.readlines()
 
@@ -496,7 +513,10 @@ def render_latency(plot):
             'fliers': []        # Outliers
         })
         service_colors.append(color_by_service[service])
+    _plot_latency_boxes(plot, boxes, service_colors)
 
+
+def _plot_latency_boxes(plot, boxes, service_colors):
     bplot = plot.bxp(boxes, showfliers=False, patch_artist=True)
     for patch, color in zip(bplot['boxes'], service_colors):
         patch.set_facecolor(color)
@@ -539,6 +559,55 @@ def render_throughput(plot):
     plot.grid(which="major", color="dimgrey", alpha=0.3)
     plot.set_xticks(ind, service_names)
 
+
+def render_throughput_vs_latency(sweep_file="image-classification-throughput-sweep.csv", percentile="p95"):
+    # Sweep results are written by throughput_sweep.py, one row per service, dataset, ablation and concurrency level.
+    # Each service gets one curve of latency vs. throughput, with the concurrency level next to each point and the
+    # saturation knee drawn as a larger marker.
+    with open(sweep_file) as f:
+        lines = f.readlines()
+
+    header = lines[0].strip().split(",")
+    curves = {}
+    for line in lines[1:]:
+        row = dict(zip(header, line.strip().split(",")))
+        service = "huggingface" if row["service"] == "hg" else row["service"]
+        key = (service, row["dataset"], row["ablation"])
+        if key not in curves:
+            curves[key] = {"concurrency": [], "throughput": [], "latency": [], "knee": None}
+        curves[key]["concurrency"].append(int(row["concurrency"]))
+        curves[key]["throughput"].append(float(row["throughput_rps"]))
+        curves[key]["latency"].append(1000 * float(row[f"{percentile}_s"]))
+        if row["knee"] == "True":
+            curves[key]["knee"] = len(curves[key]["concurrency"]) - 1
+
+    fig, ax = plt.subplots(1, 1, figsize=(10, 5))
+    for (service, dataset, ablation), curve in curves.items():
+        color = color_by_service.get(service, "dimgrey")
+        ax.plot(
+            curve["throughput"],
+            curve["latency"],
+            ".-",
+            color=color,
+            label=f"{pretty_name_by_service.get(service, service)} ({dataset}, {ablation})",
+        )
+        for concurrency, throughput, latency in zip(curve["concurrency"], curve["throughput"], curve["latency"]):
+            ax.annotate(str(concurrency), (throughput, latency), fontsize=8, xytext=(3, 3), textcoords="offset points")
+        if curve["knee"] is not None:
+            knee = curve["knee"]
+            ax.plot(curve["throughput"][knee], curve["latency"][knee], "o", markersize=10, color=color)
+
+    ax.set_title(f"Throughput vs. {percentile} latency by concurrency", fontsize=18)
+    ax.set_yscale("log")
+    ax.set_xlabel("Throughput (requests per second)")
+    ax.set_ylabel(f"{percentile} latency (ms)")
+    ax.grid(which="minor", color="dimgrey", alpha=0.1)
+    ax.grid(which="major", color="dimgrey", alpha=0.3)
+    ax.legend(prop={"size": 8})
+    fig.tight_layout()
+    fig.savefig("result_plots/throughput_vs_latency.png")
+    fig.savefig("result_plots/throughput_vs_latency.svg")
+
 def render_devex():
     with open("image-classification-usability.csv") as f:
         lines = f.readlines()
@@ -583,6 +652,8 @@ def render_selected(data):
     render_mean_traintime_vs_mean_accuracy(data, True)
     render_mean_traintime_vs_mean_accuracy(data, False, "mean_traintime_vs_mean_accuracy_no_legend")
     render_latency_and_throughput()
+    if os.path.exists("image-classification-throughput-sweep.csv"):
+        render_throughput_vs_latency()
     render_devex()
 
 
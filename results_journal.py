@@ -0,0 +1,78 @@
+"""Append-only journal for the per-service results files
+data/{dataset}/results/{dataset}-{service}-results-{ablation}.csv.
+
+Rows are appended as they come in and flushed + fsynced in batches, so a run costs O(n) writes instead of rewriting
+the whole file after every image. On open the filenames already in the file are loaded into a set, which makes the
+"already done" check on resume O(1). A row that was only half written when a previous run crashed is dropped.
+
+Failed requests are journaled too, with their error in the status column (see runner.py), but do not count as done,
+so the next run tries them again.
+"""
+
+import csv
+import os
+
+STATUS_COLUMN = 11
+
+
+def succeeded(row):
+    """Whether a journal row is a prediction. Rows written before the status column existed only record successes."""
+    return len(row) <= STATUS_COLUMN or row[STATUS_COLUMN] == "ok"
+
+
+class ResultsJournal:
+    def __init__(self, path, flush_every=50):
+        self.path = path
+        self.flush_every = flush_every
+        self.done = set()
+        self._pending = 0
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            self._truncate_partial_row()
+            with open(path, newline="") as csvfile:
+                for row in csv.reader(csvfile):
+                    if row and succeeded(row):
+                        self.done.add(row[0])
+
+        self._file = open(path, "a", newline="")
+        self._writer = csv.writer(self._file)
+
+    def _truncate_partial_row(self):
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def __contains__(self, filename):
+        return filename in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def append(self, row):
+        self._writer.writerow(row)
+        if succeeded(row):
+            self.done.add(row[0])
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
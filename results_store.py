@@ -0,0 +1,182 @@
+"""Columnar results store. Every accuracy run ends up as one Parquet file under
+
+    data/results_store/dataset={dataset}/service={service}/ablation={ablation}/part-0.parquet
+
+with the same typed schema for every service (SCHEMA), so analysis is a vectorized scan over all runs instead of a
+csv.reader loop over headerless files whose columns differ by service.
+
+The per-service CSVs written by runner.py stay the crash-safe journal of a run in progress; run_invoke rewrites the
+run's partition from it when it finishes. Results from before the store existed are imported with
+
+    python results_store.py convert
+
+and `python results_store.py summary` prints accuracy and latency for every (dataset, service, ablation).
+"""
+
+import csv
+import os
+import re
+import sys
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+STORE_ROOT = "data/results_store"
+SCHEMA = pa.schema(
+    [
+        ("filename", pa.string()),
+        ("truth", pa.string()),
+        ("prediction", pa.string()),
+        ("confidence", pa.float64()),
+        ("latency_ns", pa.int64()),
+        ("status", pa.string()),
+        ("attempt", pa.int32()),
+        ("payload_bytes", pa.int64()),
+    ]
+)
+PARTITIONING = ds.partitioning(
+    pa.schema([("dataset", pa.string()), ("service", pa.string()), ("ablation", pa.int32())]), flavor="hive"
+)
+RESULTS_FILE = re.compile(r"^(?P<dataset>[^-]+)-(?P<service>.+)-results-(?P<ablation>\d+)\.csv$")
+
+
+def parse_latency(value):
+    # Everything written by runner.py stores seconds as a float. Older nyckel and huggingface results store requests'
+    # response.elapsed, a timedelta string like 0:00:00.213843.
+    try:
+        return float(value)
+    except ValueError:
+        hours, minutes, seconds = value.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_results_filename(file):
+    """(dataset, service, ablation) for a results file name like beans-hg-results-20.csv, None for anything else."""
+    match = RESULTS_FILE.match(os.path.basename(file))
+    if match is None:
+        return None
+    return match["dataset"], match["service"], int(match["ablation"])
+
+
+def partition_path(dataset, service, ablation, root=STORE_ROOT):
+    return f"{root}/dataset={dataset}/service={service}/ablation={ablation}"
+
+
+def read_results_csv(path):
+    """Reads a per-service results CSV of any vintage into a SCHEMA table. Rows written by runner.py carry
+    [..., invoke_time, connection_reused, attempts, start_ns, first_byte_ns, end_ns, payload_bytes, status]; older
+    rows stop earlier and are all successes. Failed requests have a status other than "ok" and null prediction,
+    confidence and latency. A row without attempts counts as a single attempt, one without payload_bytes gets a null."""
+    columns = {name: [] for name in SCHEMA.names}
+    with open(path, newline="") as csvfile:
+        for row in csv.reader(csvfile):
+            if not row:
+                continue
+            status = row[11] if len(row) > 11 and row[11] else "ok"
+            if status != "ok":
+                prediction = confidence = latency_ns = None
+            else:
+                prediction, confidence = row[2], float(row[3])
+                if len(row) >= 10 and row[7] and row[9]:
+                    latency_ns = int(row[9]) - int(row[7])
+                else:
+                    latency_ns = round(parse_latency(row[4]) * 1e9)
+            columns["filename"].append(row[0])
+            columns["truth"].append(row[1])
+            columns["prediction"].append(prediction)
+            columns["confidence"].append(confidence)
+            columns["latency_ns"].append(latency_ns)
+            columns["status"].append(status)
+            columns["attempt"].append(int(row[6]) if len(row) > 6 and row[6] else 1)
+            columns["payload_bytes"].append(int(row[10]) if len(row) > 10 and row[10] else None)
+    return pa.table(columns, schema=SCHEMA)
+
+
+def write_partition(table, dataset, service, ablation, root=STORE_ROOT):
+    path = partition_path(dataset, service, ablation, root)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    pq.write_table(table, f"{path}/part-0.parquet")
+
+
+def import_results_csv(path, root=STORE_ROOT):
+    """Replaces the partition of one results CSV with its current contents."""
+    dataset, service, ablation = parse_results_filename(path)
+    write_partition(read_results_csv(path), dataset, service, ablation, root)
+
+
+def import_if_stale(path, root=STORE_ROOT):
+    """Imports a results CSV unless its partition is at least as new as the file."""
+    dataset, service, ablation = parse_results_filename(path)
+    part = f"{partition_path(dataset, service, ablation, root)}/part-0.parquet"
+    if not os.path.exists(part) or os.path.getmtime(part) < os.path.getmtime(path):
+        import_results_csv(path, root)
+
+
+def convert(data_dir="data", root=STORE_ROOT):
+    """Imports every data/{dataset}/results/*.csv into the store."""
+    for dataset in sorted(os.listdir(data_dir)):
+        results_dir = f"{data_dir}/{dataset}/results"
+        if not os.path.isdir(results_dir):
+            continue
+        for file in sorted(os.listdir(results_dir)):
+            if parse_results_filename(file) is None:
+                continue
+            import_results_csv(f"{results_dir}/{file}", root)
+            print(f"Imported {results_dir}/{file}")
+
+
+def load_results(root=STORE_ROOT, datasets=None, services=None, ablations=None, columns=None):
+    """One pyarrow Table with the dataset/service/ablation partition columns, optionally filtered. Only the
+    partitions that match the filters are read."""
+    # An explicit schema reads partitions written before a column was added, with nulls for that column
+    schema = pa.unify_schemas([SCHEMA, PARTITIONING.schema])
+    dataset = ds.dataset(root, schema=schema, format="parquet", partitioning=PARTITIONING)
+    expression = None
+    for field, values in [("dataset", datasets), ("service", services), ("ablation", ablations)]:
+        if values is not None:
+            condition = pc.field(field).isin(list(values))
+            expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def summarize(table):
+    """Accuracy and latency per (dataset, service, ablation) as a pandas DataFrame. Accuracy and latency are over the
+    successful requests (n); failed counts the requests that ran out of retries."""
+    # Failed requests have a null prediction and latency, which count/mean skip
+    table = table.append_column("correct", pc.cast(pc.equal(table["truth"], table["prediction"]), pa.float64()))
+    table = table.append_column("latency_s", pc.divide(pc.cast(table["latency_ns"], pa.float64()), 1e9))
+    table = table.append_column("retries", pc.subtract(table["attempt"], 1))
+    table = table.append_column("failed", pc.cast(pc.not_equal(table["status"], "ok"), pa.int64()))
+    summary = table.group_by(["dataset", "service", "ablation"]).aggregate(
+        [
+            ("correct", "count"),
+            ("correct", "mean"),
+            ("latency_s", "mean"),
+            ("latency_s", "approximate_median"),
+            ("retries", "sum"),
+            ("failed", "sum"),
+            ("payload_bytes", "mean"),
+        ]
+    )
+    names = {
+        "correct_count": "n",
+        "correct_mean": "accuracy",
+        "latency_s_mean": "latency_mean_s",
+        "latency_s_approximate_median": "latency_median_s",
+        "retries_sum": "retries",
+        "failed_sum": "failed",
+        "payload_bytes_mean": "payload_bytes_mean",
+    }
+    summary = summary.to_pandas().rename(columns=names)
+    columns = ["dataset", "service", "ablation", *names.values()]
+    return summary[columns].sort_values(["dataset", "service", "ablation"]).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "convert":
+        convert()
+    elif sys.argv[1] == "summary":
+        print(summarize(load_results()).to_string(index=False))
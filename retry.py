@@ -0,0 +1,101 @@
+"""Retries and client-side rate limiting shared by every service.
+
+RetryPolicy decides whether a failed request is retried and how long to wait: exponential backoff with full jitter,
+but never less than the Retry-After the service asked for. A TokenBucket per service (see get_limiter) is shared by
+all workers of a run, so the run as a whole stays at the allowed request rate instead of every worker hammering the
+service until it gets throttled. A 429 with Retry-After pauses the whole bucket, not just the worker that got it.
+"""
+
+import os
+import random
+import threading
+import time
+
+# Throttling, timeouts and server errors are worth retrying; None is a failure without a status (connection error)
+RETRYABLE_STATUS_CODES = {None, 408, 429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header. HTTP dates are not used by any of the services and are ignored."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, seed=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = random.Random(seed)
+
+    def should_retry(self, err, attempt):
+        return attempt < self.max_attempts and err.status_code in RETRYABLE_STATUS_CODES
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before attempt `attempt + 1`."""
+        backoff = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+# Used by the accuracy runs unless they are given another policy. Sweeps and load tests do not retry.
+DEFAULT_POLICY = RetryPolicy(max_attempts=5, base_delay=2.0, max_delay=60.0)
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average with bursts of up to `burst`. reserve() takes a token right away
+    and returns how long the caller has to wait before using it, so blocking and asyncio callers can share one
+    bucket."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Holds every caller back for `seconds`, e.g. after a 429 with Retry-After."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(service, rate=None, burst=None):
+    """The TokenBucket shared by every worker calling `service`, or None if the service is not rate limited. Without
+    an explicit rate, {SERVICE}_RATE_LIMIT (requests per second) and {SERVICE}_RATE_BURST are read from the
+    environment, e.g. HG_RATE_LIMIT=5."""
+    if rate is None and os.getenv(f"{service.upper()}_RATE_LIMIT"):
+        rate = float(os.getenv(f"{service.upper()}_RATE_LIMIT"))
+        burst = float(os.getenv(f"{service.upper()}_RATE_BURST", rate))
+    if rate is None:
+        return None
+    with _limiters_lock:
+        limiter = _limiters.get(service)
+        if limiter is None or (limiter.rate, limiter.burst) != (float(rate), float(burst or max(1.0, rate))):
+            _limiters[service] = TokenBucket(rate, burst)
+        return _limiters[service]
@@ -0,0 +1,270 @@
+"""Shared runner for every service adapter (see service_adapter.py).
+
+Handles reading the test list, resuming from the results journal, concurrency, timing, retries and persistence, so
+each service only has to implement prepare/send/parse. Requests are driven by asyncio with a bounded number in
+flight; the service SDKs are blocking, so each request runs on a worker thread and is timed on that thread, which
+keeps the latency independent of how busy the event loop is.
+
+Accuracy runs write rows [filename, actual_class, predicted_class, confidence, invoke_time, connection_reused,
+attempts, start_ns, first_byte_ns, end_ns, payload_bytes, status] to
+data/{dataset}/results/{dataset}-{service}-results-{ablation}.csv. Every service is timed the same way, with
+time.perf_counter_ns around adapter.send of the attempt that succeeded: start_ns/first_byte_ns/end_ns are the raw
+timestamps (only comparable within one run) and invoke_time is (end_ns - start_ns) in seconds. first_byte_ns and
+connection_reused are empty for services whose SDK does not expose them. payload_bytes is the size of the request
+body (adapter.payload_size), so runs with a PayloadTransform (payload_cache.py) record what they actually uploaded.
+status is "ok" for a prediction; a request that still fails after its retries gets a row with only filename,
+actual_class and attempts, and service_adapter.error_status as its status, and is tried again on the next run.
+Retries and rate limiting are in retry.py. Latencies also go into a LatencySketch (latency_sketch.py) that is stored
+next to the results.
+"""
+
+import asyncio
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow.compute as pc
+from tqdm import tqdm
+
+from latency_sketch import SUMMARY_QUANTILES, LatencySketch, sketch_file
+from results_journal import ResultsJournal
+from results_store import import_results_csv, read_results_csv
+from retry import DEFAULT_POLICY, get_limiter
+from service_adapter import ServiceError, error_status
+
+
+def read_test_rows(test_file, limit=None):
+    rows = []
+    with open(test_file) as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            if row[1] == "label":
+                continue
+            # vertex and azure test files carry the full bucket uri, the others just the filename
+            rows.append((row[0].split("/")[-1], row[1]))
+            if limit is not None and len(rows) == limit:
+                break
+    return rows
+
+
+def invoke_one(adapter, filename, label, policy=DEFAULT_POLICY, limiter=None):
+    """Sends one image and returns (predicted_class, confidence, invoke_time, connection_reused, attempts, start_ns,
+    first_byte_ns, end_ns, payload_bytes). invoke_time is the latency of the attempt that succeeded; failed attempts
+    and backoff only show up in attempts. Only adapter.send is timed."""
+    payload = adapter.prepare(filename, label)
+    payload_bytes = adapter.payload_size(payload)
+    (prediction, confidence), attempt, start, end = send_with_retries(
+        adapter.send, adapter.parse, payload, filename, policy, limiter
+    )
+    # Both are per-thread state of the last send, which is the attempt that succeeded
+    first_byte = adapter.first_byte_ns()
+    reused = adapter.connection_reused()
+    return prediction, confidence, (end - start) / 1e9, reused, attempt, start, first_byte, end, payload_bytes
+
+
+def send_with_retries(send, parse, payload, description, policy=DEFAULT_POLICY, limiter=None):
+    """Calls parse(send(payload)) until it succeeds or policy gives up on the ServiceError it raised, and returns
+    (parsed, attempts, start_ns, end_ns) with the send of the successful attempt timed. Used by invoke_one and by
+    callers that send something other than one image, like vertex.batch_invoke."""
+    attempt = 0
+    while True:
+        attempt += 1
+        if limiter is not None:
+            limiter.acquire()
+        start = time.perf_counter_ns()
+        try:
+            response = send(payload)
+            end = time.perf_counter_ns()
+            parsed = parse(response)
+        except ServiceError as err:
+            delay = _backoff(policy, limiter, description, err, attempt)
+            time.sleep(delay)
+            continue
+        return parsed, attempt, start, end
+
+
+async def invoke_one_async(adapter, filename, label, policy=DEFAULT_POLICY, limiter=None):
+    """Same as invoke_one, but awaits adapter.send_async on the event loop. Reading and encoding the image still
+    runs on a worker thread."""
+    payload = await asyncio.get_running_loop().run_in_executor(None, adapter.prepare, filename, label)
+    payload_bytes = adapter.payload_size(payload)
+    attempt = 0
+    while True:
+        attempt += 1
+        if limiter is not None:
+            await asyncio.sleep(limiter.reserve())
+        start = time.perf_counter_ns()
+        try:
+            response = await adapter.send_async(payload)
+            end = time.perf_counter_ns()
+            prediction, confidence = adapter.parse(response)
+        except ServiceError as err:
+            delay = _backoff(policy, limiter, filename, err, attempt)
+            await asyncio.sleep(delay)
+            continue
+        return prediction, confidence, (end - start) / 1e9, None, attempt, start, None, end, payload_bytes
+
+
+def _backoff(policy, limiter, filename, err, attempt):
+    """Re-raises err, with the number of attempts made as err.attempts, if it should not be retried, otherwise
+    returns the seconds to wait before the next attempt. A 429 also pauses the shared limiter so the other workers
+    back off too."""
+    if not policy.should_retry(err, attempt):
+        err.attempts = attempt
+        raise err
+    delay = policy.delay(attempt, err.retry_after)
+    if limiter is not None and err.status_code == 429:
+        limiter.pause(delay)
+    print(f"Request failed for {filename}: {err}. Retry {attempt} in {delay:.1f} seconds")
+    return delay
+
+
+def failed_row(filename, label, err):
+    """Results row of a request that failed for good. attempts is empty unless the error ran out of retries."""
+    return [filename, label, "", "", "", "", getattr(err, "attempts", ""), "", "", "", "", error_status(err)]
+
+
+def _resume_sketch(adapter, ablationSize, journal):
+    """The stored sketch of an accuracy run, rebuilt from the results file if it does not cover every journaled
+    prediction (e.g. after a crash)."""
+    path = sketch_file(adapter.dataset, adapter.run_name(), ablationSize)
+    if os.path.exists(path):
+        sketch = LatencySketch.load(path)
+        if sketch.count == len(journal):
+            return sketch
+    sketch = LatencySketch()
+    if len(journal):
+        journal.flush()
+        latencies = pc.drop_null(read_results_csv(journal.path)["latency_ns"])
+        sketch.add_many(latencies.to_numpy() / 1e9)
+    return sketch
+
+
+def _print_quantiles(sketch):
+    quantiles = sketch.quantiles(SUMMARY_QUANTILES)
+    print("Latency " + ", ".join(f"p{100 * q:g}: {value:.3f}s" for q, value in zip(SUMMARY_QUANTILES, quantiles)))
+
+
+async def run_concurrently(call, rows, concurrency, on_result, on_error):
+    """Calls call(filename, label) for every row, `concurrency` at a time, and hands each outcome to on_result or
+    on_error. Any exception of a call (a ServiceError that ran out of retries, but also e.g. a KeyError from parse or
+    a ValueError from prepare) only fails that row; the other requests keep going."""
+    loop = asyncio.get_running_loop()
+    # Rows are pulled one at a time as workers free up, so `rows` can be a lazy iterator
+    rows = iter(rows)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def _worker():
+            for filename, label in rows:
+                try:
+                    if asyncio.iscoroutinefunction(call):
+                        result = await call(filename, label)
+                    else:
+                        result = await loop.run_in_executor(executor, call, filename, label)
+                except Exception as err:
+                    on_error(filename, label, err)
+                else:
+                    on_result(filename, label, result)
+
+        await asyncio.gather(*[_worker() for _ in range(concurrency)])
+
+
+def run_invoke(adapter, ablationSize, concurrency=1, policy=DEFAULT_POLICY, use_send_async=False, rate_limit=None):
+    """Runs the accuracy evaluation over every test image that is not already in the results file, with at most
+    `concurrency` requests in flight. Failed requests are retried according to `policy`; images that still fail are
+    journaled with their error and picked up again on the next run. With `rate_limit` (requests per
+    second, or {SERVICE}_RATE_LIMIT in the environment) all workers share one token bucket. With use_send_async the
+    adapter's native async client is used instead of worker threads."""
+    concurrency = int(concurrency)
+    limiter = get_limiter(adapter.name, rate_limit)
+    accurate = 0
+    total = 0
+    errors = 0
+    reused = 0
+    retries = 0
+
+    with ResultsJournal(adapter.results_file(ablationSize)) as journal:
+        rows = [row for row in read_test_rows(adapter.test_file()) if row[0] not in journal]
+        print(f"{len(journal)} already done, {len(rows)} to go at concurrency {concurrency}")
+        sketch = _resume_sketch(adapter, ablationSize, journal)
+        progress = tqdm(total=len(rows))
+
+        def _on_result(filename, label, result):
+            nonlocal accurate, total, reused, retries
+            prediction, _, latency, connection_reused, attempts = result[:5]
+            journal.append([filename, label, *result, "ok"])
+            sketch.add(latency)
+            reused += connection_reused is True
+            retries += attempts - 1
+            if str(prediction) == str(label):
+                accurate += 1
+            total += 1
+            progress.update(1)
+            progress.set_postfix(accuracy=accurate / total)
+
+        def _on_error(filename, label, err):
+            nonlocal errors
+            print(f"Invalid response {err} {filename=} {label=}")
+            journal.append(failed_row(filename, label, err))
+            errors += 1
+            progress.update(1)
+
+        def _call(filename, label):
+            return invoke_one(adapter, filename, label, policy, limiter)
+
+        async def _call_async(filename, label):
+            return await invoke_one_async(adapter, filename, label, policy, limiter)
+
+        call = _call_async if use_send_async else _call
+        asyncio.run(run_concurrently(call, rows, concurrency, _on_result, _on_error))
+        progress.close()
+    import_results_csv(adapter.results_file(ablationSize))
+    sketch.save(sketch_file(adapter.dataset, adapter.run_name(), ablationSize))
+
+    if total:
+        print(f"Accuracy: {accurate/total}")
+        print(f"Accurate: {accurate}")
+        print(f"Total: {total}")
+        print(f"Requests on a reused connection: {reused}")
+        print(f"Retries: {retries}")
+        _print_quantiles(sketch)
+    if errors:
+        print(f"Failed: {errors}")
+
+
+def run_parallel(adapter, ablationSize, n_requests=1000, concurrency=10, policy=DEFAULT_POLICY, rate_limit=None):
+    """Calls the endpoint with the first `n_requests` test images, `concurrency` at a time, to check throughput."""
+    concurrency = int(concurrency)
+    limiter = get_limiter(adapter.name, rate_limit)
+    rows = read_test_rows(adapter.test_file(), limit=n_requests)
+    progress = tqdm(total=len(rows))
+    retries = 0
+    errors = 0
+    sketch = LatencySketch()
+
+    def _on_result(filename, label, result):
+        nonlocal retries
+        retries += result[4] - 1
+        sketch.add(result[2])
+        progress.update(1)
+
+    def _on_error(filename, label, err):
+        nonlocal errors
+        print(f"Invalid response {err} {filename=} {label=}")
+        errors += 1
+        progress.update(1)
+
+    def _call(filename, label):
+        return invoke_one(adapter, filename, label, policy, limiter)
+
+    start = time.perf_counter_ns()
+    asyncio.run(run_concurrently(_call, rows, concurrency, _on_result, _on_error))
+    duration = (time.perf_counter_ns() - start) / 1e9
+    progress.close()
+    print(f"Time to {len(rows)} invokes {adapter.dataset}-{ablationSize}: {duration}")
+    print(f"Retries: {retries}, failed: {errors}")
+    _print_quantiles(sketch)
+    sketch.save(sketch_file(adapter.dataset, adapter.run_name(), ablationSize, kind="parallel"))
+    return duration
@@ -0,0 +1,127 @@
+"""Concurrent upload of local files to S3 through one shared transfer manager.
+
+All files go through a single s3transfer TransferManager, so `workers` requests are in flight at once over one
+connection pool, and files above multipart_threshold are split into parts that are uploaded in parallel too.
+
+A file is skipped when its key is already in the bucket with the same size and ETag. The bucket is listed once per
+prefix; the local ETag is the MD5 of the file for single-part uploads and the MD5 of the part MD5s plus "-{parts}" for
+multipart ones, which is what S3 reports for objects uploaded with the same part size. A CSV manifest of
+[key, size, mtime_ns, etag] for everything uploaded or found up to date saves hashing unchanged files again on the
+next run.
+"""
+
+import csv
+import hashlib
+import os
+import time
+
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from tqdm import tqdm
+
+MB = 1024 * 1024
+
+
+def local_etag(path, multipart_threshold=8 * MB, multipart_chunksize=8 * MB):
+    """The ETag S3 gives the file when it is uploaded with this transfer config."""
+    if os.path.getsize(path) < multipart_threshold:
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(MB), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    part_digests = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(multipart_chunksize), b""):
+            part_digests.append(hashlib.md5(chunk).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def list_existing(s3, bucket_name, prefixes):
+    """{key: (size, etag)} of every object under the given prefixes."""
+    existing = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                existing[obj["Key"]] = (obj["Size"], obj["ETag"].strip('"'))
+    return existing
+
+
+def read_manifest(path):
+    manifest = {}
+    if path is not None and os.path.exists(path):
+        with open(path, newline="") as f:
+            for key, size, mtime_ns, etag in csv.reader(f):
+                manifest[key] = (int(size), int(mtime_ns), etag)
+    return manifest
+
+
+def write_manifest(path, manifest):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(f"{path}.tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        for key in sorted(manifest):
+            writer.writerow([key, *manifest[key]])
+    os.replace(f"{path}.tmp", path)
+
+
+def bulk_upload(
+    s3,
+    bucket_name,
+    files,
+    manifest_path=None,
+    workers=16,
+    multipart_threshold=8 * MB,
+    multipart_chunksize=8 * MB,
+    md5_of=None,
+):
+    """Uploads [(local_path, key)] whose object is missing or differs, `workers` requests at a time. md5_of
+    optionally maps a local path to its known MD5 hex digest (image_store.md5_lookup), which is the ETag of a
+    single-part upload. Returns (uploaded, skipped, bytes_uploaded, seconds)."""
+    prefixes = sorted({key.rsplit("/", 1)[0] + "/" if "/" in key else "" for _, key in files})
+    existing = list_existing(s3, bucket_name, prefixes)
+    manifest = read_manifest(manifest_path)
+
+    config = TransferConfig(
+        max_concurrency=workers, multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize
+    )
+    progress = tqdm(total=len(files))
+    start = time.perf_counter()
+    futures = []
+    skipped = 0
+    total_bytes = 0
+    try:
+        with create_transfer_manager(s3, config) as manager:
+            for path, key in files:
+                stat = os.stat(path)
+                if key in manifest and manifest[key][:2] == (stat.st_size, stat.st_mtime_ns):
+                    etag = manifest[key][2]
+                elif md5_of is not None and stat.st_size < multipart_threshold and md5_of(path) is not None:
+                    etag = md5_of(path)
+                else:
+                    etag = local_etag(path, multipart_threshold, multipart_chunksize)
+                if existing.get(key) == (stat.st_size, etag):
+                    manifest[key] = (stat.st_size, stat.st_mtime_ns, etag)
+                    skipped += 1
+                    progress.update(1)
+                    continue
+                futures.append((manager.upload(path, bucket_name, key), key, stat, etag))
+
+            for future, key, stat, etag in futures:
+                future.result()
+                manifest[key] = (stat.st_size, stat.st_mtime_ns, etag)
+                total_bytes += stat.st_size
+                progress.update(1)
+    finally:
+        # Keep what did make it to the bucket even if an upload failed
+        if manifest_path is not None:
+            write_manifest(manifest_path, manifest)
+    duration = time.perf_counter() - start
+    progress.close()
+
+    print(
+        f"Uploaded {len(futures)} files ({total_bytes / 1e6:.1f} MB) to s3://{bucket_name} in {duration:.1f}s, "
+        f"{total_bytes / 1e6 / max(duration, 1e-9):.2f} MB/s, {skipped} already up to date"
+    )
+    return len(futures), skipped, total_bytes, duration
@@ -0,0 +1,99 @@
+"""Base class for the per-service adapters used by runner.py.
+
+An adapter only knows how to talk to one service: turn a test image into a request payload (prepare), send it
+(send) and pull the top-1 class and its confidence out of the response (parse). Reading the test list, resuming,
+concurrency, timing, retries and writing results are handled once in runner.py for every service. When a
+PayloadTransform is set (see payload_cache.py), prepare starts from the resized/recompressed image instead of the file.
+"""
+
+from packed_store import open_packed
+from payload_cache import open_payloads, transform_from_env
+
+
+class ServiceError(Exception):
+    """Raised by ServiceAdapter.send when the service returned an error instead of a prediction. retry_after is the
+    number of seconds the service asked us to wait (Retry-After header), if any."""
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def error_status(err):
+    """How a failed request is recorded: the HTTP status code, "connection" for a failure without a response (refused
+    or reset connection, timeout) and the exception type for anything else, e.g. a KeyError from parse."""
+    if isinstance(err, ServiceError):
+        return "connection" if err.status_code is None else str(err.status_code)
+    return type(err).__name__
+
+
+class ServiceAdapter:
+    # Name used in the results file, data/{dataset}/results/{dataset}-{name}-results-{ablation}.csv (see run_name)
+    name = None
+    # Suffix of the test list written by create_tests.py, data/{dataset}/{dataset}_test_{test_suffix}.csv
+    test_suffix = None
+
+    def __init__(self, dataset, transform=None):
+        self.dataset = dataset
+        # Defaults to the transform configured with PAYLOAD_MAX_DIMENSION / PAYLOAD_QUALITY, if any
+        self.transform = transform if transform is not None else transform_from_env()
+
+    def test_file(self):
+        return f"data/{self.dataset}/{self.dataset}_test_{self.test_suffix}.csv"
+
+    def run_name(self):
+        """Service name in the files written by a run. Runs with a transform are a different experiment and get its
+        key appended, e.g. hg+max1024-q85-noexif, so they are journaled and resumed separately from the originals."""
+        if self.transform is None:
+            return self.name
+        return f"{self.name}+{self.transform.key()}"
+
+    def results_file(self, ablationSize):
+        return f"data/{self.dataset}/results/{self.dataset}-{self.run_name()}-results-{str(ablationSize)}.csv"
+
+    def image_path(self, filename, label):
+        return f"data/{self.dataset}/test/{label}/{filename}"
+
+    def image_bytes(self, filename, label):
+        """The test image, as a zero-copy memoryview into the packed test split if there is one (see packed_store.py),
+        otherwise read from its file. With a transform, the cached transformed payload of the image."""
+        if self.transform is not None:
+            payloads = open_payloads(self.dataset, self.transform)
+            return payloads.get(filename, label, lambda: self._source_bytes(filename, label))
+        return self._source_bytes(filename, label)
+
+    def _source_bytes(self, filename, label):
+        store = open_packed(self.dataset, "test")
+        if store is not None and (label, filename) in store:
+            return store.get(filename, label)
+        with open(self.image_path(filename, label), "rb") as f:
+            return f.read()
+
+    def prepare(self, filename, label):
+        return self.image_bytes(filename, label)
+
+    def payload_size(self, payload):
+        """Bytes on the wire for a prepared payload, recorded with every result."""
+        return len(payload)
+
+    def send(self, payload):
+        raise NotImplementedError
+
+    async def send_async(self, payload):
+        """Optional asyncio version of send for services with a native async client. runner.run_invoke awaits it on
+        the event loop instead of calling send on a worker thread when use_send_async=True."""
+        raise NotImplementedError
+
+    def connection_reused(self):
+        """Whether the last send on the calling thread went out on a kept-alive connection, None if not known."""
+        return None
+
+    def first_byte_ns(self):
+        """time.perf_counter_ns when the first byte of the last response on the calling thread arrived, None if the
+        SDK does not expose it."""
+        return None
+
+    def parse(self, response):
+        """Returns (predicted_class, confidence). Services that return no label above threshold map to ("none", 0.0)."""
+        raise NotImplementedError
@@ -1,6 +1,11 @@
+import csv
+import json
+import os
 import pytest
 from collections import Counter
 
+from ablation_manifest import ablation_rows, csv_text, manifest_ablations, read_manifest, render_view
+
 ablation_sizes_by_dataset = {
     "beans": [320, 80, 20, 5],
     "cars": [20, 5],
@@ -27,24 +32,72 @@ def dataset(request):
     return request.param
 
 
+# Bucket prefixes the provider views are rendered with; the tests strip them again
+URIS = ("gs://argot-xrays", "azureml://training_uploads/", "azureml://val_uploads/")
+
+_manifests = {}
+
+
+def manifest(dataset):
+    if dataset not in _manifests:
+        _manifests[dataset] = read_manifest(dataset)
+    return _manifests[dataset]
+
+
+def ablation_lines(dataset, ablation_size, split):
+    """The lines of the {split} list of an ablation, as create_ablations.py used to write them."""
+    return csv_text(ablation_rows(dataset, ablation_size, split, manifest(dataset))).splitlines(keepends=True)
+
+
+def view_lines(dataset, ablation_size, split, view):
+    """The lines of a provider list rendered from the manifest, as ablation_manifest.py render writes them."""
+    train = ablation_rows(dataset, ablation_size, "train", manifest(dataset))
+    val = ablation_rows(dataset, ablation_size, "val", manifest(dataset))
+    return render_view(train, val, split, view, *URIS)[1].splitlines(keepends=True)
+
+
+_listings = {}
+
+
+def listing(dataset, split, cls):
+    """The image files in data/{dataset}/{split}/{cls}, listed once per test session."""
+    if (dataset, split, cls) not in _listings:
+        path = f"data/{dataset}/{split}/{cls}"
+        _listings[(dataset, split, cls)] = set(os.listdir(path)) if os.path.isdir(path) else set()
+    return _listings[(dataset, split, cls)]
+
+
+def view_pairs(lines, view):
+    """(filename, label) of every image in a rendered provider list, with the bucket prefix stripped."""
+    if view == "azure":
+        rows = [(entry["image_url"], entry["label"]) for entry in map(json.loads, lines)]
+    else:
+        rows = list(csv.reader(lines))
+        if view == "hg":
+            rows = rows[1:]
+    return [(uri.split("/")[-1], label) for uri, label in rows]
+
+
 def train_ablation(dataset, ablation_size):
-    return f"data/{dataset}/ablations/{dataset}_train_{ablation_size}.csv"
+    return ablation_lines(dataset, ablation_size, "train")
 
 
 def val_ablation(dataset, ablation_size):
-    return f"data/{dataset}/ablations/{dataset}_val_{ablation_size}.csv"
+    return ablation_lines(dataset, ablation_size, "val")
+
+
+def test_manifest_ablations(dataset):
+    assert manifest_ablations(manifest(dataset)) == sorted(ablation_sizes_by_dataset[dataset], reverse=True)
 
 
 def test_ablation_files_correct_size(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     n_classes = n_classes_by_datasets[dataset]
     for ablation_size_index in range(len(ablation_sizes)):
-        with open(train_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data_train = ablation_file.readlines()
+        ablation_data_train = train_ablation(dataset, ablation_sizes[ablation_size_index])
         assert len(ablation_data_train) == n_classes * ablation_sizes[ablation_size_index] * 0.8
 
-        with open(val_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data_val = ablation_file.readlines()
+        ablation_data_val = val_ablation(dataset, ablation_sizes[ablation_size_index])
         assert len(ablation_data_val) == n_classes * ablation_sizes[ablation_size_index] * 0.2
 
 
@@ -53,10 +106,8 @@ def test_no_split_mixing(dataset):
     with open(f"data/{dataset}/{dataset}_test_nyckel.csv") as ablation_file:
         ablation_data_test = ablation_file.readlines()
     for ablation_size_index in range(len(ablation_sizes)):
-        with open(train_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data_train = ablation_file.readlines()
-        with open(val_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data_val = ablation_file.readlines()
+        ablation_data_train = train_ablation(dataset, ablation_sizes[ablation_size_index])
+        ablation_data_val = val_ablation(dataset, ablation_sizes[ablation_size_index])
         for entry in ablation_data_train:
             assert entry not in ablation_data_test
             assert entry not in ablation_data_val
@@ -71,10 +122,8 @@ def test_ablations_are_cumulative(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     ablation_sizes.sort()
     for ablation_size_index in range(len(ablation_sizes) - 1):
-        with open(train_ablation(dataset, ablation_sizes[ablation_size_index + 1])) as ablation_file:
-            larger_ablation_data = ablation_file.readlines()
-        with open(train_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            smaller_ablation_data = ablation_file.readlines()
+        larger_ablation_data = train_ablation(dataset, ablation_sizes[ablation_size_index + 1])
+        smaller_ablation_data = train_ablation(dataset, ablation_sizes[ablation_size_index])
         for entry in smaller_ablation_data:
             assert entry in larger_ablation_data
 
@@ -82,8 +131,7 @@ def test_ablations_are_cumulative(dataset):
 def test_ablations_are_balanced(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     for ablation_size_index in range(len(ablation_sizes)):
-        with open(train_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data = ablation_file.readlines()
+        ablation_data = train_ablation(dataset, ablation_sizes[ablation_size_index])
         class_names = [entry.split(",")[1].rstrip().lstrip() for entry in ablation_data]
         counts = Counter(class_names)
         for count in counts.values():
@@ -93,14 +141,9 @@ def test_ablations_are_balanced(dataset):
 def test_nyckel_files(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     for ablation_size_index in range(len(ablation_sizes)):
-        with open(train_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data_train = ablation_file.readlines()
-        with open(val_ablation(dataset, ablation_sizes[ablation_size_index])) as ablation_file:
-            ablation_data_val = ablation_file.readlines()
-        with open(
-            f"data/{dataset}/ablations/{dataset}_train_nyckel_{ablation_sizes[ablation_size_index]}.csv"
-        ) as ablation_file:
-            ablation_data_nyckel = ablation_file.readlines()
+        ablation_data_train = train_ablation(dataset, ablation_sizes[ablation_size_index])
+        ablation_data_val = val_ablation(dataset, ablation_sizes[ablation_size_index])
+        ablation_data_nyckel = view_lines(dataset, ablation_sizes[ablation_size_index], "train", "nyckel")
         for entry in ablation_data_nyckel:
             assert entry in ablation_data_train + ablation_data_val
 
@@ -109,14 +152,8 @@ def test_vertex_files(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     for split in ["train", "val"]:
         for ablation_size_index in range(len(ablation_sizes)):
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                ablation_data = ablation_file.readlines()
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_vertex_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                vertex_data = ablation_file.readlines()
+            ablation_data = ablation_lines(dataset, ablation_sizes[ablation_size_index], split)
+            vertex_data = view_lines(dataset, ablation_sizes[ablation_size_index], split, "vertex")
             vertex_data = [entry.removeprefix("gs://argot-xrays/training_uploads/") for entry in vertex_data]
             vertex_data = [entry.removeprefix("gs://argot-xrays/val_uploads/") for entry in vertex_data]
             assert set(vertex_data) == set(ablation_data), f"failed on {split} {ablation_size_index}"
@@ -126,14 +163,8 @@ def test_huggingface_files(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     for split in ["train", "val"]:
         for ablation_size_index in range(len(ablation_sizes)):
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                ablation_data = ablation_file.readlines()
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_hg_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                hf_data = ablation_file.readlines()
+            ablation_data = ablation_lines(dataset, ablation_sizes[ablation_size_index], split)
+            hf_data = view_lines(dataset, ablation_sizes[ablation_size_index], split, "hg")
             hf_data = hf_data[1:]  # Pop header
             assert set(hf_data) == set(ablation_data), f"failed on {split} {ablation_size_index}"
 
@@ -142,14 +173,8 @@ def test_aws_files(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     for split in ["train", "val"]:
         for ablation_size_index in range(len(ablation_sizes)):
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                ablation_data = ablation_file.readlines()
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_aws_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                aws_data = ablation_file.readlines()
+            ablation_data = ablation_lines(dataset, ablation_sizes[ablation_size_index], split)
+            aws_data = view_lines(dataset, ablation_sizes[ablation_size_index], split, "aws")
             assert set(aws_data) == set(ablation_data), f"failed on {split} {ablation_size_index}"
 
 
@@ -157,15 +182,27 @@ def test_azure_files(dataset):
     ablation_sizes = ablation_sizes_by_dataset[dataset]
     for split in ["train", "val"]:
         for ablation_size_index in range(len(ablation_sizes)):
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                ablation_data = ablation_file.readlines()
-            with open(
-                f"data/{dataset}/ablations/{dataset}_{split}_azure_{ablation_sizes[ablation_size_index]}.csv"
-            ) as ablation_file:
-                azure_data = ablation_file.readlines()
-            azure_data = azure_data[1:]  # Pop header
-            azure_data = [entry.removeprefix("azureml://training_uploads/") for entry in azure_data]
-            azure_data = [entry.removeprefix("azureml://val_uploads/") for entry in azure_data]
+            ablation_data = ablation_lines(dataset, ablation_sizes[ablation_size_index], split)
+            azure_data = view_lines(dataset, ablation_sizes[ablation_size_index], split, "azure")
+            azure_data = [json.loads(entry) for entry in azure_data]
+            azure_data = [(entry["image_url"], entry["label"]) for entry in azure_data]
+            azure_data = [(url.removeprefix("azureml://training_uploads/"), label) for url, label in azure_data]
+            azure_data = [(url.removeprefix("azureml://val_uploads/"), label) for url, label in azure_data]
+            azure_data = csv_text(azure_data).splitlines(keepends=True)
             assert set(azure_data) == set(ablation_data), f"failed on {split} {ablation_size_index}"
+
+
+def test_views_match_split_directories(dataset):
+    """Every image of every provider list is in the train folder of its label and not in the test folder, and each
+    class has the expected number of images, checked against the directories rather than the manifest."""
+    classes = sorted(os.listdir(f"data/{dataset}/train"))
+    for ablation_size in ablation_sizes_by_dataset[dataset]:
+        for split, fraction in [("train", 0.8), ("val", 0.2)]:
+            for view in ["vertex", "hg", "aws", "azure"]:
+                pairs = view_pairs(view_lines(dataset, ablation_size, split, view), view)
+                for filename, label in pairs:
+                    assert filename in listing(dataset, "train", label), f"{view} {split} {ablation_size}: {label}"
+                    assert filename not in listing(dataset, "test", label), f"{view} {split} {ablation_size}"
+                counts = Counter(label for _, label in pairs)
+                assert sorted(counts) == classes, f"{view} {split} {ablation_size}"
+                assert set(counts.values()) == {ablation_size * fraction}, f"{view} {split} {ablation_size}"
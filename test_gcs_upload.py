@@ -0,0 +1,68 @@
+import threading
+
+from gcs_upload import bulk_upload, folder_files, local_md5
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_filename(self, path):
+        with open(path, "rb") as f:
+            content = f.read()
+        with self.bucket.client.lock:
+            self.bucket.client.objects[self.name] = (len(content), local_md5(path))
+            self.bucket.client.uploads.append(self.name)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeListedBlob:
+    def __init__(self, name, size, md5_hash):
+        self.name = name
+        self.size = size
+        self.md5_hash = md5_hash
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.listings = []
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def list_blobs(self, bucket_name, prefix=None):
+        self.listings.append(prefix)
+        return [FakeListedBlob(name, *meta) for name, meta in self.objects.items() if name.startswith(prefix or "")]
+
+
+def test_bulk_upload_skips_unchanged_objects(tmp_path):
+    for folder in ["training_uploads", "test_uploads"]:
+        (tmp_path / folder).mkdir()
+        for i in range(5):
+            (tmp_path / folder / f"{i}.jpg").write_bytes(f"{folder}-{i}".encode())
+    files = folder_files(f"{tmp_path}/training_uploads", "training_uploads")
+    files += folder_files(f"{tmp_path}/test_uploads", "test_uploads")
+    client = FakeStorageClient()
+
+    uploaded, skipped, _, _ = bulk_upload(client, "bucket", files, workers=4)
+    assert (uploaded, skipped) == (10, 0)
+    assert sorted(client.listings) == ["test_uploads/", "training_uploads/"]
+
+    # Same size, different content: only the MD5 tells them apart
+    (tmp_path / "test_uploads" / "0.jpg").write_bytes(b"test_uploads-9")
+    client.uploads = []
+    uploaded, skipped, _, _ = bulk_upload(client, "bucket", files, workers=4)
+    assert (uploaded, skipped) == (1, 9)
+    assert client.uploads == ["test_uploads/0.jpg"]
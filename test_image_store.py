@@ -0,0 +1,33 @@
+import hashlib
+import os
+
+from image_store import build_store, image_source, md5_lookup, read_index
+from materialize import materialize_all
+
+
+def test_store_deduplicates_and_feeds_uploaders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for split, label, filename, content in [
+        ("train", "cat", "1.jpg", b"same"),
+        ("train", "dog", "2.jpg", b"same"),
+        ("test", "cat", "3.jpg", b"other"),
+    ]:
+        os.makedirs(f"data/ds/{split}/{label}", exist_ok=True)
+        with open(f"data/ds/{split}/{label}/{filename}", "wb") as f:
+            f.write(content)
+
+    build_store("ds")
+    index = read_index("ds")
+    assert len(index) == 3 and len({entry[0] for entry in index.values()}) == 2
+    # The store is the only copy: duplicates and their object are one inode, and the images stay writable
+    assert image_source("ds", "train", "cat", "1.jpg") == image_source("ds", "train", "dog", "2.jpg")
+    assert os.path.samefile("data/ds/train/dog/2.jpg", image_source("ds", "train", "cat", "1.jpg"))
+    assert os.path.samefile("data/ds/train/cat/1.jpg", "data/ds/train/dog/2.jpg")
+    assert all(os.stat(f"data/ds/{key[0]}/{key[1]}/{key[2]}").st_mode & 0o200 for key in index)
+    build_store("ds")
+    assert read_index("ds") == index
+
+    source = image_source("ds", "test", "cat", "3.jpg")
+    assert source.startswith("data/image_store/")
+    materialize_all([(source, "data/ds/test_uploads/3.jpg")])
+    assert md5_lookup("ds")("data/ds/test_uploads/3.jpg") == hashlib.md5(b"other").hexdigest()
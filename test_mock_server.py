@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from aws_rekognition import RekognitionAdapter
+from azure_ml import AzureAdapter
+from huggingface import HuggingfaceAdapter
+from load_generator import _run_open_loop
+from mock_server import make_server
+from nyckel import NyckelAdapter
+from payload_cache import PayloadTransform
+from results_journal import ResultsJournal
+from results_store import load_results
+from retry import NO_RETRY, RetryPolicy, TokenBucket, get_limiter
+from runner import invoke_one, run_concurrently, run_invoke
+from service_adapter import ServiceError
+from vertex import VertexAdapter, encode_instance
+
+LABELS = ["cat", "dog"]
+
+
+@pytest.fixture
+def mock_url(request):
+    options = getattr(request, "param", {})
+    server = make_server(0, labels=LABELS, latency_ms=1, seed=0, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_huggingface_and_nyckel_shapes(mock_url):
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    prediction, confidence = hf.parse(hf.send(b"image"))
+    assert prediction in LABELS and 0 <= confidence <= 1
+
+    nyckel = NyckelAdapter("mock", "token", "function")
+    nyckel.url = f"{mock_url}/v1/functions/function/invoke"
+    prediction, confidence = nyckel.parse(nyckel.send(b"image"))
+    assert prediction in LABELS and 0 <= confidence <= 1
+
+
+def test_vertex_rest_shape(mock_url):
+    vertex = VertexAdapter("mock", "project", "endpoint", api_endpoint=mock_url)
+    assert vertex.clients.transport == "rest"
+    prediction, confidence = vertex.parse(vertex.send(encode_instance(b"image")))
+    assert prediction in LABELS and 0 <= confidence <= 1
+    # The async client is gRPC only, which the mock does not speak
+    with pytest.raises(ValueError, match="only speaks REST"):
+        asyncio.run(vertex.send_async(encode_instance(b"image")))
+
+
+def test_rekognition_json_shape(mock_url, monkeypatch):
+    monkeypatch.setenv("AWS_ENDPOINT_URL", mock_url)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "mock")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "mock")
+    rekognition = RekognitionAdapter("mock", "arn:aws:rekognition:us-west-2:0:project/mock/version/mock/0")
+    prediction, confidence = rekognition.parse(rekognition.send(b"\xff\xd8\xff image"))
+    assert prediction in LABELS and 0 <= confidence <= 100
+
+
+def test_azure_score_shape(mock_url):
+    azure = AzureAdapter("mock", f"{mock_url}/score")
+    payload = json.dumps({"input_data": {"columns": ["image"], "index": [0], "data": ["aW1hZ2U="]}})
+    prediction, confidence = azure.parse(azure.send(payload))
+    assert prediction in LABELS and 0 <= confidence <= 1
+
+
+def test_keep_alive(mock_url):
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf", pool_size=1)
+    reused = []
+    for _ in range(3):
+        hf.send(b"image")
+        reused.append(hf.connection_reused())
+    assert reused == [False, True, True]
+
+
+@pytest.mark.parametrize("mock_url", [{"rate_limit": 1, "burst": 2}], indirect=True)
+def test_rate_limit(mock_url):
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    hf.send(b"image")
+    hf.send(b"image")
+    with pytest.raises(ServiceError) as err:
+        hf.send(b"image")
+    assert err.value.status_code == 429
+
+
+@pytest.mark.parametrize("mock_url", [{"error_rate": 1.0}], indirect=True)
+def test_error_injection(mock_url):
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    with pytest.raises(ServiceError) as err:
+        hf.send(b"image")
+    assert err.value.status_code == 503
+
+
+@pytest.mark.parametrize("mock_url", [{"error_rate": 1.0}], indirect=True)
+def test_failures_are_journaled_but_not_done(mock_url, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/mock")
+    with open("data/mock/mock_test_hg.csv", "w") as f:
+        f.write("filename,label\na.jpg,cat\nb.jpg,dog\n")
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    hf.prepare = lambda filename, label: b"image"
+    run_invoke(hf, 20, policy=RetryPolicy(max_attempts=2, base_delay=0.001))
+
+    with ResultsJournal(hf.results_file(20)) as journal:
+        assert len(journal) == 0
+    table = load_results(datasets=["mock"]).sort_by("filename")
+    assert table["status"].to_pylist() == ["503", "503"] and table["attempt"].to_pylist() == [2, 2]
+    assert table["prediction"].null_count == table["latency_ns"].null_count == 2
+
+
+def test_transformed_runs_are_journaled_separately(mock_url, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/mock")
+    with open("data/mock/mock_test_hg.csv", "w") as f:
+        f.write("filename,label\na.jpg,cat\n")
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    hf.prepare = lambda filename, label: b"image"
+    run_invoke(hf, 20)
+    hf.transform = PayloadTransform(max_dimension=1024)
+    run_invoke(hf, 20)
+
+    assert sorted(os.listdir("data/mock/results")) == [
+        "mock-hg+max1024-q85-noexif-results-20.csv",
+        "mock-hg-results-20.csv",
+    ]
+    table = load_results(datasets=["mock"])
+    assert sorted(table["service"].to_pylist()) == ["hg", "hg+max1024-q85-noexif"]
+
+
+@pytest.mark.parametrize("mock_url", [{"rate_limit": 5, "burst": 1}], indirect=True)
+def test_retry_after_throttling(mock_url):
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    hf.prepare = lambda filename, label: b"image"
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01)
+    assert invoke_one(hf, "a.jpg", "cat", policy)[4] == 1
+    prediction, _, latency, _, attempts, start, first_byte, end, payload_bytes = invoke_one(hf, "b.jpg", "cat", policy)
+    assert prediction in LABELS and attempts == 2 and payload_bytes == len(b"image")
+    assert start < first_byte <= end and latency == (end - start) / 1e9
+
+
+@pytest.mark.parametrize("mock_url", [{"rate_limit": 20, "burst": 1}], indirect=True)
+def test_shared_limiter_avoids_throttling(mock_url):
+    hf = HuggingfaceAdapter("mock", f"{mock_url}/hf")
+    hf.prepare = lambda filename, label: b"image"
+    limiter = TokenBucket(rate=15, burst=1)
+    rows = [(f"{i}.jpg", "cat") for i in range(15)]
+    results = []
+    errors = []
+
+    def _call(filename, label):
+        return invoke_one(hf, filename, label, NO_RETRY, limiter)
+
+    def _on_result(filename, label, result):
+        results.append(result)
+
+    def _on_error(filename, label, err):
+        errors.append(err)
+
+    asyncio.run(run_concurrently(_call, rows, 8, _on_result, _on_error))
+    assert len(results) == len(rows) and not errors
+
+
+def test_limiter_only_when_rate_limited(monkeypatch):
+    monkeypatch.delenv("MOCK_RATE_LIMIT", raising=False)
+    limiter = get_limiter("mock", 5)
+    assert get_limiter("mock", 5) is limiter
+    assert get_limiter("mock") is None
+
+
+def test_connection_errors_are_retried_and_do_not_abort_the_run():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    refused_url = f"http://127.0.0.1:{sock.getsockname()[1]}/hf"
+    sock.close()
+    hf = HuggingfaceAdapter("mock", refused_url)
+    hf.prepare = lambda filename, label: b"image"
+    attempts = []
+    hf.send = lambda payload, send=hf.send: attempts.append(1) or send(payload)
+    rows = [(f"{i}.jpg", "cat") for i in range(4)]
+    errors = []
+
+    def _call(filename, label):
+        return invoke_one(hf, filename, label, RetryPolicy(max_attempts=3, base_delay=0.001))
+
+    asyncio.run(run_concurrently(_call, rows, 2, lambda *args: None, lambda filename, label, err: errors.append(err)))
+    assert len(errors) == len(rows) and len(attempts) == 3 * len(rows)
+    assert all(isinstance(err, ServiceError) and err.status_code is None for err in errors)
+
+
+def test_open_loop_records_connection_failures():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    hf = HuggingfaceAdapter("mock", f"http://127.0.0.1:{sock.getsockname()[1]}/hf")
+    sock.close()
+    samples = asyncio.run(_run_open_loop(hf, [b"image"], [0.0, 0.01, 0.02], 4))
+    assert [sample[3] for sample in samples] == ["connection"] * 3
+    assert all(intended <= sent <= completed for intended, sent, completed, _ in samples)
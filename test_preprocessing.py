@@ -0,0 +1,44 @@
+import io
+import os
+import tarfile
+import zipfile
+
+from preprocessing import ingest_dataset
+
+
+def add_file(archive, name, content):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    archive.addfile(info, io.BytesIO(content))
+
+
+def test_beans_zips_go_straight_to_class_folders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/beans")
+    for split in ["train", "test", "validation"]:
+        with zipfile.ZipFile(f"data/beans/{split}.zip", "w") as archive:
+            for class_ in ["healthy", "bean_rust"]:
+                archive.writestr(f"{split}/{class_}/{class_}_{split}.0.jpg", f"{split}-{class_}")
+
+    ingest_dataset("beans")
+    assert sorted(os.listdir("data/beans/train/healthy")) == ["healthy_train.0.jpg", "healthy_validation.0.jpg"]
+    assert os.listdir("data/beans/test/bean_rust") == ["bean_rust_test.0.jpg"]
+    assert sorted(os.listdir("data/beans")) == ["test", "test.zip", "train", "train.zip", "validation.zip"]
+
+
+def test_food_images_before_their_split_lists(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/food")
+    with tarfile.open("data/food/food-101.tar.gz", "w:gz") as archive:
+        # The images come first, so their split is only known once the whole tarball has been read
+        for image in ["pizza/1", "pizza/2", "pizza/3", "sushi/4"]:
+            add_file(archive, f"food-101/images/{image}.jpg", image.encode())
+        add_file(archive, "food-101/meta/train.txt", b"pizza/1\nsushi/4\n")
+        add_file(archive, "food-101/meta/test.txt", b"pizza/2\n")
+
+    ingest_dataset("food")
+    assert os.listdir("data/food/train/pizza") == ["1.jpg"]
+    assert os.listdir("data/food/test/pizza") == ["2.jpg"]
+    with open("data/food/train/sushi/4.jpg", "rb") as f:
+        assert f.read() == b"sushi/4"
+    assert not os.path.exists("data/food/food-101")
@@ -0,0 +1,41 @@
+import boto3
+import pytest
+
+from s3_upload import MB, bulk_upload, local_etag
+
+# moto is a test-only dependency and not in requirements.txt; its mock_aws needs moto 5
+mock_aws = pytest.importorskip("moto").mock_aws
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        yield client
+
+
+def test_bulk_upload_skips_matching_etags(s3, tmp_path):
+    files = []
+    for i in range(5):
+        (tmp_path / f"{i}.jpg").write_bytes(f"image-{i}".encode())
+        files.append((f"{tmp_path}/{i}.jpg", f"train/cat/{i}.jpg"))
+    manifest = f"{tmp_path}/manifest.csv"
+
+    assert bulk_upload(s3, "bucket", files, manifest, workers=4)[:2] == (5, 0)
+    assert bulk_upload(s3, "bucket", files, manifest, workers=4)[:2] == (0, 5)
+
+    (tmp_path / "3.jpg").write_bytes(b"changed")
+    assert bulk_upload(s3, "bucket", files, manifest, workers=4)[:2] == (1, 4)
+    assert s3.get_object(Bucket="bucket", Key="train/cat/3.jpg")["Body"].read() == b"changed"
+
+
+def test_multipart_etag_matches_s3(s3, tmp_path):
+    (tmp_path / "large.jpg").write_bytes(b"x" * (11 * MB))
+    files = [(f"{tmp_path}/large.jpg", "test/large.jpg")]
+    options = {"multipart_threshold": 5 * MB, "multipart_chunksize": 5 * MB}
+
+    assert bulk_upload(s3, "bucket", files, workers=4, **options)[:2] == (1, 0)
+    etag = s3.head_object(Bucket="bucket", Key="test/large.jpg")["ETag"].strip('"')
+    assert etag.endswith("-3") and etag == local_etag(files[0][0], **options)
+    assert bulk_upload(s3, "bucket", files, workers=4, **options)[:2] == (0, 1)
@@ -0,0 +1,131 @@
+"""Concurrency sweep. Runs a service's parallel path at concurrency 1, 2, 4, ... up to max_concurrency and records
+throughput, latency percentiles and error rate at every level, then picks the saturation knee: the last level after
+which adding concurrency stops buying throughput.
+
+Results go to image-classification-throughput-sweep.csv with one row per (service, dataset, ablation, concurrency).
+Rows from an earlier sweep of the same service/dataset/ablation are replaced. render_results.py plots the file as
+throughput-vs-latency curves.
+"""
+
+import asyncio
+import csv
+import os
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from retry import NO_RETRY
+from runner import invoke_one, read_test_rows, run_concurrently
+
+SWEEP_FILE = "image-classification-throughput-sweep.csv"
+SWEEP_COLUMNS = [
+    "service",
+    "dataset",
+    "ablation",
+    "concurrency",
+    "requests",
+    "errors",
+    "error_rate",
+    "duration_s",
+    "throughput_rps",
+    "p50_s",
+    "p95_s",
+    "p99_s",
+    "knee",
+]
+
+
+def concurrency_levels(max_concurrency):
+    levels = [1]
+    while levels[-1] * 2 <= max_concurrency:
+        levels.append(levels[-1] * 2)
+    if levels[-1] != max_concurrency:
+        levels.append(max_concurrency)
+    return levels
+
+
+def run_level(adapter, rows, concurrency):
+    latencies = []
+    errors = 0
+    progress = tqdm(total=len(rows), desc=f"concurrency {concurrency}")
+
+    def _on_result(filename, label, result):
+        latencies.append(result[2])
+        progress.update(1)
+
+    def _on_error(filename, label, err):
+        nonlocal errors
+        errors += 1
+        progress.update(1)
+
+    def _call(filename, label):
+        return invoke_one(adapter, filename, label, NO_RETRY)
+
+    start = time.perf_counter_ns()
+    asyncio.run(run_concurrently(_call, rows, concurrency, _on_result, _on_error))
+    duration = (time.perf_counter_ns() - start) / 1e9
+    progress.close()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (np.nan, np.nan, np.nan)
+    return {
+        "concurrency": concurrency,
+        "requests": len(rows),
+        "errors": errors,
+        "error_rate": errors / len(rows),
+        "duration_s": duration,
+        "throughput_rps": len(latencies) / duration,
+        "p50_s": p50,
+        "p95_s": p95,
+        "p99_s": p99,
+    }
+
+
+def find_knee(levels, min_gain=0.1):
+    """Index of the saturation knee: the last level whose throughput improved on the previous level by more than
+    `min_gain` (relative) without pushing the error rate up. Everything past it buys latency, not throughput."""
+    knee = 0
+    for i in range(1, len(levels)):
+        previous, current = levels[i - 1], levels[i]
+        if previous["throughput_rps"] == 0:
+            break
+        gain = current["throughput_rps"] / previous["throughput_rps"] - 1
+        if gain <= min_gain or current["error_rate"] > previous["error_rate"]:
+            break
+        knee = i
+    return knee
+
+
+def write_sweep(service, dataset, ablationSize, levels, knee, sweep_file=SWEEP_FILE):
+    rows = []
+    if os.path.exists(sweep_file):
+        with open(sweep_file) as f:
+            rows = [
+                row
+                for row in csv.DictReader(f)
+                if (row["service"], row["dataset"], row["ablation"]) != (service, dataset, str(ablationSize))
+            ]
+    for i, level in enumerate(levels):
+        rows.append({"service": service, "dataset": dataset, "ablation": ablationSize, **level, "knee": i == knee})
+
+    with open(sweep_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_sweep(adapter, ablationSize, max_concurrency=64, n_requests=1000, min_gain=0.1):
+    rows = read_test_rows(adapter.test_file(), limit=n_requests)
+    levels = []
+    for concurrency in concurrency_levels(int(max_concurrency)):
+        level = run_level(adapter, rows, concurrency)
+        print(
+            f"concurrency {concurrency}: {level['throughput_rps']:.1f} rps, p50 {level['p50_s']:.3f}s, "
+            f"p95 {level['p95_s']:.3f}s, p99 {level['p99_s']:.3f}s, errors {level['error_rate']:.1%}"
+        )
+        levels.append(level)
+
+    knee = find_knee(levels, min_gain)
+    print(f"Saturation knee at concurrency {levels[knee]['concurrency']}: {levels[knee]['throughput_rps']:.1f} rps")
+    write_sweep(adapter.run_name(), adapter.dataset, ablationSize, levels, knee)
+    return levels, knee
@@ -1,17 +1,36 @@
 from google.cloud import storage, aiplatform
+import asyncio
+import csv
 import os
 import sys
-import csv
+import threading
 import time
-import pandas as pd
 from create_tests import get_bucket_uris
+from gcs_upload import bulk_upload, folder_files
+from http_session import TRANSPORT_ERRORS as HTTP_TRANSPORT_ERRORS
+from image_store import md5_lookup
 import base64
-from joblib import Parallel, delayed
+
+from load_generator import run_open_loop
+from results_journal import ResultsJournal
+from results_store import import_results_csv
+from retry import DEFAULT_POLICY
+from runner import failed_row, read_test_rows, run_concurrently, run_invoke, run_parallel, send_with_retries
+from throughput_sweep import run_sweep
+from service_adapter import ServiceAdapter, ServiceError
 
 
+from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError, ServiceUnavailable
 from google.cloud.aiplatform.gapic.schema import predict
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2 import service_account
 
+# Set VERTEX_API_ENDPOINT to http://localhost:{port} to run against mock_server.py
+DEFAULT_API_ENDPOINT = os.getenv("VERTEX_API_ENDPOINT", "us-central1-aiplatform.googleapis.com")
+# No prediction because the endpoint could not be reached: gRPC reports an unreachable or reset channel as
+# UNAVAILABLE and a timeout as DEADLINE_EXCEEDED, the REST transport raises requests' connection errors
+TRANSPORT_ERRORS = (ServiceUnavailable, DeadlineExceeded) + HTTP_TRANSPORT_ERRORS
+
 
 def upload_to_bucket(blob_name, path_to_file, bucket_name, storage_client):
     bucket = storage_client.get_bucket(bucket_name)
@@ -30,66 +49,128 @@ def get_storage_client():
     return storage.Client.from_service_account_json("gcreds.json")
 
 
-def upload(dataset, google_bucket_name):
+def upload(dataset, google_bucket_name, workers=8):
+    """Uploads the training, validation and test images that are not already in the bucket with the same content."""
     storage_client = get_storage_client()
-
-    for file in os.listdir(f"data/{dataset}/training_uploads"):
-        public_url = upload_to_bucket(
-            f"training_uploads/{file}", f"data/{dataset}/training_uploads/{file}", google_bucket_name, storage_client
+    files = []
+    for folder in ["training_uploads", "val_uploads", "test_uploads"]:
+        files += folder_files(f"data/{dataset}/{folder}", folder)
+    bulk_upload(storage_client, google_bucket_name, files, workers, md5_lookup(dataset))
+
+
+class PredictionClientPool:
+    """Long-lived prediction clients for one regional API endpoint. The service account credentials are loaded once.
+    With per_thread=True every worker thread gets its own client and gRPC channel, otherwise all threads share a
+    single client whose channel multiplexes the concurrent calls. get_async returns a PredictionServiceAsyncClient for
+    the running event loop; it needs gRPC, so it is not available for a REST-only (http://) endpoint."""
+
+    def __init__(self, api_endpoint: str = DEFAULT_API_ENDPOINT, per_thread: bool = True):
+        # The AI Platform services require regional API endpoints.
+        self.client_options = {"api_endpoint": api_endpoint}
+        # A plain http:// endpoint is a local stand-in (mock_server.py), which only speaks REST and needs no credentials
+        self.transport = "rest" if api_endpoint.startswith("http://") else None
+        if self.transport == "rest":
+            self.credentials = AnonymousCredentials()
+        else:
+            self.credentials = service_account.Credentials.from_service_account_file("gcreds.json")
+        self.per_thread = per_thread
+        self._local = threading.local()
+        self._shared = None
+        self._async_clients = {}
+        self._lock = threading.Lock()
+
+    def _new_client(self):
+        return aiplatform.gapic.PredictionServiceClient(
+            client_options=self.client_options, credentials=self.credentials, transport=self.transport
         )
-        print(public_url)
 
-    for file in os.listdir(f"data/{dataset}/val_uploads"):
-        public_url = upload_to_bucket(
-            f"val_uploads/{file}", f"data/{dataset}/val_uploads/{file}", google_bucket_name, storage_client
-        )
-        print(public_url)
-
-    for file in os.listdir(f"data/{dataset}/test_uploads"):
-        print(file)
-        if not check_if_exists(f"test_uploads/{file}", google_bucket_name, storage_client):
-            public_url = upload_to_bucket(
-                f"test_uploads/{file}", f"data/{dataset}/test_uploads/{file}", google_bucket_name, storage_client
+    def get(self):
+        if self.per_thread:
+            client = getattr(self._local, "client", None)
+            if client is None:
+                client = self._local.client = self._new_client()
+            return client
+        with self._lock:
+            if self._shared is None:
+                self._shared = self._new_client()
+            return self._shared
+
+    def check_async(self):
+        """Raises ValueError if get_async cannot work for this endpoint."""
+        if self.transport == "rest":
+            raise ValueError(
+                f"{self.client_options['api_endpoint']} only speaks REST and the async prediction client needs gRPC, "
+                "use invoke or async instead of aio"
             )
-            print(public_url)
 
+    def get_async(self):
+        self.check_async()
+        # grpc.aio channels are bound to the event loop they were created on
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_clients:
+                # Clients of loops that have finished (an earlier asyncio.run) can never be used again
+                self._async_clients = {key: c for key, c in self._async_clients.items() if not key.is_closed()}
+                self._async_clients[loop] = aiplatform.gapic.PredictionServiceAsyncClient(
+                    client_options=self.client_options, credentials=self.credentials
+                )
+            return self._async_clients[loop]
 
-def predict_image_classification_sample(
-    project: str,
-    endpoint_id: str,
-    filename: str,
-    location: str = "us-central1",
-    api_endpoint: str = "us-central1-aiplatform.googleapis.com",
-):
-    # The AI Platform services require regional API endpoints.
-    client_options = {"api_endpoint": api_endpoint}
-    # Initialize client that will be used to create and send requests.
-    # This client only needs to be created once, and can be reused for multiple requests.
-    credentials = service_account.Credentials.from_service_account_file("gcreds.json")
-    client = aiplatform.gapic.PredictionServiceClient(client_options=client_options, credentials=credentials)
 
-    with open(filename, "rb") as f:
-        file_content = f.read()
+_client_pools = {}
+_client_pools_lock = threading.Lock()
+
+
+def get_client_pool(api_endpoint: str = DEFAULT_API_ENDPOINT, per_thread: bool = True):
+    with _client_pools_lock:
+        if (api_endpoint, per_thread) not in _client_pools:
+            _client_pools[(api_endpoint, per_thread)] = PredictionClientPool(api_endpoint, per_thread)
+        return _client_pools[(api_endpoint, per_thread)]
 
+
+def get_prediction_client(api_endpoint: str = DEFAULT_API_ENDPOINT):
+    return get_client_pool(api_endpoint).get()
+
+
+def encode_instance(file_content: bytes):
     # The format of each instance should conform to the deployed model's prediction input schema.
     encoded_content = base64.b64encode(file_content).decode("utf-8")
-    instance = predict.instance.ImageClassificationPredictionInstance(
+    return predict.instance.ImageClassificationPredictionInstance(
         content=encoded_content,
     ).to_value()
-    instances = [instance]
+
+
+def get_parameters():
     # See gs://google-cloud-aiplatform/schema/predict/params/image_classification_1.0.0.yaml for the format of the parameters.
-    parameters = predict.params.ImageClassificationPredictionParams(
+    return predict.params.ImageClassificationPredictionParams(
         confidence_threshold=0.1,
         max_predictions=5,
     ).to_value()
+
+
+def predict_image_classification_sample(
+    project: str,
+    endpoint_id: str,
+    filename: str,
+    location: str = "us-central1",
+    api_endpoint: str = DEFAULT_API_ENDPOINT,
+):
+    # Clients are created once per thread and reused for every request.
+    client = get_prediction_client(api_endpoint)
+
+    with open(filename, "rb") as f:
+        file_content = f.read()
+
+    instances = [encode_instance(file_content)]
+    parameters = get_parameters()
     endpoint = client.endpoint_path(project=project, location=location, endpoint=endpoint_id)
     # start timer to measure latency
-    start = time.time()
+    start = time.perf_counter_ns()
 
     response = client.predict(endpoint=endpoint, instances=instances, parameters=parameters)
     # end timer
-    end = time.time()
-    latency = end - start
+    end = time.perf_counter_ns()
+    latency = (end - start) / 1e9
     print("response")
     print(" deployed_model_id:", response.deployed_model_id)
     # See gs://google-cloud-aiplatform/schema/predict/prediction/image_classification_1.0.0.yaml for the format of the predictions.
@@ -106,98 +187,211 @@ def predict_image_classification_sample(
 # [END aiplatform_predict_image_classification_sample]
 
 
-def invoke(dataset, ablationSize, project_id, endpoint_id):
-    results = [[], [], [], [], []]
-    if not os.path.exists(f"data/{dataset}/results"):
-        os.makedirs(f"data/{dataset}/results")
-    if os.path.exists(f"data/{dataset}/results/{dataset}-vertex-results-{str(ablationSize)}.csv"):
-        df = pd.read_csv(f"data/{dataset}/results/{dataset}-vertex-results-{str(ablationSize)}.csv", header=None)
-        results[0] = df[0].tolist()
-        results[1] = df[1].tolist()
-        results[2] = df[2].tolist()
-        results[3] = df[3].tolist()
-        results[4] = df[4].tolist()
-
-    with open(f"data/{dataset}/{dataset}_test_vertex.csv") as csvfile:
-        reader = csv.reader(csvfile)
-        # get the class labels from classes.txt
-
-        for row in reader:
-            filename = row[0].split("/")[-1]
-            print(filename)
-            if filename in results[0]:
-                print("already done")
-                continue
+class VertexAdapter(ServiceAdapter):
+    name = "vertex"
+    test_suffix = "vertex"
+
+    def __init__(
+        self,
+        dataset,
+        project_id,
+        endpoint_id,
+        location="us-central1",
+        api_endpoint=DEFAULT_API_ENDPOINT,
+        per_thread=True,
+    ):
+        super().__init__(dataset)
+        self.clients = get_client_pool(api_endpoint, per_thread)
+        self.endpoint = aiplatform.gapic.PredictionServiceClient.endpoint_path(
+            project=project_id, location=location, endpoint=endpoint_id
+        )
+        self.parameters = get_parameters()
+
+    def prepare(self, filename, label):
+        return encode_instance(super().prepare(filename, label))
+
+    def payload_size(self, payload):
+        return payload.ByteSize()
+
+    def send(self, payload):
+        return self.send_batch([payload])
+
+    def send_batch(self, instances):
+        client = self.clients.get()
+        try:
+            return client.predict(endpoint=self.endpoint, instances=instances, parameters=self.parameters)
+        except TRANSPORT_ERRORS as err:
+            raise ServiceError(f"Connection failed: {err}") from err
+        except GoogleAPICallError as err:
+            raise ServiceError(str(err), err.code)
+
+    async def send_async(self, payload):
+        client = self.clients.get_async()
+        try:
+            return await client.predict(endpoint=self.endpoint, instances=[payload], parameters=self.parameters)
+        except TRANSPORT_ERRORS as err:
+            raise ServiceError(f"Connection failed: {err}") from err
+        except GoogleAPICallError as err:
+            raise ServiceError(str(err), err.code)
+
+    def parse(self, response):
+        return self.parse_batch(response)[0]
+
+    def parse_batch(self, response):
+        # See gs://google-cloud-aiplatform/schema/predict/prediction/image_classification_1.0.0.yaml for the format
+        # of the predictions. Predictions come back in the same order as the instances.
+        results = []
+        for prediction in response.predictions:
+            prediction = dict(prediction)
+            if len(prediction["displayNames"]) == 0:
+                results.append(("none", 0.0))
             else:
-                with open(f"data/{dataset}/test/{row[1]}/{filename}", "rb") as f:
-                    # measure the latency for this request
-
-                    displayNames, confidences, latency = predict_image_classification_sample(
-                        project=project_id,
-                        endpoint_id=endpoint_id,
-                        location="us-central1",
-                        filename=f"data/{dataset}/test/{row[1]}/{filename}",
-                    )
-                    if len(displayNames) == 0:
-                        results[0].append(filename)
-                        results[1].append(row[1])
-                        results[2].append("none")
-                        results[3].append(0.0)
-                        results[4].append(latency)
-                    else:
-                        results[0].append(filename)
-                        results[1].append(row[1])
-                        results[2].append(displayNames[0])
-                        results[3].append(confidences[0])
-                        results[4].append(latency)
-
-                print(filename, row[1], displayNames, confidences, latency)
-                df = pd.DataFrame(results)
-                df = df.transpose()
-                df.to_csv(
-                    f"data/{dataset}/results/{dataset}-vertex-results-{str(ablationSize)}.csv",
-                    index=False,
-                    header=False,
+                results.append((prediction["displayNames"][0], prediction["confidences"][0]))
+        return results or [("none", 0.0)]
+
+
+def make_batches(sized_rows, max_instances=10, max_payload_bytes=1_500_000):
+    """Packs consecutive (row, size) pairs into batches of at most max_instances whose total size stays under
+    max_payload_bytes (online prediction requests are capped at 1.5MB). An image that is larger than the limit on its
+    own is sent alone. Batches are yielded as they fill up, so `sized_rows` can be a lazy iterator."""
+    batch = []
+    batch_bytes = 0
+    for row, size in sized_rows:
+        if batch and (len(batch) == max_instances or batch_bytes + size > max_payload_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((row, size))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+class VertexBatchAdapter(VertexAdapter):
+    """VertexAdapter whose results go to the vertex_batch results file."""
+
+    name = "vertex_batch"
+
+    def instance_size(self, filename, label):
+        """Serialized size of the instance prepare builds for an image, from the size of its file: the base64 content
+        is 4/3 of the bytes, plus a few bytes of protobuf framing. Only stats the file, so batches can be formed
+        without reading the images."""
+        return 4 * -(-os.path.getsize(self.image_path(filename, label)) // 3) + 32
+
+    def parse_full_batch(self, response, n_instances):
+        """parse_batch for a batch of n_instances, failing the whole batch if any prediction is missing."""
+        if len(response.predictions) != n_instances:
+            raise ValueError(f"{len(response.predictions)} predictions for {n_instances} instances")
+        return self.parse_batch(response)
+
+
+def batch_invoke(
+    dataset,
+    ablationSize,
+    project_id,
+    endpoint_id,
+    max_instances=10,
+    max_payload_bytes=1_500_000,
+    concurrency=1,
+    policy=DEFAULT_POLICY,
+):
+    """Accuracy run that packs several images into each predict call. Batches are retried according to `policy` like
+    single requests in runner.py, and every image gets a full results row in the vertex_batch results file: attempts,
+    start_ns and end_ns are those of its batch, so its latency is the time until its prediction came back. The images
+    of a batch that fails for good are journaled as failures and retried on the next run. Every batch is logged to
+    data/{dataset}/batches/{dataset}-vertex-batches-{ablation}.csv as [batch_index, n_images, payload_bytes,
+    batch_latency, per_image_latency], where per_image_latency is the batch latency split evenly over its images."""
+    adapter = VertexBatchAdapter(dataset, project_id, endpoint_id)
+    if not os.path.exists(f"data/{dataset}/batches"):
+        os.makedirs(f"data/{dataset}/batches")
+    batch_file = f"data/{dataset}/batches/{dataset}-vertex-batches-{str(ablationSize)}.csv"
+
+    with ResultsJournal(adapter.results_file(ablationSize)) as journal, open(batch_file, "a", newline="") as f:
+        batch_writer = csv.writer(f)
+        rows = [row for row in read_test_rows(adapter.test_file()) if row[0] not in journal]
+        # Batches are sized from the file sizes; the images are read and encoded by the worker thread that sends them
+        sized_rows = ((row, adapter.instance_size(*row)) for row in rows)
+        batches = enumerate(make_batches(sized_rows, int(max_instances), int(max_payload_bytes)))
+        print(f"{len(journal)} already done, {len(rows)} images to go in batches of up to {max_instances}")
+        batch_latencies = []
+        errors = 0
+
+        def _call(batch_index, batch):
+            instances = [adapter.prepare(*row) for row, _ in batch]
+            result = send_with_retries(
+                adapter.send_batch,
+                lambda response: adapter.parse_full_batch(response, len(instances)),
+                instances,
+                f"batch {batch_index}",
+                policy,
+            )
+            return result, [instance.ByteSize() for instance in instances]
+
+        def _on_result(batch_index, batch, result):
+            (predictions, attempts, start, end), sizes = result
+            latency = (end - start) / 1e9
+            for ((filename, label), _), size, (prediction, confidence) in zip(batch, sizes, predictions):
+                journal.append(
+                    [filename, label, prediction, confidence, latency, None, attempts, start, None, end, size, "ok"]
                 )
+            payload_bytes = sum(sizes)
+            batch_writer.writerow([batch_index, len(batch), payload_bytes, latency, latency / len(batch)])
+            batch_latencies.append((len(batch), latency))
+
+        def _on_error(batch_index, batch, err):
+            nonlocal errors
+            print(f"Invalid response {err} {batch_index=} images={len(batch)}")
+            for (filename, label), _ in batch:
+                journal.append(failed_row(filename, label, err))
+            errors += len(batch)
+
+        asyncio.run(run_concurrently(_call, batches, int(concurrency), _on_result, _on_error))
+    import_results_csv(adapter.results_file(ablationSize))
+
+    if batch_latencies:
+        n_images = sum(n for n, _ in batch_latencies)
+        total_latency = sum(latency for _, latency in batch_latencies)
+        print(f"{n_images} images in {len(batch_latencies)} requests")
+        print(f"Mean latency per batch: {total_latency / len(batch_latencies)}")
+        print(f"Mean latency per image: {total_latency / n_images}")
+    if errors:
+        print(f"Failed: {errors} images")
+
+
+def invoke(dataset, ablationSize, project_id, endpoint_id):
+    run_invoke(VertexAdapter(dataset, project_id, endpoint_id), ablationSize)
 
 
 def parallel_invoke(dataset, ablationSize, project_id, endpoint_id):
-    filenames = []
-    labels = []
-    with open(f"data/{dataset}/{dataset}_test_vertex.csv") as csvfile:
-        reader = csv.reader(csvfile)
-        # get the class labels from classes.txt
-        count = 0
-        for row in reader:
-            filenames.append(row[0].split("/")[-1])
-            labels.append(row[1])
-            count += 1
-            if count == 1000:
-                break
-
-    def _parallel_invoke(filename: str, label: str, project_id: str, endpoint_id: str):
-        displayNames, confidences, latency = predict_image_classification_sample(
-            project=project_id,
-            endpoint_id=endpoint_id,
-            location="us-central1",
-            filename=f"data/{dataset}/test/{label}/{filename}",
-        )
+    run_parallel(VertexAdapter(dataset, project_id, endpoint_id), ablationSize)
+
 
-    start = time.time()
-    Parallel(n_jobs=10, prefer="threads")(
-        delayed(_parallel_invoke)(filename, label, project_id, endpoint_id)
-        for filename, label in zip(filenames, labels)
-    )
-    end = time.time()
-    print(f"Time to 1000 invokes {dataset}-{ablationSize}: {end - start}")
+def async_invoke(dataset, ablationSize, project_id, endpoint_id, concurrency=10):
+    run_invoke(VertexAdapter(dataset, project_id, endpoint_id), ablationSize, concurrency)
+
+
+def aio_invoke(dataset, ablationSize, project_id, endpoint_id, concurrency=10):
+    adapter = VertexAdapter(dataset, project_id, endpoint_id)
+    # Fail before the run instead of recording every image as failed
+    adapter.clients.check_async()
+    run_invoke(adapter, ablationSize, concurrency, use_send_async=True)
+
+
+def load_test(dataset, ablationSize, project_id, endpoint_id, rps, duration=60, warmup=10):
+    run_open_loop(VertexAdapter(dataset, project_id, endpoint_id), ablationSize, rps, duration, warmup)
+
+
+def sweep(dataset, ablationSize, project_id, endpoint_id, max_concurrency=64, n_requests=1000):
+    run_sweep(VertexAdapter(dataset, project_id, endpoint_id), ablationSize, max_concurrency, n_requests)
 
 
 if __name__ == "__main__":
     if sys.argv[1] == "upload":
         dataset = sys.argv[2]
-        google_bucket_name, _, _, _ = get_bucket_uris(dataset)
+        google_bucket_name, _, _ = get_bucket_uris(dataset)
         google_bucket_name = google_bucket_name.split("/")[2]
-        upload(dataset, google_bucket_name)
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+        upload(dataset, google_bucket_name, workers)
     elif sys.argv[1] == "invoke":
         dataset = sys.argv[2]
         ablation = sys.argv[3]
@@ -210,3 +404,42 @@ if __name__ == "__main__":
         project_id = sys.argv[4]
         endpoint_id = sys.argv[5]
         parallel_invoke(dataset, ablation, project_id, endpoint_id)
+    elif sys.argv[1] == "async":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        project_id = sys.argv[4]
+        endpoint_id = sys.argv[5]
+        concurrency = int(sys.argv[6]) if len(sys.argv) > 6 else 10
+        async_invoke(dataset, ablation, project_id, endpoint_id, concurrency)
+    elif sys.argv[1] == "load":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        project_id = sys.argv[4]
+        endpoint_id = sys.argv[5]
+        rps = float(sys.argv[6])
+        duration = float(sys.argv[7]) if len(sys.argv) > 7 else 60
+        warmup = float(sys.argv[8]) if len(sys.argv) > 8 else 10
+        load_test(dataset, ablation, project_id, endpoint_id, rps, duration, warmup)
+    elif sys.argv[1] == "sweep":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        project_id = sys.argv[4]
+        endpoint_id = sys.argv[5]
+        max_concurrency = int(sys.argv[6]) if len(sys.argv) > 6 else 64
+        n_requests = int(sys.argv[7]) if len(sys.argv) > 7 else 1000
+        sweep(dataset, ablation, project_id, endpoint_id, max_concurrency, n_requests)
+    elif sys.argv[1] == "aio":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        project_id = sys.argv[4]
+        endpoint_id = sys.argv[5]
+        concurrency = int(sys.argv[6]) if len(sys.argv) > 6 else 10
+        aio_invoke(dataset, ablation, project_id, endpoint_id, concurrency)
+    elif sys.argv[1] == "batch":
+        dataset = sys.argv[2]
+        ablation = sys.argv[3]
+        project_id = sys.argv[4]
+        endpoint_id = sys.argv[5]
+        max_instances = int(sys.argv[6]) if len(sys.argv) > 6 else 10
+        concurrency = int(sys.argv[7]) if len(sys.argv) > 7 else 1
+        batch_invoke(dataset, ablation, project_id, endpoint_id, max_instances, concurrency=concurrency)